@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""Benchmarks sftpman's commands against a fake environment, for many systems.
+
+Nothing gets mounted for real: stand-ins for `sshfs`, `fusermount`, `ssh` and `pgrep`
+(shell scripts, put first in `PATH`) keep a fake mount table, which sftpman is pointed to.
+They can be made slow (`--latency`) or unreliable (`--failure-rate`).
+
+Each command runs in its own Python process (like it would for real), and we report:
+- the wall time of the whole process and of the command itself
+- how many processes it started (as counted by the stand-ins)
+- its peak memory use (RSS)
+
+Usage: python benchmarks/run.py [options]
+Available options:
+    --sizes={comma-separated numbers of systems} [default: 10,100,1000,5000]
+    --jobs={number of systems to work on concurrently} [default: 32]
+    --latency={seconds sshfs takes to mount} [default: 0]
+    --failure-rate={share of mounts failing, between 0 and 1} [default: 0]
+    --json
+        Print the results as JSON (one object per line), instead of a table.
+    --baseline={file with results from `--json`}
+        Compare against earlier results and fail if anything got slower (or started more processes)
+        by more than the tolerance.
+    --tolerance={factor} [default: 1.5]
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: The commands to benchmark, in order (each one works on what the previous ones left).
+#: `{ids}` stands for all system ids, `{jobs}` for the number of jobs.
+COMMANDS = (
+    ('ls', ['ls', 'available']),
+    ('mount_all', ['mount_all', '--jobs={jobs}']),
+    ('ls mounted', ['ls', 'mounted']),
+    ('status', ['status']),
+    ('umount_all', ['umount_all', '--jobs={jobs}']),
+    ('mount_all (again)', ['mount_all', '--jobs={jobs}']),
+    ('rm', ['rm', '--jobs={jobs}', '{ids}']),
+)
+
+#: Mounts found on a typical machine, so the mount table isn't unrealistically small.
+BASE_MOUNTINFO = [
+    '21 1 0:20 / /proc rw,nosuid,nodev,noexec,relatime - proc proc rw',
+    '22 1 0:21 / /sys rw,nosuid,nodev,noexec,relatime - sysfs sysfs rw',
+    '23 1 0:5 / /dev rw,nosuid - devtmpfs devtmpfs rw,size=8000000k,mode=755',
+    '24 1 8:1 / / rw,relatime - ext4 /dev/sda1 rw',
+    '25 1 0:22 / /run rw,nosuid,nodev - tmpfs tmpfs rw,mode=755',
+    '26 1 0:23 / /tmp rw,nosuid,nodev - tmpfs tmpfs rw',
+    '27 1 8:2 / /home rw,relatime - ext4 /dev/sda2 rw',
+]
+
+STUB_PRELUDE = '''#!/bin/sh
+echo "$(basename "$0")" >> "$BENCH_DIR/calls"
+for last; do :; done
+'''
+
+#: Mounts (unless it's made to fail), like sshfs does once connected.
+STUB_SSHFS = STUB_PRELUDE + '''
+if [ "$BENCH_LATENCY" != "0" ]; then
+    sleep "$BENCH_LATENCY"
+fi
+if [ "$BENCH_FAILURE_THRESHOLD" -gt 0 ] && [ "$(od -An -N2 -tu2 /dev/urandom)" -lt "$BENCH_FAILURE_THRESHOLD" ]; then
+    echo "read: Connection reset by peer" >&2
+    exit 1
+fi
+exec 9>"$BENCH_DIR/mountinfo.lock"
+flock 9
+echo "99 24 0:99 / $last rw,nosuid,nodev,relatime - fuse.sshfs bench rw,user_id=0,group_id=0" >> "$BENCH_DIR/mountinfo"
+'''
+
+#: Unmounts (`-u`, `-uz`), failing like the real one if nothing's mounted there.
+STUB_FUSERMOUNT = STUB_PRELUDE + '''
+exec 9>"$BENCH_DIR/mountinfo.lock"
+flock 9
+if ! grep -q " $last rw" "$BENCH_DIR/mountinfo"; then
+    echo "fusermount: entry for $last not found in /etc/mtab" >&2
+    exit 1
+fi
+grep -v " $last rw" "$BENCH_DIR/mountinfo" > "$BENCH_DIR/mountinfo.new"
+mv "$BENCH_DIR/mountinfo.new" "$BENCH_DIR/mountinfo"
+'''
+
+#: sftpman isn't supposed to need these for the benchmarked commands, but we'd like to know if it does.
+STUB_OTHER = STUB_PRELUDE + '''
+exit 1
+'''
+
+STUBS = (
+    ('sshfs', STUB_SSHFS),
+    ('fusermount', STUB_FUSERMOUNT),
+    ('ssh', STUB_OTHER),
+    ('pgrep', STUB_OTHER),
+)
+
+
+class Workspace(object):
+    """A fake environment: stand-in executables, a fake mount table and N configured systems."""
+
+    def __init__(self, size, latency=0, failure_rate=0):
+        self.size = size
+        self.path = tempfile.mkdtemp(prefix='sftpman-bench-')
+        self.bin_path = os.path.join(self.path, 'bin')
+        self.env = dict(os.environ)
+        self.env.update({
+            'PATH': '%s:%s' % (self.bin_path, os.environ['PATH']),
+            'BENCH_DIR': self.path,
+            'BENCH_LATENCY': str(latency),
+            'BENCH_FAILURE_THRESHOLD': str(int(failure_rate * 65536)),
+            'XDG_CONFIG_HOME': os.path.join(self.path, 'config'),
+            'XDG_CACHE_HOME': os.path.join(self.path, 'cache'),
+            'XDG_RUNTIME_DIR': os.path.join(self.path, 'run'),
+            'PYTHONPATH': REPO_PATH,
+            'SFTPMAN_NO_DAEMON': '1',
+        })
+        self.system_ids = ['bench-%05d' % idx for idx in range(size)]
+
+    def create(self):
+        os.mkdir(self.bin_path)
+        for name, content in STUBS:
+            path = os.path.join(self.bin_path, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            os.chmod(path, 0o755)
+        os.mkdir(self.env['XDG_RUNTIME_DIR'], 0o700)
+        with open(os.path.join(self.path, 'mountinfo'), 'w') as f:
+            f.write('\n'.join(BASE_MOUNTINFO) + '\n')
+        open(os.path.join(self.path, 'calls'), 'w').close()
+
+        # Configuring systems isn't what we measure, so it's done in bulk.
+        subprocess.check_call([sys.executable, __file__, '--create-systems', self.path, str(self.size)], env=self.env)
+
+    def destroy(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def count_calls(self):
+        """Returns (and resets) the number of times each stand-in was run."""
+        calls_path = os.path.join(self.path, 'calls')
+        with open(calls_path) as f:
+            names = f.read().split()
+        open(calls_path, 'w').close()
+        counts = dict((name, 0) for name, _ in STUBS)
+        for name in names:
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def run(self, argv):
+        """Runs an sftpman command in a new process.
+        :return: dict with the measurements
+        """
+        started = time.monotonic()
+        proc = subprocess.Popen(
+            [sys.executable, __file__, '--worker', self.path] + argv,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        output = proc.stdout.read()
+        proc.stdout.close()
+        # Unlike `resource.getrusage()`, this tells us about this process alone.
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - started
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        result['wall'] = wall
+        # ru_maxrss is in kilobytes on Linux
+        result['peak_rss_mb'] = usage.ru_maxrss / 1024.0
+        result['processes'] = self.count_calls()
+        return result
+
+
+def _create_environment(path):
+    from sftpman.model import EnvironmentModel
+    environment = EnvironmentModel()
+    environment.mount_path_base = os.path.join(path, 'mnt') + '/'
+    environment.mountinfo_path = os.path.join(path, 'mountinfo')
+    return environment
+
+
+def create_systems(path, size):
+    """Configures `size` systems, spread over (up to) 100 hosts."""
+    from sftpman import bulk
+    from sftpman.model import SystemModel
+    environment = _create_environment(path)
+    systems = [
+        SystemModel(
+            id='bench-%05d' % idx,
+            host='bench-host-%03d' % (idx % 100),
+            user='bench',
+            mountPoint='/srv/%d' % idx,
+            authType=SystemModel.AUTH_METHOD_AUTHENTICATION_AGENT,
+        )
+        for idx in range(size)
+    ]
+    bulk.save_systems(systems, environment)
+
+
+def run_worker(path, argv):
+    """Runs an sftpman command (in this process) and prints how long it took (as JSON)."""
+    from sftpman.cli import SftpCli, dispatch
+    environment = _create_environment(path)
+    with open(os.devnull, 'w') as devnull:
+        cli = SftpCli(environment, stdout=devnull, stderr=devnull)
+        exit_code = 0
+        started = time.monotonic()
+        try:
+            dispatch(cli, argv)
+        except SystemExit as e:
+            exit_code = e.code or 0
+        seconds = time.monotonic() - started
+    print(json.dumps({'seconds': seconds, 'exit_code': exit_code}))
+
+
+def run_benchmarks(sizes, jobs, latency, failure_rate):
+    """Runs all commands for each size.
+    :return: list of dicts (one per command and size)
+    """
+    results = []
+    for size in sizes:
+        workspace = Workspace(size, latency, failure_rate)
+        try:
+            workspace.create()
+            for name, argv in COMMANDS:
+                expanded = []
+                for arg in argv:
+                    if arg == '{ids}':
+                        expanded += workspace.system_ids
+                    else:
+                        expanded.append(arg.replace('{jobs}', str(jobs)))
+                result = workspace.run(expanded)
+                result.update({'size': size, 'command': name})
+                results.append(result)
+        finally:
+            workspace.destroy()
+    return results
+
+
+def print_table(results):
+    rows = [('SYSTEMS', 'COMMAND', 'WALL', 'COMMAND TIME', 'PROCESSES', 'PEAK RSS', 'EXIT')]
+    for result in results:
+        processes = result['processes']
+        breakdown = ', '.join('%s: %d' % (name, count) for name, count in sorted(processes.items()) if count != 0)
+        rows.append((
+            str(result['size']),
+            result['command'],
+            '%.3fs' % result['wall'],
+            '%.3fs' % result['seconds'],
+            '%d%s' % (sum(processes.values()), ' (%s)' % breakdown if breakdown else ''),
+            '%.1f MB' % result['peak_rss_mb'],
+            str(result['exit_code']),
+        ))
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compares results with a baseline (results from an earlier run).
+    Times may grow by `tolerance` (a factor), the number of processes started may not grow at all.
+    :return: list of strings describing the regressions
+    """
+    # Timing noise on tiny numbers would be reported as huge regressions.
+    min_seconds = 0.05
+    previous = dict(((result['size'], result['command']), result) for result in baseline)
+    regressions = []
+    for result in results:
+        base = previous.get((result['size'], result['command']))
+        if base is None:
+            continue
+        label = '%s (%d systems)' % (result['command'], result['size'])
+        if result['wall'] > max(base['wall'] * tolerance, min_seconds):
+            regressions.append('%s: took %.3fs, was %.3fs' % (label, result['wall'], base['wall']))
+        processes, base_processes = sum(result['processes'].values()), sum(base['processes'].values())
+        if processes > base_processes:
+            regressions.append('%s: started %d processes, was %d' % (label, processes, base_processes))
+    return regressions
+
+
+def main(args):
+    def usage():
+        print(__doc__)
+        sys.exit(1)
+
+    try:
+        opts, _ = getopt.gnu_getopt(args, "", [
+            "sizes=", "jobs=", "latency=", "failure-rate=", "json", "baseline=", "tolerance=",
+        ])
+    except getopt.GetoptError as e:
+        sys.stderr.write('Error: %s\n\n' % e)
+        usage()
+
+    opts = dict(opts)
+    try:
+        sizes = [int(size) for size in opts.get('--sizes', '10,100,1000,5000').split(',')]
+        jobs = int(opts.get('--jobs', 32))
+        latency = float(opts.get('--latency', 0))
+        failure_rate = float(opts.get('--failure-rate', 0))
+        tolerance = float(opts.get('--tolerance', 1.5))
+    except ValueError as e:
+        sys.stderr.write('Error: %s\n\n' % e)
+        usage()
+
+    results = run_benchmarks(sizes, jobs, latency, failure_rate)
+    if '--json' in opts:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+    else:
+        print_table(results)
+
+    if '--baseline' in opts:
+        with open(opts['--baseline']) as f:
+            baseline = [json.loads(line) for line in f if line.strip() != '']
+        regressions = find_regressions(results, baseline, tolerance)
+        for regression in regressions:
+            sys.stderr.write('Regression: %s\n' % regression)
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, REPO_PATH)
+    if sys.argv[1:2] == ['--worker']:
+        run_worker(sys.argv[2], sys.argv[3:])
+    elif sys.argv[1:2] == ['--create-systems']:
+        create_systems(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Measures how long sftpman takes to start, and checks it against a budget.
+
+Shell completion runs `sftpman ls` (unless its cache is up to date) on every TAB,
+so starting up has to stay fast. Each measurement is the median wall time of several runs,
+each in a new process, in a fake environment with some configured systems (see `run.py`).
+What counts against the budget is the time on top of starting the Python interpreter itself.
+
+We also check that `ls` doesn't import modules it has no use for (they're what makes starting up slow).
+
+Usage: python benchmarks/startup.py [options]
+Available options:
+    --runs={number of runs of each command} [default: 20]
+    --systems={number of configured systems} [default: 100]
+    --budget={milliseconds `ls` may take on top of starting Python} [default: 25]
+    --json
+        Print the results as JSON (one object per line), instead of a table.
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import subprocess
+
+import run
+
+
+#: Runs sftpman (like the `sftpman` executable does), with the arguments which follow
+LAUNCHER = 'import sys; from sftpman.launcher import main; main()'
+
+#: Runs `sftpman ls`, then tells (on stderr) which of the modules `ls` shouldn't need got imported
+LAUNCHER_REPORTING_MODULES = (
+    'import sys; from sftpman.launcher import main; main(); '
+    'sys.stderr.write(" ".join(sorted(name for name in %r if name in sys.modules)))'
+)
+
+#: Modules which are slow to import and which `ls` has no use for
+HEAVY_MODULES = ('json', 're', 'subprocess', 'socket', 'concurrent.futures', 'hashlib', 'getopt', 'shlex')
+
+COMPLETION_PATH = os.path.join(run.REPO_PATH, 'bash_completion.d', 'sftpman')
+
+
+def get_commands():
+    """:return: list of two-tuples (name, argv)"""
+    return [
+        ('python (baseline)', [sys.executable, '-c', 'pass']),
+        ('ls', [sys.executable, '-c', LAUNCHER, 'ls', 'available']),
+        ('ls mounted', [sys.executable, '-c', LAUNCHER, 'ls', 'mounted']),
+        ('help', [sys.executable, '-c', LAUNCHER, 'help']),
+        # The cache is there (`ls` wrote it), so this doesn't start Python at all.
+        ('completion (cached)', ['bash', '-c', 'source "$0" && _sftpman_ids available', COMPLETION_PATH]),
+    ]
+
+
+def measure(argv, env, runs):
+    """:return: median wall time (in seconds) of running the command"""
+    timings = []
+    for _ in range(runs):
+        started = time.monotonic()
+        subprocess.check_call(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.monotonic() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def find_heavy_imports(env):
+    argv = [sys.executable, '-c', LAUNCHER_REPORTING_MODULES % (HEAVY_MODULES,), 'ls', 'available']
+    proc = subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return proc.stderr.decode('utf-8').split()
+
+
+def main(args):
+    def usage():
+        print(__doc__)
+        sys.exit(1)
+
+    try:
+        opts, _ = getopt.gnu_getopt(args, "", ["runs=", "systems=", "budget=", "json"])
+    except getopt.GetoptError as e:
+        sys.stderr.write('Error: %s\n\n' % e)
+        usage()
+
+    opts = dict(opts)
+    try:
+        runs = int(opts.get('--runs', 20))
+        size = int(opts.get('--systems', 100))
+        budget = float(opts.get('--budget', 25)) / 1000
+    except ValueError as e:
+        sys.stderr.write('Error: %s\n\n' % e)
+        usage()
+
+    workspace = run.Workspace(size)
+    try:
+        workspace.create()
+        # sftpman should use the real mount table here, like shell completion does.
+        env = dict(workspace.env)
+        results = []
+        for name, argv in get_commands():
+            results.append({'command': name, 'seconds': measure(argv, env, runs), 'size': size})
+        heavy_imports = find_heavy_imports(env)
+    finally:
+        workspace.destroy()
+
+    baseline = results[0]['seconds']
+    for result in results[1:]:
+        if result['command'] != 'completion (cached)':
+            result['overhead'] = result['seconds'] - baseline
+
+    if '--json' in opts:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+    else:
+        rows = [('COMMAND', 'MEDIAN', 'ON TOP OF PYTHON')]
+        for result in results:
+            overhead = result.get('overhead')
+            rows.append((
+                result['command'],
+                '%.1fms' % (result['seconds'] * 1000),
+                '' if overhead is None else '%.1fms' % (overhead * 1000),
+            ))
+        widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+    failed = False
+    ls_overhead = results[1]['overhead']
+    if ls_overhead > budget:
+        sys.stderr.write('Over budget: `ls` takes %.1fms on top of starting Python (budget: %.1fms)\n' % (
+            ls_overhead * 1000, budget * 1000,
+        ))
+        failed = True
+    if len(heavy_imports) != 0:
+        sys.stderr.write('`ls` imports modules it has no use for: %s\n' % ', '.join(heavy_imports))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, run.REPO_PATH)
+    main(sys.argv[1:])
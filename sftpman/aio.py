@@ -0,0 +1,356 @@
+"""An asyncio-native take on `SystemControllerModel`, for embedding sftpman in event loops (GUIs, services)."""
+
+import os
+import time
+import select
+import asyncio
+import collections
+from asyncio.subprocess import PIPE
+
+from . import timing
+from .helper import CommandResult, pid_exists
+from .exception import SftpException
+from .model import EnvironmentModel, SystemControllerModel
+from .proc import MountWatcher
+from .state import diff_argv
+
+
+#: What `AsyncSystemController.status()` reports.
+#: `pid` and `config_drift` (see `SystemControllerModel.get_config_drift()`) are None
+#: unless sftpman mounted the system.
+SystemStatus = collections.namedtuple('SystemStatus', 'system_id mounted source pid config_drift')
+
+#: How many systems `mount_many()` mounts at once
+MOUNT_MANY_JOBS = 8
+
+#: How many systems on the same host `mount_many()` mounts at once
+MOUNT_MANY_PER_HOST = 2
+
+
+class AsyncMountWatcher(object):
+    """Waits for changes to the mount table without blocking the event loop (see `MountWatcher`).
+
+    The kernel signals changes to `/proc/self/mountinfo` with POLLPRI, which asyncio doesn't watch for.
+    An epoll instance of our own (watching for just that) becomes readable instead, which asyncio does watch for.
+    """
+
+    def __init__(self, path=None):
+        self._watcher = MountWatcher(path)
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._epoll = None
+        fd = self._watcher.fileno()
+        if fd is not None:
+            self._epoll = select.epoll()
+            self._epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+
+    def close(self):
+        if self._epoll is not None:
+            self._loop.remove_reader(self._epoll.fileno())
+            self._epoll.close()
+        self._watcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self):
+        """Reads the current mount table (this also resets the change notification)."""
+        return self._watcher.read()
+
+    def _on_change(self):
+        # The kernel keeps signaling until the mount table gets read again,
+        # so we stop listening until the next `wait()`.
+        self._loop.remove_reader(self._epoll.fileno())
+        self._changed.set()
+
+    async def wait(self, timeout=None):
+        """Waits until the mount table (possibly) changes or `timeout` seconds pass."""
+        if self._epoll is None:
+            interval = MountWatcher.CHECK_INTERVAL_SECONDS
+            await asyncio.sleep(interval if timeout is None else min(timeout, interval))
+            return
+        self._changed.clear()
+        self._loop.add_reader(self._epoll.fileno(), self._on_change)
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _kill_process(proc):
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def _communicate(proc, timeout=None):
+    """Collects the output of a process (started with pipes), once it exits.
+    :return: two-tuple (stdout, stderr), or None if `timeout` seconds passed first
+    """
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    return (stdout or b'').decode('utf-8', 'replace'), (stderr or b'').decode('utf-8', 'replace')
+
+
+async def run_command(command, timeout=None, shell=False):
+    """Like `sftpman.helper.run_command()`, without blocking the event loop.
+    If whoever's waiting gets cancelled, the command gets killed.
+    :return: CommandResult
+    """
+    try:
+        if shell:
+            proc = await asyncio.create_subprocess_shell(command, stdout=PIPE, stderr=PIPE)
+        else:
+            proc = await asyncio.create_subprocess_exec(*command, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        return CommandResult(127, '', str(e), False)
+    try:
+        output = await _communicate(proc, timeout)
+    except asyncio.CancelledError:
+        _kill_process(proc)
+        raise
+    if output is not None:
+        return CommandResult(proc.returncode, output[0], output[1], False)
+    _kill_process(proc)
+    # Something stuck in uninterruptible sleep (a dead FUSE mount can do that) is left behind.
+    output = await _communicate(proc, 1) or ('', '')
+    return CommandResult(proc.returncode, output[0], output[1], True)
+
+
+async def wait_for_pid_exit(pid, timeout):
+    """Like `sftpman.helper.wait_for_pid_exit()`, without blocking the event loop.
+    :return: boolean - whether the process is gone
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # No pidfd support (Python < 3.9 or Linux < 5.3)
+        deadline = time.monotonic() + timeout
+        while pid_exists(pid):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(0.05, remaining))
+        return True
+
+    exited = loop.create_future()
+    loop.add_reader(fd, lambda: exited.done() or exited.set_result(True))
+    try:
+        await asyncio.wait_for(exited, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+class AsyncSystemController(object):
+    """Mounts, unmounts and checks on a system from within an event loop,
+    going through the same steps as `SystemControllerModel` (see `SystemControllerModel._mount_steps()`).
+
+    Commands (sshfs, fusermount) run as asyncio subprocesses
+    and waiting (for the mount to show up, for sshfs to exit) never blocks the loop.
+    What can't be done without blocking (the before-mount command when it's shared with other systems,
+    starting a shared SSH connection) runs in the loop's default executor.
+
+    Cancelling `mount()` kills whatever it was running, unmounts whatever sshfs managed to mount
+    and removes the mount point.
+    """
+
+    def __init__(self, system, environment, progress_callback=None):
+        self.system = system
+        self.environment = environment
+        #: Knows the steps and does the work which doesn't block.
+        #: Its settings (`mount_wait_time`, `unmount_strategy`, ..) apply.
+        self.controller = SystemControllerModel(system, environment)
+        #: Called with (system id, event) as things progress (see `SystemControllerModel.progress_callback`).
+        self.progress_callback = progress_callback
+        #: Records how long each phase takes (a `sftpman.timing.PhaseTimer`), if set
+        self.timer = None
+
+    async def _run_steps(self, steps):
+        """Like `SystemControllerModel._run_steps()`, waiting within the event loop.
+        If whoever's waiting gets cancelled, the operation stops where it is (see `_perform()`).
+        """
+        result = None
+        try:
+            while True:
+                result = await self._perform(steps.send(result))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+    async def _perform(self, step):
+        kind = step[0]
+        if kind == SystemControllerModel.STEP_CALL:
+            return await asyncio.get_running_loop().run_in_executor(None, step[1])
+        if kind == SystemControllerModel.STEP_RUN:
+            _, command, shell, timeout = step
+            if self.timer is not None:
+                self.timer.count_command(command)
+            return await run_command(command, timeout=timeout, shell=shell)
+        if kind == SystemControllerModel.STEP_MOUNT:
+            _, command, shell, timeout = step
+            return await self._mount_and_wait(command, shell, timeout)
+        if kind == SystemControllerModel.STEP_DETACH:
+            await _communicate(step[1], 1)
+            return None
+        if kind == SystemControllerModel.STEP_WAIT_FOR_EXIT:
+            return await wait_for_pid_exit(step[1], step[2])
+        raise ValueError('Unknown step: %s' % kind)
+
+    def _prepare(self):
+        self.controller.timer = self.timer
+        self.controller.progress_callback = self.progress_callback
+        # Something long-lived can't go by an old snapshot of the mount table.
+        self.environment.invalidate_mount_table()
+
+    async def mount(self):
+        """Mounts the system if it's not already mounted.
+        :return: boolean - whether it got mounted (False if it already was)
+        """
+        self._prepare()
+        try:
+            try:
+                mounted = await self._run_steps(self.controller._mount_steps())
+            except asyncio.CancelledError:
+                # Cleaning up must not be cut short by another cancellation.
+                await asyncio.shield(self._run_steps(self.controller._abandon_mount_steps()))
+                raise
+        except SftpException as e:
+            self.controller._finish(timing.OUTCOME_FAILED, e)
+            raise
+        self.controller._finish(timing.OUTCOME_MOUNTED if mounted else timing.OUTCOME_ALREADY_MOUNTED)
+        return mounted
+
+    async def _mount_and_wait(self, command, shell, timeout):
+        """Like `SystemControllerModel._mount_and_wait()`. Getting cancelled kills sshfs."""
+        if self.timer is not None:
+            self.timer.count_command(command)
+        with AsyncMountWatcher(self.environment.mountinfo_path) as watcher:
+            try:
+                if shell:
+                    proc = await asyncio.create_subprocess_shell(command, stdout=PIPE, stderr=PIPE)
+                else:
+                    proc = await asyncio.create_subprocess_exec(*command, stdout=PIPE, stderr=PIPE)
+            except OSError as e:
+                return None, CommandResult(127, '', str(e), False)
+            try:
+                return proc, await self._wait_for_mount(watcher, proc, timeout)
+            except asyncio.CancelledError:
+                _kill_process(proc)
+                # Its ssh child may hold on to the pipes for a bit. Once they're closed, asyncio can let go of them.
+                await asyncio.shield(_communicate(proc, 1))
+                raise
+
+    async def _wait_for_mount(self, watcher, proc, timeout):
+        """Waits (up to `timeout` seconds) for the kernel to register the mount sshfs (`proc`) is making,
+        until sshfs fails or the deadline passes.
+        :return: CommandResult of sshfs if it failed, None if mounted
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        exited = asyncio.ensure_future(proc.wait())
+        changed = None
+        try:
+            while True:
+                table = watcher.read()
+                if table.is_mounted(self.controller.mount_point_local, EnvironmentModel.MOUNT_FSTYPE):
+                    return None
+                if exited.done():
+                    output = await _communicate(proc, 1) or ('', '')
+                    return CommandResult(proc.returncode, output[0], output[1], False)
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        _kill_process(proc)
+                        output = await _communicate(proc, 1) or ('', '')
+                        return CommandResult(proc.returncode, output[0], output[1], True)
+                changed = asyncio.ensure_future(watcher.wait(remaining))
+                await asyncio.wait([changed, exited], return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+        finally:
+            exited.cancel()
+            if changed is not None:
+                changed.cancel()
+
+    async def unmount(self):
+        """Unmounts the system if it's currently mounted (see `SystemControllerModel.unmount()`).
+        :return: boolean - whether it was mounted
+        """
+        self._prepare()
+        unmounted = await self._run_steps(self.controller._unmount_steps())
+        self.controller._finish(timing.OUTCOME_UNMOUNTED if unmounted else timing.OUTCOME_NOT_MOUNTED)
+        return unmounted
+
+    async def status(self):
+        """Tells whether the system is mounted and, if sftpman mounted it, by which sshfs process
+        and how its configuration changed since.
+        :return: SystemStatus
+        """
+        self.environment.invalidate_mount_table()
+        entry = self.environment.get_mount_table().get(self.controller.mount_point_local)
+        if entry is None or entry.fstype != EnvironmentModel.MOUNT_FSTYPE:
+            return SystemStatus(self.system.id, False, None, None, None)
+        record = self.environment.get_mount_record(self.system.id)
+        if record is None:
+            return SystemStatus(self.system.id, True, entry.source, None, None)
+        argv = await asyncio.get_running_loop().run_in_executor(None, self.controller.get_mount_argv)
+        return SystemStatus(self.system.id, True, entry.source, record.pid, diff_argv(record.argv, argv))
+
+
+async def mount_many(controllers, jobs=MOUNT_MANY_JOBS, per_host=MOUNT_MANY_PER_HOST, before_mount_runner=None):
+    """Mounts many systems concurrently (`AsyncSystemController`s, with their own progress callbacks).
+    At most `jobs` systems are mounted at once, and at most `per_host` on the same host
+    (see `sftpman.batch.BatchRunner`). A system that fails to mount doesn't stop the others.
+    With a `before_mount_runner` (see `sftpman.batch.SharedCommandRunner`), identical before-mount commands
+    run once, for the controllers which don't have a runner of their own. It only applies to this call.
+    Cancelling cancels (and cleans up) all mounts still in progress.
+    :return: list of two-tuples (controller, exception or None), in the order controllers were given
+    """
+    if before_mount_runner is None:
+        return await _mount_many(controllers, jobs, per_host)
+    sharing = [controller.controller for controller in controllers if controller.controller.before_mount_runner is None]
+    for controller in sharing:
+        controller.before_mount_runner = before_mount_runner
+    try:
+        return await _mount_many(controllers, jobs, per_host)
+    finally:
+        # The runner keeps its results (failures included), so mounting again later must not reuse it.
+        for controller in sharing:
+            controller.before_mount_runner = None
+
+
+async def _mount_many(controllers, jobs, per_host):
+    jobs_semaphore = asyncio.Semaphore(max(1, int(jobs)))
+    host_semaphores = {}
+
+    async def attempt(controller):
+        async with jobs_semaphore:
+            try:
+                await controller.mount()
+            except Exception as e:
+                return controller, e
+        return controller, None
+
+    async def mount(controller):
+        if per_host is None:
+            return await attempt(controller)
+        host_semaphore = host_semaphores.setdefault(controller.system.host, asyncio.Semaphore(max(1, int(per_host))))
+        # Waiting for a busy host first, so that it doesn't hold up systems on other hosts.
+        async with host_semaphore:
+            return await attempt(controller)
+
+    return list(await asyncio.gather(*[mount(controller) for controller in controllers]))
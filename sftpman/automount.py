@@ -0,0 +1,236 @@
+import os
+import time
+import ctypes
+import select
+import struct
+import threading
+
+from .exception import SftpException
+from .helper import mkdir_p
+from .model import SystemModel, SystemControllerModel
+from .proc import find_busy_paths
+
+
+class Inotify(object):
+    """A minimal wrapper around Linux's inotify (see `inotify(7)`)."""
+
+    IN_ACCESS = 0x00000001
+    IN_OPEN = 0x00000020
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """Starts watching the given path.
+        :return: the watch descriptor (the same one, if the path's already watched)
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self, timeout=None):
+        """Waits (for up to `timeout` seconds) for events.
+        :return: list of two-tuples (watch descriptor, mask)
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(None if timeout is None else timeout * 1000):
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size + name_length
+            events.append((wd, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Automounter(object):
+    """Mounts systems on first access and unmounts them once they're no longer used.
+
+    Unmounted systems get an (empty) placeholder directory at their mount location.
+    Listing it (or opening anything in it) is noticed through inotify and mounts the system.
+    Whatever triggered the mount sees the empty placeholder; the files show up right after.
+
+    Systems nothing has used (no open files, no process working in them) for `idle_timeout` seconds
+    are unmounted, so that only the systems in use hold an SSH connection.
+    """
+
+    #: Unmount systems which haven't been used for this long
+    IDLE_TIMEOUT_SECONDS = 600
+
+    #: How often to look for unused systems (at most)
+    IDLE_CHECK_INTERVAL_SECONDS = 30
+
+    #: After a failed mount, accesses are ignored for this long (so we don't keep retrying)
+    RETRY_DELAY_SECONDS = 10
+
+    def __init__(self, environment, system_ids=None, idle_timeout=IDLE_TIMEOUT_SECONDS, callback=None):
+        self.environment = environment
+        #: Systems to handle. If None, all available systems are handled.
+        self.system_ids = system_ids
+        #: Seconds of not being used before a system is unmounted (None never unmounts)
+        self.idle_timeout = idle_timeout
+        #: Called with (system id, event, message) whenever something happens
+        self.callback = callback
+        self.systems = {}
+        self.inotify = None
+        self._watches = {}
+        self._last_used = {}
+        self._failed_at = {}
+        self._mounting = set()
+        self._lock = threading.Lock()
+
+    def _notify(self, system_id, event, message=None):
+        if self.callback is not None:
+            self.callback(system_id, event, message)
+
+    def load(self):
+        """Loads the systems to handle.
+        :return: list of two-tuples (system id, reason) of systems which can't be handled
+        """
+        skipped = []
+        for system_id, system in self.environment.load_systems(self.system_ids):
+            if isinstance(system, SftpException):
+                skipped.append((system_id, str(system)))
+            elif system.auth_method in SystemModel.AUTH_METHODS_INTERACTIVE:
+                skipped.append((system_id, 'Authentication needs typing a password, which nobody will be there to do.'))
+            else:
+                self.systems[system_id] = system
+        return skipped
+
+    def run_forever(self):
+        self.inotify = Inotify()
+        try:
+            last_idle_check = time.monotonic()
+            while True:
+                self._update_watches()
+                for wd, mask in self.inotify.read(self._get_wait_time()):
+                    self._handle_event(wd, mask)
+                if self.idle_timeout is not None and time.monotonic() - last_idle_check >= self._get_idle_check_interval():
+                    self.unmount_idle()
+                    last_idle_check = time.monotonic()
+        finally:
+            self.inotify.close()
+
+    def _get_idle_check_interval(self):
+        return min(self.IDLE_CHECK_INTERVAL_SECONDS, self.idle_timeout / 4.0)
+
+    def _get_wait_time(self):
+        # Placeholders removed from under us are only noticed when we wake up.
+        if self.idle_timeout is None:
+            return self.IDLE_CHECK_INTERVAL_SECONDS
+        return self._get_idle_check_interval()
+
+    def _update_watches(self):
+        """Makes sure every unmounted system has a (watched) placeholder."""
+        self.environment.invalidate_mount_table()
+        mounted_ids = set(self.environment.get_mounted_ids())
+        with self._lock:
+            mounting = set(self._mounting)
+        for system_id in self.systems:
+            if system_id in mounted_ids or system_id in mounting:
+                continue
+            path = self.environment.get_system_mount_dest(system_id)
+            try:
+                mkdir_p(path)
+                wd = self.inotify.add_watch(path, Inotify.IN_OPEN | Inotify.IN_ACCESS | Inotify.IN_ONLYDIR)
+            except OSError as e:
+                self._notify(system_id, 'error', 'Cannot watch %s: %s' % (path, str(e)))
+                continue
+            self._watches[wd] = system_id
+
+    def _handle_event(self, wd, mask):
+        system_id = self._watches.get(wd)
+        if system_id is None:
+            return
+        if mask & Inotify.IN_IGNORED:
+            # The placeholder is gone (removed by unmounting, or by someone else).
+            del self._watches[wd]
+            return
+        with self._lock:
+            if system_id in self._mounting:
+                return
+            failed_at = self._failed_at.get(system_id)
+            if failed_at is not None and time.monotonic() - failed_at < self.RETRY_DELAY_SECONDS:
+                return
+            self._mounting.add(system_id)
+        # Mounting may take a while, and other systems shouldn't wait for it.
+        thread = threading.Thread(target=self._mount, args=(system_id,))
+        thread.daemon = True
+        thread.start()
+
+    def _mount(self, system_id):
+        controller = SystemControllerModel(self.systems[system_id], self.environment)
+        try:
+            controller.mount()
+        except SftpException as e:
+            with self._lock:
+                self._failed_at[system_id] = time.monotonic()
+            self._notify(system_id, 'error', str(e))
+        else:
+            with self._lock:
+                self._failed_at.pop(system_id, None)
+                self._last_used[system_id] = time.monotonic()
+            self._notify(system_id, 'mounted')
+        finally:
+            with self._lock:
+                self._mounting.discard(system_id)
+
+    def unmount_idle(self):
+        """Unmounts the systems which haven't been used for `idle_timeout` seconds.
+        :return: list of system ids unmounted
+        """
+        self.environment.invalidate_mount_table()
+        with self._lock:
+            mounting = set(self._mounting)
+        mounted_ids = [
+            system_id for system_id in self.environment.get_mounted_ids()
+            if system_id in self.systems and system_id not in mounting
+        ]
+        dests = dict((system_id, self.environment.get_system_mount_dest(system_id)) for system_id in mounted_ids)
+        busy = find_busy_paths(dests.values())
+
+        now = time.monotonic()
+        unmounted = []
+        for system_id in mounted_ids:
+            with self._lock:
+                # Systems which were already mounted when we started count as just used.
+                last_used = self._last_used.setdefault(system_id, now)
+                if dests[system_id] in busy:
+                    self._last_used[system_id] = last_used = now
+            if now - last_used < self.idle_timeout:
+                continue
+            controller = SystemControllerModel(self.systems[system_id], self.environment)
+            try:
+                if not controller.unmount_if_unused():
+                    # Something we can't see (e.g. another user's process) is using it.
+                    continue
+            except SftpException as e:
+                self._notify(system_id, 'error', str(e))
+                continue
+            with self._lock:
+                self._last_used.pop(system_id, None)
+            unmounted.append(system_id)
+            self._notify(system_id, 'unmounted', 'Unused for %d seconds.' % (now - last_used))
+        return unmounted
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .helper import json, atomic_write, mkdir_p, run_command, CommandResult
+
+
+class BatchRunner(object):
+    """Runs a callback over many items concurrently.
+
+    Concurrency is bounded globally (`jobs`) and per group (`per_group`).
+    The per-group limit is what keeps us from opening too many SSH connections
+    to the same host at once (sshd's `MaxStartups` kicks in rather quickly).
+    """
+
+    def __init__(self, jobs=1, per_group=None):
+        self.jobs = max(1, int(jobs))
+        self.per_group = None if per_group is None else max(1, int(per_group))
+
+    def run(self, items, callback, group_by=None):
+        """Calls `callback(item)` for every item.
+
+        :return: list of two-tuples (item, exception or None), in the order items were given
+        """
+        items = list(items)
+        results = [None] * len(items)
+
+        if self.jobs == 1 or len(items) <= 1:
+            for idx, item in enumerate(items):
+                results[idx] = (item, self._call(callback, item))
+            return results
+
+        condition = threading.Condition()
+        running_per_group = {}
+        running = [0]
+
+        def can_start(group):
+            if running[0] >= self.jobs:
+                return False
+            if self.per_group is None:
+                return True
+            return running_per_group.get(group, 0) < self.per_group
+
+        def work(idx, item, group):
+            exc = self._call(callback, item)
+            with condition:
+                results[idx] = (item, exc)
+                running[0] -= 1
+                running_per_group[group] -= 1
+                condition.notify_all()
+
+        pending = [(idx, item, group_by(item) if group_by else None) for idx, item in enumerate(items)]
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            with condition:
+                while len(pending) != 0:
+                    # Start the first item whose group has a free slot.
+                    # Items for a busy group wait, without blocking the ones after them.
+                    for pos, (idx, item, group) in enumerate(pending):
+                        if can_start(group):
+                            del pending[pos]
+                            running[0] += 1
+                            running_per_group[group] = running_per_group.get(group, 0) + 1
+                            executor.submit(work, idx, item, group)
+                            break
+                    else:
+                        condition.wait()
+        return results
+
+    @staticmethod
+    def _call(callback, item):
+        try:
+            callback(item)
+        except Exception as e:
+            return e
+        return None
+
+
+class SharedCommandRunner(object):
+    """Runs shell commands on behalf of many systems, running each distinct command only once.
+
+    Systems mounted together often have the same before-mount command
+    (bringing up a VPN, loading keys into the agent), which gains nothing from running once per system.
+    Whoever asks for a command which is already running waits for it and gets the same result,
+    failures included. Results are kept for as long as the runner is (a batch).
+    With a `cache` (see `CommandCache`), commands which succeeded recently (in any sftpman process) aren't run at all.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._results = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _get_lock(self, command):
+        with self._locks_lock:
+            return self._locks.setdefault(command, threading.Lock())
+
+    def run(self, command):
+        """:return: CommandResult"""
+        with self._get_lock(command):
+            result = self._results.get(command)
+            if result is not None:
+                return result
+            if self.cache is not None and self.cache.is_fresh(command):
+                result = CommandResult(0, '', '', False)
+            else:
+                result = run_command(command, shell=True)
+                if self.cache is not None and result.returncode == 0:
+                    self.cache.record(command)
+            self._results[command] = result
+            return result
+
+
+class CommandCache(object):
+    """Remembers when commands last succeeded (in a file shared by all sftpman processes),
+    so that they don't need to run again for `ttl` seconds.
+    Failures aren't remembered: a command which failed runs again next time.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def is_fresh(self, command):
+        succeeded_at = self._load().get(command)
+        if not isinstance(succeeded_at, (int, float)):
+            return False
+        return 0 <= time.time() - succeeded_at < self.ttl
+
+    def record(self, command):
+        entries = self._load()
+        entries[command] = time.time()
+        try:
+            mkdir_p(os.path.dirname(self.path))
+            atomic_write(self.path, json.dumps(entries), fsync=False)
+        except (IOError, OSError):
+            # It's only a cache.
+            pass
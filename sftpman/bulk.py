@@ -0,0 +1,119 @@
+import os
+
+from .exception import SftpConfigException
+from .helper import json, mkdir_p
+from .model import SystemModel
+
+
+def parse_systems(content):
+    """Parses a document describing many systems.
+
+    The document is either a single JSON array or JSON lines (one object per line).
+    Each object looks like a configuration file (see `SystemModel.export()`).
+    :return: two-tuple (list of two-tuples (location, SystemModel), list of (location, error message))
+    """
+    records = []
+    errors = []
+    stripped = content.strip()
+    if stripped.startswith('['):
+        try:
+            records = [('item %d' % (idx + 1), record) for idx, record in enumerate(json.loads(stripped))]
+        except ValueError as e:
+            return [], [('document', 'Invalid JSON: %s' % e)]
+    else:
+        for idx, line in enumerate(content.split('\n')):
+            if line.strip() == '':
+                continue
+            try:
+                records.append(('line %d' % (idx + 1), json.loads(line)))
+            except ValueError as e:
+                errors.append(('line %d' % (idx + 1), 'Invalid JSON: %s' % e))
+
+    systems = []
+    for location, record in records:
+        if not isinstance(record, dict):
+            errors.append((location, 'Expected an object.'))
+            continue
+        try:
+            systems.append((location, SystemModel(**record)))
+        except (ValueError, TypeError) as e:
+            errors.append((location, 'Bad value: %s' % e))
+    return systems, errors
+
+
+def validate_systems(systems):
+    """Validates all systems, collecting all the problems (not just the first).
+    :param systems: list of two-tuples (location, SystemModel)
+    :return: list of two-tuples (location, error message)
+    """
+    errors = []
+    seen = {}
+    for location, system in systems:
+        is_valid, system_errors = system.validate()
+        for field_name, msg in system_errors:
+            errors.append(('%s (%s)' % (location, system.id), '%s: %s' % (field_name, msg)))
+        if system.id in seen:
+            errors.append(('%s (%s)' % (location, system.id), 'Duplicate id (first seen at %s).' % seen[system.id]))
+        seen.setdefault(system.id, location)
+    return errors
+
+
+def diff_systems(systems, environment):
+    """Compares the given systems with the ones currently configured.
+    :return: list of three-tuples (system_id, change, list of (field, old value, new value)),
+        where change is one of `added`, `changed`, `unchanged`
+    """
+    existing = {}
+    for system_id, system in environment.load_systems([system.id for system in systems]):
+        if not isinstance(system, SftpConfigException):
+            existing[system_id] = system.to_dict()
+
+    out = []
+    for system in systems:
+        new = system.to_dict()
+        old = existing.get(system.id)
+        if old is None:
+            out.append((system.id, 'added', []))
+            continue
+        fields = [(field, old.get(field), new[field]) for field in sorted(new) if old.get(field) != new[field]]
+        out.append((system.id, 'changed' if len(fields) != 0 else 'unchanged', fields))
+    return out
+
+
+def save_systems(systems, environment):
+    """Saves all systems at once.
+
+    Everything gets written to temporary files first, so if anything fails,
+    nothing changes. The files are then renamed into place and the directory is synced once.
+    """
+    config_dir = environment.config_path_mounts
+    mkdir_p(config_dir)
+    pending = []
+    try:
+        for system in systems:
+            path = environment.get_system_config_path(system.id)
+            tmp_path = '%s.tmp-%d' % (path, os.getpid())
+            pending.append((tmp_path, path))
+            with open(tmp_path, 'w') as f:
+                f.write(system.export())
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        for tmp_path, _ in pending:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        raise
+
+    for tmp_path, path in pending:
+        os.replace(tmp_path, path)
+
+    fd = os.open(config_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if environment.use_config_index:
+        environment.config_index.load()
@@ -1,24 +1,74 @@
+import os
 import sys
-import getopt
-import collections.abc
 
-from .exception import SftpException, SftpConfigException, SftpMountException
+from .exception import SftpException, SftpConfigException, SftpMountException, SftpUnreachableException
 from .model import EnvironmentModel, SystemModel, SystemControllerModel
+from .helper import json, format_command
+
+
+BATCH_OPTIONS_USAGE = """    Available batch options:
+        --jobs={number of systems to work on concurrently} [default: 1]
+"""
+
+MOUNT_OPTIONS_USAGE = """    Available mount options:
+        --per-host={max number of concurrent mounts against the same host} [default: 2]
+        --mount-timeout={seconds to wait for a mount to show up} [default: 30]
+            Doesn't apply to systems using password or keyboard-interactive authentication.
+        --skip-unreachable
+            Check (concurrently) which hosts are reachable first, and don't try mounting the others.
+        --share-before-mount
+            Systems with the same before-mount command share a single run of it (and its outcome),
+            instead of running it for each system.
+        --before-mount-ttl={seconds}
+            Don't run a before-mount command which succeeded (for any system) in the last so many seconds.
+            Implies --share-before-mount.
+        --timings
+            Show how long each phase of mounting took (and how many processes it ran), for each system.
+        --json
+            Print the outcome and timings of each system as JSON (one object per line).
+        --timings-log={file}
+            Append the outcome and timings of each system to a JSON lines file.
+        --prometheus-file={file}
+            Write the outcome and timings to a file for the Prometheus node exporter's textfile collector.
+"""
+
+UNMOUNT_OPTIONS_USAGE = """    Available unmount options:
+        --lazy
+            If a filesystem is busy, detach it right away (`fusermount -uz`), before killing sshfs.
+        --kill-timeout={seconds to wait for sshfs to exit before killing it forcefully} [default: 2]
+"""
 
 
 class SftpCli(object):
 
-    def __init__(self):
-        self.environment = EnvironmentModel()
+    #: How many systems batch commands (mount, umount, rm, ..) work on concurrently
+    BATCH_JOBS_DEFAULT = 1
+
+    #: How many concurrent operations batch commands run against the same host
+    BATCH_PER_HOST_DEFAULT = 2
+
+    #: The commands (each one a `command_{name}` method), in the order `help` lists them.
+    #: Keeping them here saves looking through `dir()` on every start.
+    COMMANDS = (
+        'automount', 'bench', 'copy', 'daemon', 'export', 'generate_units', 'help', 'import', 'ls',
+        'mount', 'mount_all', 'preflight_check', 'profiles', 'rm', 'setup', 'status', 'suspend_hook',
+        'umount', 'umount_all', 'warm', 'watchdog',
+    )
+
+    #: Commands which (may) change the available or mounted systems, and so update the completion cache.
+    #: `ls` is there because shell completion falls back to it when the cache is outdated.
+    COMMANDS_UPDATING_COMPLETION = ('import', 'ls', 'mount', 'mount_all', 'rm', 'setup', 'umount', 'umount_all')
+
+    def __init__(self, environment=None, stdout=None, stderr=None):
+        self.environment = environment or EnvironmentModel()
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
 
     def command_help(self, *args, **kwargs):
         """Displays this help menu."""
-        print("Commands available:\n")
-        for name in dir(self):
-            if not name.startswith("command_"):
-                continue
-            name_clean = name[len("command_"):]
-            print("%s:\n - %s\n" % (name_clean, getattr(self, name).__doc__.strip()))
+        print("Commands available:\n", file=self.stdout)
+        for name in self.COMMANDS:
+            print("%s:\n - %s\n" % (name, getattr(self, "command_%s" % name).__doc__.strip()), file=self.stdout)
 
     def command_setup(self, *args):
         """Defines a new sftp file system configuration or edits an old one with the same id.
@@ -42,9 +92,18 @@ class SftpCli(object):
                 Only applies if auth_method is `publickey`.
             --cmd_before_mount={command to run before mounting} [default: /bin/true]
                 Allows you to run a custom command every time this system is mounted.
+            --ssh_multiplexing={yes|no} [default: no]
+                Share a single SSH connection between all systems on the same host (with the same user, auth and ssh options).
+                Mounting another system then skips the SSH handshake and authentication.
+                Needs `$XDG_RUNTIME_DIR` to be set.
+            --performance_profile={profile} [optional]
+                Adds sshfs/ssh options tuned for a kind of workload (see `sftpman profiles`).
+                Mount options given with --mount_opt take precedence over the profile's.
         """
+        import getopt
+
         def usage():
-            print(self.command_setup.__doc__)
+            print(self.command_setup.__doc__, file=self.stdout)
             sys.exit(1)
 
         if len(args) == 0:
@@ -58,11 +117,12 @@ class SftpCli(object):
                 "id", "host", "port", "user",
                 "mount_opt", "mount_point",
                 "ssh_key", "cmd_before_mount",
-                "auth_method",
+                "auth_method", "ssh_multiplexing",
+                "performance_profile",
             ]
             opts, _ = getopt.getopt(args, "", ["%s=" % s for s in fields])
         except getopt.GetoptError as e:
-            sys.stderr.write('Error: %s\n\n' % e)
+            self.stderr.write('Error: %s\n\n' % e)
             usage()
 
         system = SystemModel()
@@ -79,50 +139,271 @@ class SftpCli(object):
 
         is_valid, errors = system.validate()
         if not is_valid:
-            sys.stderr.write('Invalid data found:\n')
+            self.stderr.write('Invalid data found:\n')
             for field_name, msg in errors:
-                sys.stderr.write(' - %s: %s\n' % (field_name, msg))
-            sys.stderr.write('\n')
+                self.stderr.write(' - %s: %s\n' % (field_name, msg))
+            self.stderr.write('\n')
             usage()
             sys.exit(1)
 
         system.save(self.environment)
-        print('Configuration created.')
-        print('You can try mounting now: `sftpman mount %s`' % system.id)
+        print('Configuration created.', file=self.stdout)
+        print('You can try mounting now: `sftpman mount %s`' % system.id, file=self.stdout)
+
+    def command_import(self, *args):
+        """Defines (or edits) many sftp file system configurations at once.
+        Usage: sftpman import [--dry-run] {file}
+        Use `-` as {file} to read from standard input.
+        The file is either a JSON array or JSON lines (one object per line).
+        Each object looks like a configuration file (see `sftpman export`).
+        Nothing is saved unless all systems are valid.
+        Available options:
+            --dry-run
+                Only show what would change.
+        """
+        import getopt
+
+        def usage():
+            print(self.command_import.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, paths = getopt.gnu_getopt(args, "", ["dry-run"])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if len(paths) != 1:
+            usage()
+
+        from . import bulk
+
+        try:
+            if paths[0] == '-':
+                content = sys.stdin.read()
+            else:
+                with open(paths[0]) as f:
+                    content = f.read()
+        except IOError as e:
+            self.stderr.write('Cannot read %s: %s\n' % (paths[0], str(e)))
+            sys.exit(1)
+
+        systems, errors = bulk.parse_systems(content)
+        errors += bulk.validate_systems(systems)
+        if len(errors) != 0:
+            self.stderr.write('Invalid data found:\n')
+            for location, msg in errors:
+                self.stderr.write(' - %s: %s\n' % (location, msg))
+            sys.exit(1)
+
+        systems = [system for _, system in systems]
+        changes = bulk.diff_systems(systems, self.environment)
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+        for system_id, change, fields in changes:
+            counts[change] += 1
+            if change == 'added':
+                print('+ %s' % system_id, file=self.stdout)
+            elif change == 'changed':
+                print('~ %s' % system_id, file=self.stdout)
+                for field, old, new in fields:
+                    print('    %s: %s -> %s' % (field, json.dumps(old), json.dumps(new)), file=self.stdout)
+        summary = '%(added)d added, %(changed)d changed, %(unchanged)d unchanged.' % counts
+
+        if '--dry-run' in dict(opts):
+            print('Dry run: %s Nothing was saved.' % summary, file=self.stdout)
+            return
+
+        bulk.save_systems([system for system, (_, change, _) in zip(systems, changes) if change != 'unchanged'], self.environment)
+        print(summary, file=self.stdout)
+
+    def command_export(self, *system_ids):
+        """Prints sftp file system configurations, in a format `sftpman import` understands (JSON lines).
+        Usage: sftpman export [{id}..] [default: all available systems]
+        """
+        has_failed = False
+        for system_id, system in self.environment.load_systems(system_ids or None):
+            if isinstance(system, SftpConfigException):
+                self.stderr.write('Cannot export %s: %s\n' % (system_id, str(system)))
+                has_failed = True
+                continue
+            print(json.dumps(system.to_dict()), file=self.stdout)
+        if has_failed:
+            sys.exit(1)
+
+    def command_generate_units(self, *args):
+        """Generates systemd units, so that the init system mounts sftp systems (in parallel) and supervises them.
+        Usage: sftpman generate_units [--type=service|mount] [--automount] [--idle-timeout=SECONDS] [--output-dir=DIR] [{id}..] [default: all available systems]
+        Available options:
+            --type={unit type} [default: service]
+                `service` units run sshfs as you, in your service manager (`systemctl --user`).
+                They go to `~/.config/systemd/user/` by default.
+                `mount` units are for the system's service manager, so sshfs runs as root.
+                They go to `/etc/systemd/system/` by default.
+            --automount
+                Only for `--type=mount`. Also generates `automount` units, so that systems are mounted on first access.
+            --idle-timeout={seconds}
+                Only for `--automount`. Unmount systems which haven't been used for this long.
+            --output-dir={directory to write the units to}
+                Use `-` to print them instead.
+        The command before mounting becomes an `ExecStartPre` (or a separate unit, for `--type=mount`).
+        Units need to be generated again after changing a system.
+        """
+        import getopt
+        from . import units
+
+        def usage():
+            print(self.command_generate_units.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, system_ids = getopt.gnu_getopt(args, "", ["type=", "automount", "idle-timeout=", "output-dir="])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        opts = dict(opts)
+        unit_type = opts.get('--type', units.UNIT_TYPE_SERVICE)
+        if unit_type not in units.UNIT_TYPES:
+            self.stderr.write('Error: --type expects one of: %s\n\n' % ', '.join(units.UNIT_TYPES))
+            usage()
+        automount = '--automount' in opts
+        if automount and unit_type != units.UNIT_TYPE_MOUNT:
+            self.stderr.write('Error: --automount only applies to --type=mount\n\n')
+            usage()
+        idle_timeout = None
+        if '--idle-timeout' in opts:
+            if not automount:
+                self.stderr.write('Error: --idle-timeout only applies to --automount\n\n')
+                usage()
+            try:
+                idle_timeout = int(opts['--idle-timeout'])
+            except ValueError:
+                self.stderr.write('Error: --idle-timeout expects a number of seconds\n\n')
+                usage()
+        default_dir = units.USER_UNIT_PATH if unit_type == units.UNIT_TYPE_SERVICE else units.SYSTEM_UNIT_PATH
+        output_dir = opts.get('--output-dir', default_dir)
+
+        generator = units.UnitGenerator(self.environment)
+        has_failed = False
+        generated = []
+        for system_id, system in self.environment.load_systems(system_ids or None):
+            if isinstance(system, SftpConfigException):
+                self.stderr.write('Cannot generate units for %s: %s\n' % (system_id, str(system)))
+                has_failed = True
+                continue
+            generated += generator.generate(system, unit_type, automount, idle_timeout)
 
-    def command_rm(self, system_id, *system_ids):
+        if output_dir == '-':
+            for name, content in generated:
+                print('# %s\n%s' % (name, content), file=self.stdout)
+        else:
+            try:
+                for path in generator.write(generated, output_dir):
+                    print('Wrote %s' % path, file=self.stdout)
+            except (IOError, OSError) as e:
+                self.stderr.write('Cannot write units to %s: %s\n' % (output_dir, str(e)))
+                sys.exit(1)
+            enabled = [name for name, _ in generated if not name.endswith('-before-mount.service')]
+            if automount:
+                enabled = [name for name in enabled if not name.endswith('.mount')]
+            if len(enabled) != 0:
+                systemctl = 'systemctl --user' if unit_type == units.UNIT_TYPE_SERVICE else 'systemctl'
+                print('\nTo start them now and on every boot (or login), run:', file=self.stdout)
+                print('    %s daemon-reload' % systemctl, file=self.stdout)
+                print('    %s enable --now %s' % (systemctl, format_command(enabled)), file=self.stdout)
+        if has_failed:
+            sys.exit(1)
+
+    def command_profiles(self, *system_ids):
+        """Lists the performance profiles, or shows the options systems end up with.
+        Usage: sftpman profiles [{id}..]
+        For each system, this shows the profile's options which are overridden by the system's own
+        and the ones left out, because the installed sshfs doesn't support them.
+        """
+        from .profiles import PROFILES
+
+        if len(system_ids) == 0:
+            for profile in PROFILES.values():
+                print('%s: %s' % (profile.name, profile.description), file=self.stdout)
+                print('    sshfs options: %s' % (' '.join(profile.sshfs_options) or '-'), file=self.stdout)
+                print('    ssh options: %s' % (' '.join(profile.ssh_options) or '-'), file=self.stdout)
+            return
+
+        has_failed = False
+        for system_id, system in self.environment.load_systems(system_ids):
+            if isinstance(system, SftpConfigException):
+                self.stderr.write('Cannot load %s: %s\n' % (system_id, str(system)))
+                has_failed = True
+                continue
+            controller = SystemControllerModel(system, self.environment)
+            merged = controller.get_command_builder().get_profile_options()
+            if merged is None:
+                print('%s: no performance profile' % system_id, file=self.stdout)
+                continue
+            print('%s: %s' % (system_id, system.performance_profile), file=self.stdout)
+            print('    sshfs options: %s' % (' '.join(merged.sshfs_options + system.mount_opts) or '-'), file=self.stdout)
+            print('    ssh options: %s' % (' '.join(merged.ssh_options) or '-'), file=self.stdout)
+            for option, overriding in merged.conflicts:
+                print('    overridden: %s (by %s)' % (option, overriding), file=self.stdout)
+            for option, reason in merged.unsupported:
+                print('    left out: %s (%s)' % (option, reason), file=self.stdout)
+        if has_failed:
+            sys.exit(1)
+
+    def command_rm(self, *args):
         """Removes a system by id.
-        Usage: sftpman rm {system_id}..
+        Usage: sftpman rm [--jobs=N] [--lazy] [--kill-timeout=SECONDS] {system_id}..
         For a list of system ids, see `sftpman ls available`.
         """
-        # Intentionally reading the first system_id separately,
-        # because it's required. The others are optional.
-        # This ensures that we'll generate an error if someone tries to call
-        # this without the required argument.
-        system_ids = (system_id,) + system_ids
+        opts, system_ids = self._parse_batch_args(self.command_rm, args, unmounting=True)
+
+        def remove(controller):
+            controller.unmount()
+            controller.system.delete(self.environment)
+
         has_failed = False
-        for system_id in system_ids:
-            try:
-                system = SystemModel.create_by_id(system_id, self.environment)
-                controller = SystemControllerModel(system, self.environment)
-                controller.unmount()
-                system.delete(self.environment)
-            except SftpException as e:
-                sys.stderr.write('Cannot remove %s: %s\n' % (system_id, str(e)))
+        for system_id, e in self._run_batch(system_ids, remove, opts, group_by_host=False):
+            if isinstance(e, SftpException):
+                self.stderr.write('Cannot remove %s: %s\n' % (system_id, str(e)))
                 has_failed = True
+            elif e is not None:
+                raise e
         if has_failed:
             sys.exit(1)
 
-    def command_preflight_check(self):
+    def command_preflight_check(self, *args):
         """Detects whether we have everything needed to mount sshfs filesystems.
+        Usage: sftpman preflight_check [--hosts]
+        Available options:
+            --hosts
+                Also check (concurrently) whether the SSH server of each system can be reached,
+                showing the time it took to connect to each one.
         """
-        checks_pass, failures = self.environment.perform_preflight_check()
+        if len(args) != 0 and args != ('--hosts',):
+            print(self.command_preflight_check.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        host_results = None
+        if '--hosts' in args:
+            host_results = self.environment.check_hosts()
+            self._print_table(('HOST', 'PORT', 'STATUS', 'LATENCY', 'DETAILS'), [
+                (
+                    result.host,
+                    result.port,
+                    'ok' if result.reachable else 'unreachable',
+                    '-' if result.latency is None else '%.1fms' % (result.latency * 1000),
+                    result.banner if result.reachable else result.error,
+                )
+                for result, _ in host_results
+            ])
+            print('', file=self.stdout)
+
+        checks_pass, failures = self.environment.perform_preflight_check(host_results)
         if checks_pass:
-            print('All checks pass.')
+            print('All checks pass.', file=self.stdout)
         else:
-            sys.stderr.write('Problems encountered:\n')
+            self.stderr.write('Problems encountered:\n')
             for msg in failures:
-                sys.stderr.write(' - %s\n' % msg)
+                self.stderr.write(' - %s\n' % msg)
             sys.exit(1)
 
     def command_ls(self, list_what = 'available'):
@@ -136,97 +417,804 @@ class SftpCli(object):
         else:
             lst = []
         if len(lst) != 0:
-            print(("\n".join(lst)))
+            print(("\n".join(lst)), file=self.stdout)
 
-    def command_mount(self, system_id, *system_ids):
+    def command_status(self, *system_ids):
+        """Shows whether sftp systems are mounted and what is mounted.
+        Usage: sftpman status [{id}..] [default: all available systems]
+        For systems sftpman mounted, it also shows the sshfs process serving them (PID),
+        and whether their configuration changed since (CONFIG), in which case remounting applies it.
+        """
+        available_ids = self.environment.get_available_ids()
+        table = self.environment.get_mount_table()
+        rows = []
+        mounted = {}
+        for system_id in (system_ids or available_ids):
+            entry = table.get(self.environment.get_system_mount_dest(system_id))
+            if system_id not in available_ids:
+                rows.append([system_id, 'unknown', '', '', ''])
+            elif entry is not None and entry.fstype == EnvironmentModel.MOUNT_FSTYPE:
+                rows.append([system_id, 'mounted', entry.source, '', ''])
+                record = self.environment.get_mount_record(system_id)
+                if record is not None:
+                    rows[-1][3] = record.pid
+                    mounted[system_id] = rows[-1]
+            else:
+                rows.append([system_id, 'unmounted', '', '', ''])
+
+        for system_id, system in self.environment.load_systems(list(mounted)):
+            if isinstance(system, SystemModel):
+                drift = SystemControllerModel(system, self.environment).get_config_drift()
+                if drift is not None:
+                    mounted[system_id][4] = 'current' if drift == ([], []) else 'changed'
+        self._print_table(('ID', 'STATE', 'SOURCE', 'PID', 'CONFIG'), rows)
+
+    def command_mount(self, *args):
         """Mounts the specified sftp system, unless it's already mounted.
-        Usage: sftpman mount {id}..
+        Usage: sftpman mount [--jobs=N] [--per-host=N] [--mount-timeout=SECONDS] [--skip-unreachable] [--timings] [--json] {id}..
         """
-        system_ids = (system_id,) + system_ids
-        has_failed = False
-        for system_id in system_ids:
-            try:
-                system = SystemModel.create_by_id(system_id, self.environment)
-                controller = SystemControllerModel(system, self.environment)
-                controller.mount()
-            except SftpConfigException as e:
-                sys.stderr.write('Cannot mount %s: %s\n\n' % (system_id, str(e)))
-                has_failed = True
-            except SftpMountException as e:
-                sys.stderr.write('Cannot mount %s!\n\n' % system_id)
-                sys.stderr.write('Mount command: \n%s\n\n' % e.mount_cmd)
-                sys.stderr.write('Command output: \n%s\n\n' % e.mount_cmd_output)
-                has_failed = True
+        opts, system_ids = self._parse_batch_args(self.command_mount, args, mounting=True)
+        timers = self._create_timers(opts)
+        results = self._run_batch(system_ids, lambda controller: controller.mount(), opts, timers=timers)
+        has_failed = self._report_mount_errors(results)
+        self._report_timings(results, timers, opts)
         if has_failed:
             sys.exit(1)
 
-    def command_umount(self, system_id, *system_ids):
+    def command_suspend_hook(self, *args):
+        """Unmounts all users' sftp systems before the machine goes to sleep (and optionally remounts them afterwards).
+        Usage: sftpman suspend_hook [options] {pre|post}
+        Meant to be run as root, by a sleep hook (see `sleep-scripts/`).
+        `pre` (or `suspend`, `hibernate`) unmounts every sshfs filesystem under the mount location,
+        all at once (lazily), killing whichever sshfs processes don't exit.
+        `post` (or `resume`, `thaw`) remounts what `pre --record` recorded, in the background,
+        as the users who had them mounted.
+        Available options:
+            --deadline={seconds unmounting may take at most} [default: 10]
+            --record
+                Record what gets unmounted, so that `post` remounts it.
+            --state-file={where the record is kept} [default: /run/sftpman/suspended.json]
+        """
+        import getopt
+        from .suspend import SuspendHook
+
+        def usage():
+            print(self.command_suspend_hook.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, args = getopt.gnu_getopt(args, "", ["deadline=", "state-file=", "record"])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if len(args) != 1:
+            usage()
+
+        opts = dict(opts)
+        try:
+            deadline = float(opts.get('--deadline', SuspendHook.DEADLINE_SECONDS))
+        except ValueError:
+            self.stderr.write('Error: --deadline expects a number\n\n')
+            usage()
+        state_path = opts.get('--state-file', SuspendHook.STATE_PATH)
+        hook = SuspendHook(self.environment, deadline, state_path, record='--record' in opts)
+
+        if args[0] in ('pre', 'suspend', 'hibernate'):
+            for mount, outcome in hook.suspend():
+                print('%s (%s): %s' % (mount.system_id, mount.dest, outcome), file=self.stdout)
+        elif args[0] in ('post', 'resume', 'thaw'):
+            for username, system_ids in hook.resume():
+                print('Remounting for %s: %s' % (username, ' '.join(system_ids)), file=self.stdout)
+        else:
+            usage()
+
+    def command_umount(self, *args):
         """Unmounts the specified sftp system.
-        Usage: sftpman umount {id}..
+        Usage: sftpman umount [--jobs=N] [--lazy] [--kill-timeout=SECONDS] {id}..
         """
-        system_ids = (system_id,) + system_ids
-        has_failed = False
-        for system_id in system_ids:
-            try:
-                system = SystemModel.create_by_id(system_id, self.environment)
-                controller = SystemControllerModel(system, self.environment)
-                controller.unmount()
-            except SftpConfigException as e:
-                sys.stderr.write('Cannot unmount %s: %s\n\n' % (system_id, str(e)))
-                has_failed = True
-        if has_failed:
+        opts, system_ids = self._parse_batch_args(self.command_umount, args, unmounting=True)
+        results = self._run_batch(system_ids, lambda controller: controller.unmount(), opts, group_by_host=False)
+        if self._report_unmount_errors(results):
             sys.exit(1)
 
-    def command_mount_all(self):
+    def command_mount_all(self, *args):
         """Mounts all sftp file systems known to sftpman.
-        Usage: sftpman mount_all
+        Usage: sftpman mount_all [--jobs=N] [--per-host=N] [--mount-timeout=SECONDS] [--skip-unreachable] [--timings] [--json]
         """
-        has_failed = False
-        for system_id in self.environment.get_unmounted_ids():
-            try:
-                system = SystemModel.create_by_id(system_id, self.environment)
-                controller = SystemControllerModel(system, self.environment)
-                controller.mount()
-            except SftpConfigException as e:
-                sys.stderr.write('Cannot mount %s: %s\n\n' % (system_id, str(e)))
-                has_failed = True
-            except SftpMountException as e:
-                sys.stderr.write('Cannot mount %s!\n\n' % system_id)
-                sys.stderr.write('Mount command: \n%s\n\n' % e.mount_cmd)
-                sys.stderr.write('Command output: \n%s\n\n' % e.mount_cmd_output)
+        opts, _ = self._parse_batch_args(self.command_mount_all, args, requires_ids=False, mounting=True)
+        system_ids = self.environment.get_unmounted_ids()
+        timers = self._create_timers(opts)
+        results = self._run_batch(system_ids, lambda controller: controller.mount(), opts, timers=timers)
+        # Mount failures are reported, but (unlike config errors) don't affect the exit code.
+        has_failed = self._report_mount_errors(results, mount_errors_fail=False)
+        self._report_timings(results, timers, opts)
         sys.exit(0 if not has_failed else 1)
 
-    def command_umount_all(self):
+    def command_umount_all(self, *args):
         """Unmounts all sftp file systems known to sftpman.
-        Usage: sftpman umount_all
+        Usage: sftpman umount_all [--jobs=N] [--lazy] [--kill-timeout=SECONDS]
         """
-        has_failed = False
-        for system_id in self.environment.get_mounted_ids():
+        opts, _ = self._parse_batch_args(self.command_umount_all, args, requires_ids=False, unmounting=True)
+        system_ids = self.environment.get_mounted_ids()
+        results = self._run_batch(system_ids, lambda controller: controller.unmount(), opts, group_by_host=False)
+        has_failed = self._report_unmount_errors(results)
+        sys.exit(0 if not has_failed else 1)
+
+    def command_automount(self, *args):
+        """Mounts sftp systems on first access and unmounts them once they're no longer used.
+        Usage: sftpman automount [--idle-timeout=SECONDS] [{id}..] [default: all available systems]
+        Available options:
+            --idle-timeout={seconds} [default: 600]
+                Unmount systems nothing has used (no open files, no process working in them) for this long.
+                Use 0 to never unmount them.
+        Keeps running. Each unmounted system gets an empty directory at its mount location.
+        Listing it (or opening something in it) mounts the system: the files show up right after.
+        Systems using password or keyboard-interactive authentication are skipped.
+        """
+        import getopt
+        from .automount import Automounter
+
+        def usage():
+            print(self.command_automount.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, system_ids = getopt.gnu_getopt(args, "", ["idle-timeout="])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        opts = dict(opts)
+        try:
+            idle_timeout = float(opts.get('--idle-timeout', Automounter.IDLE_TIMEOUT_SECONDS))
+        except ValueError:
+            self.stderr.write('Error: --idle-timeout expects a number\n\n')
+            usage()
+
+        def report(system_id, event, message):
+            if message is None:
+                print('%s: %s' % (system_id, event), file=self.stdout)
+            else:
+                print('%s: %s (%s)' % (system_id, event, message), file=self.stdout)
+            self.stdout.flush()
+
+        automounter = Automounter(self.environment, system_ids or None, idle_timeout or None, report)
+        for system_id, reason in automounter.load():
+            self.stderr.write('Skipping %s: %s\n' % (system_id, reason))
+
+        try:
+            automounter.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+    def command_bench(self, *args):
+        """Measures how fast a mounted sftp system is.
+        Usage: sftpman bench [options] {id}
+        Available options:
+            --tests={comma-separated tests} [default: seq-write,seq-read,random-read,metadata]
+            --size={size of each test file, in MiB} [default: 64]
+            --block-size={size of sequential reads and writes, in KiB} [default: 1024]
+            --jobs={number of files to work on in parallel} [default: 1]
+            --files={number of files for the metadata tests} [default: 200]
+            --duration={seconds to spend on random (4K) reads} [default: 5]
+            --dir={directory (relative to the mount point) to work in} [default: the mount point]
+            --json
+                Print the results (along with the system's options) as a JSON object.
+        Files are created in a scratch directory, which is removed afterwards.
+        Results are comparable across systems and options, as long as the same options are used.
+        """
+        import getopt
+        from . import fsbench
+
+        def usage():
+            print(self.command_bench.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, system_ids = getopt.gnu_getopt(args, "", [
+                "tests=", "size=", "block-size=", "jobs=", "files=", "duration=", "dir=", "json",
+            ])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if len(system_ids) != 1:
+            usage()
+
+        opts = dict(opts)
+        tests = opts.get('--tests', ','.join(fsbench.TESTS)).split(',')
+        for test in tests:
+            if test not in fsbench.TESTS:
+                self.stderr.write('Error: unknown test `%s` (can be: %s)\n\n' % (test, ', '.join(fsbench.TESTS)))
+                usage()
+        try:
+            parameters = {
+                'jobs': int(opts.get('--jobs', 1)),
+                'file_size': int(float(opts.get('--size', 64)) * fsbench.MB),
+                'block_size': int(float(opts.get('--block-size', 1024)) * 1024),
+                'files': int(opts.get('--files', 200)),
+                'duration': float(opts.get('--duration', 5)),
+            }
+        except ValueError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        system_id = system_ids[0]
+        try:
+            system = SystemModel.create_by_id(system_id, self.environment)
+        except SftpConfigException as e:
+            self.stderr.write('Cannot load %s: %s\n' % (system_id, str(e)))
+            sys.exit(1)
+        controller = SystemControllerModel(system, self.environment)
+        if not controller.mounted:
+            self.stderr.write('%s is not mounted. Mount it first: `sftpman mount %s`\n' % (system_id, system_id))
+            sys.exit(1)
+
+        mount_point = controller.mount_point_local
+        path = os.path.normpath(os.path.join(mount_point, opts.get('--dir', '').lstrip('/')))
+        if path != mount_point and not path.startswith(mount_point + '/'):
+            # The scratch directory gets written to and removed, and it's the mount we're measuring.
+            self.stderr.write('Error: %s is outside of the mount point of %s\n' % (opts['--dir'], system_id))
+            sys.exit(1)
+        benchmark = fsbench.FilesystemBenchmark(path, **parameters)
+        try:
+            results = benchmark.run(tests)
+        except (IOError, OSError) as e:
+            self.stderr.write('Benchmarking %s failed: %s\n' % (system_id, str(e)))
+            sys.exit(1)
+
+        if '--json' in opts:
+            print(json.dumps({
+                'system': system_id,
+                'performanceProfile': system.performance_profile,
+                'mountCommand': controller.get_mount_argv(),
+                'parameters': parameters,
+                'results': dict((result.name, {
+                    'value': round(result.value, 3),
+                    'unit': result.unit,
+                    'operations': result.operations,
+                    'seconds': round(result.seconds, 6),
+                }) for result in results),
+            }, sort_keys=True), file=self.stdout)
+            return
+
+        def format_done(result):
+            if result.unit == 'MiB/s':
+                return '%.1f MiB' % (result.operations / float(fsbench.MB))
+            return '%d ops' % result.operations
+
+        self._print_table(('TEST', 'RESULT', 'DONE', 'TIME'), [
+            (result.name, '%.1f %s' % (result.value, result.unit), format_done(result), '%.3fs' % result.seconds)
+            for result in results
+        ])
+
+    def command_warm(self, *args):
+        """Crawls (part of) a mounted sftp system, so that whatever uses it next finds warm caches.
+        Usage: sftpman warm [options] {id} [{path}] [default: the mount point]
+        Available options:
+            --depth={levels of subdirectories to descend into} [default: no limit]
+            --jobs={number of directories and files to work on in parallel} [default: 8]
+            --read-max-size={read files up to this size, in KiB} [default: don't read files]
+                Reading files fills the page cache, which only lasts for systems mounted with `kernel_cache`.
+            --json
+                Print what was done (and how long it took) as a JSON object.
+        Lists every directory and stats every entry, which fills sshfs's attribute and directory caches.
+        The path is relative to the mount point. Symlinks aren't followed.
+        """
+        import getopt
+        from .warm import DirectoryWarmer
+
+        def usage():
+            print(self.command_warm.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, args = getopt.gnu_getopt(args, "", ["depth=", "jobs=", "read-max-size=", "json"])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if len(args) not in (1, 2):
+            usage()
+
+        opts = dict(opts)
+        try:
+            depth = int(opts['--depth']) if '--depth' in opts else None
+            jobs = int(opts.get('--jobs', 8))
+            read_max_size = int(float(opts['--read-max-size']) * 1024) if '--read-max-size' in opts else None
+        except ValueError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        system_id = args[0]
+        try:
+            system = SystemModel.create_by_id(system_id, self.environment)
+        except SftpConfigException as e:
+            self.stderr.write('Cannot load %s: %s\n' % (system_id, str(e)))
+            sys.exit(1)
+        controller = SystemControllerModel(system, self.environment)
+        if not controller.mounted:
+            self.stderr.write('%s is not mounted. Mount it first: `sftpman mount %s`\n' % (system_id, system_id))
+            sys.exit(1)
+
+        mount_point = controller.mount_point_local
+        path = os.path.normpath(os.path.join(mount_point, args[1].lstrip('/') if len(args) == 2 else ''))
+        if path != mount_point and not path.startswith(mount_point + '/'):
+            self.stderr.write('Error: %s is outside of the mount point of %s\n' % (args[1], system_id))
+            sys.exit(1)
+
+        def report_progress(stats):
+            self.stderr.write('\r%d directories, %d files, %.1f MiB read (%.0fs)' % (
+                stats.directories, stats.files, stats.bytes_read / 1048576.0, stats.seconds,
+            ))
+            self.stderr.flush()
+
+        show_progress = '--json' not in opts and self.stderr.isatty()
+        warmer = DirectoryWarmer(path, depth, jobs, read_max_size, report_progress if show_progress else None)
+        stats = warmer.run()
+        if show_progress:
+            self.stderr.write('\n')
+
+        for error_path, message in stats.errors:
+            self.stderr.write('Cannot warm %s: %s\n' % (error_path, message))
+
+        if '--json' in opts:
+            report = stats.to_dict()
+            report['system'] = system_id
+            report['path'] = path
+            print(json.dumps(report, sort_keys=True), file=self.stdout)
+        else:
+            print('Warmed %s: %d directories, %d files (%d read, %.1f MiB) in %.3fs' % (
+                path, stats.directories, stats.files, stats.files_read, stats.bytes_read / 1048576.0, stats.seconds,
+            ), file=self.stdout)
+        if stats.directories == 0:
+            sys.exit(1)
+
+    def command_copy(self, *args):
+        """Copies files between the local machine and an sftp system, without going through the mount.
+        Usage: sftpman copy [options] {source} {destination}
+        One of them is local, the other one is `{id}:{path}` (relative to the system's mount point).
+        The destination becomes a copy of the source (which can be a file or a directory).
+        Available options:
+            --jobs={number of concurrent ssh sessions} [default: 4]
+            --chunk-size={size of the pieces large files are split into, in MiB} [default: 64]
+            --json
+                Print what was done (and how long it took) as a JSON object.
+        Small files are sent in batches and large ones in chunks, all of it in parallel.
+        Files which are already there (same size and modification time) are skipped,
+        so an interrupted copy continues where it left off when run again.
+        Systems using ssh multiplexing share a single connection (and authentication) for all sessions.
+        The system's host needs a shell with GNU find, tar and dd, and for uploads also xargs, mkdir, truncate,
+        GNU touch, mv and rm (checked for before copying anything). Symlinks are skipped.
+        """
+        import getopt
+        import posixpath
+        from .transfer import RemoteShell, TreeCopier
+
+        def usage():
+            print(self.command_copy.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, args = getopt.gnu_getopt(args, "", ["jobs=", "chunk-size=", "json"])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if len(args) != 2:
+            usage()
+
+        opts = dict(opts)
+        try:
+            jobs = int(opts.get('--jobs', 4))
+            chunk_size = int(float(opts.get('--chunk-size', 64)))
+        except ValueError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+        if chunk_size < 1:
+            self.stderr.write('Error: --chunk-size should be at least 1 (MiB)\n\n')
+            usage()
+
+        available_ids = self.environment.get_available_ids()
+
+        def parse_remote(arg):
+            system_id, separator, path = arg.partition(':')
+            if separator == '' or system_id not in available_ids:
+                return None
+            return system_id, path
+
+        source, dest = parse_remote(args[0]), parse_remote(args[1])
+        if (source is None) == (dest is None):
+            self.stderr.write('Error: either the source or the destination (not both) should be `{id}:{path}`\n\n')
+            usage()
+        system_id, path = source or dest
+
+        try:
+            system = SystemModel.create_by_id(system_id, self.environment)
+        except SftpConfigException as e:
+            self.stderr.write('Cannot load %s: %s\n' % (system_id, str(e)))
+            sys.exit(1)
+        controller = SystemControllerModel(system, self.environment)
+        if system.auth_method in SystemModel.AUTH_METHODS_INTERACTIVE and not controller.multiplexed:
+            # Each session would ask for the password.
+            self.stderr.write('%s needs ssh multiplexing to be copied to or from, as it uses %s authentication\n' % (
+                system_id, system.auth_method,
+            ))
+            sys.exit(1)
+        remote_path = posixpath.normpath(posixpath.join(system.mount_point, path.lstrip('/')))
+
+        started_master = False
+        if controller.multiplexed:
+            control_masters = self.environment.control_masters
+            started_master = not control_masters.is_running(system)
+            if not control_masters.ensure_master(controller):
+                self.stderr.write('Cannot connect to %s\n' % system_id)
+                sys.exit(1)
+
+        def report_progress(stats):
+            self.stderr.write('\r%d/%d files, %.1f MiB' % (
+                stats.files_copied + stats.files_skipped, stats.files, stats.bytes_copied / 1048576.0,
+            ))
+            self.stderr.flush()
+
+        show_progress = '--json' not in opts and self.stderr.isatty()
+        shell = RemoteShell(controller.get_ssh_argv(), '%s@%s' % (system.user, system.host))
+        copier = TreeCopier(shell, jobs, chunk_size * TreeCopier.BLOCK_SIZE, report_progress if show_progress else None)
+        try:
+            if source is not None:
+                stats = copier.download(remote_path, args[1])
+            else:
+                stats = copier.upload(args[0], remote_path)
+        except SftpException as e:
+            self.stderr.write('Copying failed: %s\n' % str(e))
+            sys.exit(1)
+        finally:
+            if started_master:
+                self.environment.invalidate_mount_table()
+                if not controller.mounted:
+                    controller.release_control_master()
+        if show_progress:
+            self.stderr.write('\n')
+
+        for error_path, message in stats.errors:
+            self.stderr.write('Cannot copy %s: %s\n' % (error_path, message))
+
+        if '--json' in opts:
+            report = stats.to_dict()
+            report['system'] = system_id
+            print(json.dumps(report, sort_keys=True), file=self.stdout)
+        else:
+            print('Copied %d files (%.1f MiB), skipped %d (already there) in %.3fs' % (
+                stats.files_copied, stats.bytes_copied / 1048576.0, stats.files_skipped, stats.seconds,
+            ), file=self.stdout)
+        if len(stats.errors) != 0:
+            sys.exit(1)
+
+    def command_daemon(self):
+        """Keeps running, serving `ls` and `status` to other sftpman invocations.
+        Usage: sftpman daemon
+        While the daemon runs, these commands start faster and don't need to re-read everything.
+        It listens on a socket in `$XDG_RUNTIME_DIR/sftpman/`.
+        Mounting and unmounting always happen in-process, with the caller's environment (ssh agent, display).
+        Set `SFTPMAN_NO_DAEMON=1` to bypass the daemon.
+        """
+        import signal
+        from .client import get_socket_path
+        from .daemon import SftpDaemon, DaemonEnvironmentModel
+
+        socket_path = get_socket_path()
+        if socket_path is None:
+            self.stderr.write('Cannot start the daemon: $XDG_RUNTIME_DIR is not set.\n')
+            sys.exit(1)
+
+        # Make sure we clean up after ourselves when asked to stop.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        daemon = SftpDaemon(DaemonEnvironmentModel(), socket_path)
+        try:
+            daemon.serve_forever()
+        except SftpException as e:
+            self.stderr.write('Cannot start the daemon: %s\n' % str(e))
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+
+    def command_watchdog(self, *args):
+        """Watches mounted systems and remounts the ones that stop responding.
+        Usage: sftpman watchdog [--interval=SECONDS] [--once] [--no-remount] [{id}..] [default: all mounted systems]
+        Available options:
+            --interval={seconds between checks} [default: 30]
+            --once
+                Check once and print the health and probe latency of each system.
+            --no-remount
+                Only report stale systems, without remounting them.
+        A system is `slow` if checking it takes more than 1 second and `stale` if it takes more than 5.
+        Failed remounts are retried after 5 seconds, doubling the delay up to 5 minutes.
+        """
+        import getopt
+        from .watchdog import Watchdog
+
+        def usage():
+            print(self.command_watchdog.__doc__, file=self.stdout)
+            sys.exit(1)
+
+        try:
+            opts, system_ids = getopt.gnu_getopt(args, "", ["interval=", "once", "no-remount"])
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        opts = dict(opts)
+        try:
+            interval = float(opts.get('--interval', 30))
+        except ValueError:
+            self.stderr.write('Error: --interval expects a number\n\n')
+            usage()
+
+        watchdog = Watchdog(self.environment, system_ids or None, remount='--no-remount' not in opts)
+
+        def format_latency(result):
+            return '%.3fs' % result.latency
+
+        if '--once' in opts:
+            results = watchdog.check()
+            self._print_table(('ID', 'HEALTH', 'LATENCY'), [
+                (result.system_id, result.health, format_latency(result)) for result in results
+            ])
+            return
+
+        previous = {}
+
+        def report(results):
+            for result in results:
+                if previous.get(result.system_id) != result.health:
+                    print('%s: %s (%s)' % (result.system_id, result.health, format_latency(result)), file=self.stdout)
+                previous[result.system_id] = result.health
+            self.stdout.flush()
+
+        try:
+            watchdog.run_forever(interval, report)
+        except KeyboardInterrupt:
+            pass
+
+    def _parse_batch_args(self, command, args, requires_ids=True, mounting=False, unmounting=False):
+        """Separates the batch options from the system ids.
+        :return: two-tuple (dict options, list system ids)
+        """
+        import getopt
+
+        def usage():
+            print(command.__doc__, file=self.stdout)
+            print(BATCH_OPTIONS_USAGE, file=self.stdout)
+            if mounting:
+                print(MOUNT_OPTIONS_USAGE, file=self.stdout)
+            if unmounting:
+                print(UNMOUNT_OPTIONS_USAGE, file=self.stdout)
+            sys.exit(1)
+
+        long_opts = ["jobs="]
+        if mounting:
+            # Unmounting doesn't connect, so it isn't limited per host.
+            long_opts += [
+                "per-host=", "mount-timeout=", "skip-unreachable", "timings", "json", "timings-log=", "prometheus-file=",
+                "share-before-mount", "before-mount-ttl=",
+            ]
+        if unmounting:
+            long_opts += ["lazy", "kill-timeout="]
+
+        try:
+            opts, system_ids = getopt.gnu_getopt(args, "", long_opts)
+        except getopt.GetoptError as e:
+            self.stderr.write('Error: %s\n\n' % e)
+            usage()
+
+        options = {
+            'jobs': self.BATCH_JOBS_DEFAULT,
+            'per_host': self.BATCH_PER_HOST_DEFAULT,
+            'lazy': False,
+            'skip_unreachable': False,
+            'kill_timeout': SystemControllerModel.KILL_WAIT_TIME_SECONDS,
+            'mount_timeout': SystemControllerModel.MOUNT_WAIT_TIME_SECONDS,
+            'timings': False,
+            'json': False,
+            'timings_log': None,
+            'prometheus_file': None,
+            'before_mount_ttl': None,
+            'share_before_mount': False,
+        }
+        for name, value in opts:
+            name = name.lstrip('-').replace('-', '_')
+            if name in ('lazy', 'skip_unreachable', 'timings', 'json', 'share_before_mount'):
+                options[name] = True
+                continue
+            if name in ('timings_log', 'prometheus_file'):
+                options[name] = value
+                continue
             try:
-                system = SystemModel.create_by_id(system_id, self.environment)
-                controller = SystemControllerModel(system, self.environment)
-                controller.unmount()
-            except SftpConfigException as e:
-                sys.stderr.write('Cannot unmount %s: %s\n\n' % (system_id, str(e)))
+                options[name] = float(value) if name.endswith(('_timeout', '_ttl')) else int(value)
+            except ValueError:
+                self.stderr.write('Error: --%s expects a number\n\n' % name.replace('_', '-'))
+                usage()
+
+        if requires_ids and len(system_ids) == 0:
+            usage()
+
+        return options, system_ids
+
+    def _run_batch(self, system_ids, callback, opts, group_by_host=True, timers=None):
+        """Calls `callback(controller)` for each of the given systems,
+        working on several of them concurrently, if requested.
+        Unless `group_by_host` is disabled (it only matters when connecting),
+        the per-host limit applies to systems on the same host.
+        If a `timers` dict is given, each controller gets a timer, which is put there (by system id).
+        :return: list of two-tuples (system_id, exception or None), in the order of `system_ids`
+        """
+        from .batch import BatchRunner, SharedCommandRunner, CommandCache
+        from . import reachability, timing
+
+        before_mount_runner = None
+        if opts['share_before_mount'] or opts['before_mount_ttl']:
+            cache = None
+            if opts['before_mount_ttl'] and self.environment.before_mount_cache_path is not None:
+                cache = CommandCache(self.environment.before_mount_cache_path, opts['before_mount_ttl'])
+            before_mount_runner = SharedCommandRunner(cache)
+
+        results = [None] * len(system_ids)
+        controllers = []
+        for idx, (system_id, system) in enumerate(self.environment.load_systems(system_ids)):
+            if isinstance(system, SftpConfigException):
+                results[idx] = system
+                continue
+            controller = SystemControllerModel(system, self.environment)
+            controller.stderr = self.stderr
+            controller.kill_wait_time = opts['kill_timeout']
+            controller.mount_wait_time = opts['mount_timeout']
+            controller.before_mount_runner = before_mount_runner
+            if opts['lazy']:
+                controller.unmount_strategy = SystemControllerModel.UNMOUNT_STRATEGY_LAZY
+            if timers is not None:
+                controller.timer = timers[system_id] = timing.PhaseTimer(system_id)
+            controllers.append((idx, controller))
+
+        if opts['skip_unreachable']:
+            endpoints = [(controller.system.host, controller.system.port) for _, controller in controllers]
+            unreachable = dict(
+                ((result.host, result.port), result)
+                for result in reachability.probe_hosts(endpoints)
+                if not result.reachable
+            )
+            reachable = []
+            for idx, controller in controllers:
+                result = unreachable.get((controller.system.host, controller.system.port))
+                if result is None:
+                    reachable.append((idx, controller))
+                else:
+                    results[idx] = SftpUnreachableException(result)
+            controllers = reachable
+
+        runner = BatchRunner(jobs=opts['jobs'], per_group=opts['per_host'] if group_by_host else None)
+        group_by = (lambda c: c.system.host) if group_by_host else None
+        outcomes = runner.run([controller for _, controller in controllers], callback, group_by=group_by)
+        for (idx, _), (_, e) in zip(controllers, outcomes):
+            results[idx] = e
+        return list(zip(system_ids, results))
+
+    def _create_timers(self, opts):
+        """Returns a dict to collect timings in, if any timing output was requested (None otherwise)."""
+        if opts['timings'] or opts['json'] or opts['timings_log'] or opts['prometheus_file']:
+            return {}
+        return None
+
+    def _report_timings(self, results, timers, opts):
+        """Outputs the timings collected by `_run_batch()`, in all the ways requested."""
+        from . import timing
+
+        if timers is None:
+            return
+        report = []
+        for system_id, e in results:
+            timer = timers.get(system_id)
+            if timer is None or timer.outcome is None:
+                # Never got to mounting.
+                timer = timing.PhaseTimer(system_id)
+                if isinstance(e, SftpUnreachableException):
+                    timer.finish(timing.OUTCOME_UNREACHABLE, e)
+                elif isinstance(e, SftpConfigException):
+                    timer.finish(timing.OUTCOME_CONFIG_ERROR, e)
+                else:
+                    timer.finish(timing.OUTCOME_FAILED, e)
+            report.append(timer)
+
+        if opts['json']:
+            for timer in report:
+                print(json.dumps(timer.to_dict()), file=self.stdout)
+
+        if opts['timings']:
+            def format_duration(duration):
+                return '-' if duration is None else '%.3f' % duration
+
+            phases = [name for name in timing.MOUNT_PHASES if any(name in timer.get_phase_names() for timer in report)]
+            self._print_table(
+                ('ID', 'OUTCOME', 'TOTAL') + tuple(name.upper() for name in phases) + ('PROCESSES',),
+                [
+                    (timer.system_id, timer.outcome, format_duration(timer.duration)) +
+                    tuple(format_duration(timer.get_phase_duration(name)) for name in phases) +
+                    (timer.subprocesses,)
+                    for timer in report
+                ]
+            )
+
+        for option, write in (('timings_log', timing.append_jsonl), ('prometheus_file', timing.write_prometheus)):
+            if opts[option] is None:
+                continue
+            try:
+                write(report, opts[option])
+            except (IOError, OSError) as e:
+                self.stderr.write('Cannot write timings to %s: %s\n' % (opts[option], str(e)))
+
+    def _print_table(self, header, rows):
+        """Prints rows of values as left-aligned columns."""
+        rows = [header] + [tuple(str(value) for value in row) for row in rows]
+        widths = [max(len(row[idx]) for row in rows) for idx in range(len(header))]
+        for row in rows:
+            line = '  '.join(value.ljust(width) for value, width in zip(row, widths))
+            print(line.rstrip(), file=self.stdout)
+
+    def _report_mount_errors(self, results, mount_errors_fail=True):
+        """Writes mount errors to stderr. Returns whether there was a failure."""
+        has_failed = False
+        for system_id, e in results:
+            if e is None:
+                continue
+            if isinstance(e, SftpMountException):
+                self.stderr.write('Cannot mount %s!\n\n' % system_id)
+                self.stderr.write('Mount command: \n%s\n\n' % e.mount_cmd)
+                self.stderr.write('Command output: \n%s\n\n' % e.mount_cmd_output)
+                has_failed = has_failed or mount_errors_fail
+            elif isinstance(e, SftpUnreachableException):
+                self.stderr.write('Skipping %s: %s\n\n' % (system_id, str(e)))
+                has_failed = has_failed or mount_errors_fail
+            elif isinstance(e, SftpConfigException):
+                self.stderr.write('Cannot mount %s: %s\n\n' % (system_id, str(e)))
                 has_failed = True
-        sys.exit(0 if not has_failed else 1)
+            else:
+                raise e
+        return has_failed
 
+    def _report_unmount_errors(self, results):
+        """Writes unmount errors to stderr. Returns whether there was a failure."""
+        has_failed = False
+        for system_id, e in results:
+            if e is None:
+                continue
+            if isinstance(e, SftpConfigException):
+                self.stderr.write('Cannot unmount %s: %s\n\n' % (system_id, str(e)))
+                has_failed = True
+            else:
+                raise e
+        return has_failed
 
-def start():
+
+def dispatch(instance, argv):
+    """Runs the command described by `argv` (without the executable name) on the given SftpCli."""
     try:
-        command = sys.argv[1]
+        command = argv[0]
     except IndexError:
         command = 'help'
-    if '--help' in sys.argv:
+    if '--help' in argv:
         command = 'help'
-    args = sys.argv[2:]
+    args = argv[1:]
 
-    instance = SftpCli()
-    callback = getattr(instance, "command_%s" % command, None)
-    if isinstance(callback, collections.abc.Callable):
-        try:
-            callback(*args)
-        except TypeError as e:
-            sys.stderr.write('Bad call for %s: %s' % (command, str(e)))
-    else:
+    # `generate-units` works just as well as `generate_units`.
+    command = command.replace('-', '_')
+    if command not in instance.COMMANDS:
         instance.command_help()
+        return
+    try:
+        getattr(instance, "command_%s" % command)(*args)
+    except TypeError as e:
+        instance.stderr.write('Bad call for %s: %s' % (command, str(e)))
+    finally:
+        if command in instance.COMMANDS_UPDATING_COMPLETION:
+            instance.environment.update_completion_cache()
+
+
+def start():
+    dispatch(SftpCli(), sys.argv[1:])
@@ -0,0 +1,89 @@
+"""A thin client for the sftpman daemon (see `sftpman daemon`).
+
+This module is imported on every `sftpman` invocation, before anything else,
+so it needs to stay small and only depend on the standard library.
+Only what's needed to find out whether a daemon is running gets imported up front.
+"""
+
+import os
+import sys
+
+
+#: Commands which the daemon knows how to handle.
+#: Mounting and unmounting run commands (ssh, the before-mount command), which need the caller's
+#: environment (ssh agent, display, `PATH`), so they're never handed to the daemon.
+DAEMON_COMMANDS = ('ls', 'status')
+
+#: How long to wait for the daemon to accept the connection
+CONNECT_TIMEOUT = 0.5
+
+
+def get_socket_path():
+    """Returns the path to the daemon's socket, or None if there can't be one.
+    This mirrors `EnvironmentModel.runtime_path_base`.
+    """
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        return None
+    return os.path.join(runtime_dir, 'sftpman', 'daemon.sock')
+
+
+def call(argv, socket_path=None):
+    """Asks the daemon to run a command.
+    Once the daemon has the request, it may have (partly) run the command already,
+    so not getting a response back is an error (rather than a reason to run it in-process).
+    :return: dict response (exit_code, stdout, stderr, fallback) or None, if the daemon is not reachable
+    """
+    socket_path = socket_path or get_socket_path()
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sent = False
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(socket_path)
+        # Commands (mounting especially) may take a while.
+        sock.settimeout(None)
+        sock.sendall(json.dumps({'argv': list(argv)}).encode('utf-8') + b'\n')
+        sent = True
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            raise ValueError('the connection got closed')
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except (OSError, ValueError) as e:
+        if not sent:
+            return None
+        return {
+            'exit_code': 1,
+            'stdout': '',
+            'stderr': 'Error: the sftpman daemon did not respond properly (%s)\n' % e,
+        }
+    finally:
+        sock.close()
+
+
+def run(argv):
+    """Runs the command through the daemon, if possible.
+    :return: integer exit code, or None if the command needs to be run in-process
+    """
+    if os.getenv('SFTPMAN_NO_DAEMON'):
+        return None
+    if len(argv) == 0 or argv[0] not in DAEMON_COMMANDS or '--help' in argv:
+        return None
+
+    response = call(argv)
+    if response is None or response.get('fallback'):
+        return None
+    sys.stdout.write(response.get('stdout', ''))
+    sys.stderr.write(response.get('stderr', ''))
+    return response.get('exit_code', 1)
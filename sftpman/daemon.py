@@ -0,0 +1,149 @@
+import io
+import os
+import json
+import socket
+import threading
+import traceback
+
+from .cli import SftpCli, dispatch
+from .client import DAEMON_COMMANDS
+from .exception import SftpException
+from .helper import mkdir_p
+from .model import EnvironmentModel
+from .proc import MountWatcher
+
+
+class DaemonEnvironmentModel(EnvironmentModel):
+    """An environment which keeps the list of available systems in memory,
+    re-reading it only when the configuration directory changes.
+    """
+
+    def __init__(self):
+        super(DaemonEnvironmentModel, self).__init__()
+        self._available_ids = []
+        self._available_ids_mtime = None
+        self._available_ids_lock = threading.Lock()
+
+    def get_available_ids(self):
+        try:
+            mtime = os.stat(self.config_path_mounts).st_mtime_ns
+        except OSError:
+            return []
+        with self._available_ids_lock:
+            if mtime != self._available_ids_mtime:
+                self._available_ids = super(DaemonEnvironmentModel, self).get_available_ids()
+                self._available_ids_mtime = mtime
+            return list(self._available_ids)
+
+
+class SftpDaemon(object):
+    """Serves sftpman commands over a Unix socket, keeping state in memory between them.
+
+    Requests and responses are JSON documents, one per connection:
+    - request: `{"argv": ["ls", "mounted"]}`
+    - response: `{"exit_code": 0, "stdout": "..", "stderr": ".."}` or `{"fallback": true}`,
+    when the client should run the command by itself.
+    """
+
+    def __init__(self, environment, socket_path):
+        self.environment = environment
+        self.socket_path = socket_path
+        self._sock = None
+
+    def serve_forever(self):
+        self._bind()
+        watcher = threading.Thread(target=self._watch_mounts)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            while True:
+                conn, _ = self._sock.accept()
+                handler = threading.Thread(target=self._handle, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _bind(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        mkdir_p(socket_dir)
+        os.chmod(socket_dir, 0o700)
+
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise SftpException('Another daemon is already listening on %s.' % self.socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a daemon that didn't exit cleanly.
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self._sock.listen(64)
+
+    def _watch_mounts(self):
+        """Drops the cached mount table whenever the kernel says it changed."""
+        with MountWatcher(self.environment.mountinfo_path) as watcher:
+            while True:
+                watcher.wait()
+                # Reading resets the change notification.
+                watcher.read()
+                self.environment.invalidate_mount_table()
+
+    def _handle(self, conn):
+        try:
+            chunks = []
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            try:
+                argv = json.loads(b''.join(chunks).decode('utf-8'))['argv']
+            except (ValueError, KeyError, TypeError):
+                response = {'exit_code': 1, 'stdout': '', 'stderr': 'Bad request.\n'}
+            else:
+                response = self.run(argv)
+            conn.sendall(json.dumps(response).encode('utf-8'))
+        except OSError:
+            # The client went away.
+            pass
+        finally:
+            conn.close()
+
+    def run(self, argv):
+        """Runs a command, capturing its output.
+        :return: dict response
+        """
+        if len(argv) == 0 or argv[0] not in DAEMON_COMMANDS:
+            return {'fallback': True}
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        instance = SftpCli(self.environment, stdout, stderr)
+        exit_code = 0
+        try:
+            dispatch(instance, argv)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                exit_code = e.code or 0
+            else:
+                stderr.write('%s\n' % e.code)
+                exit_code = 1
+        except Exception:
+            stderr.write(traceback.format_exc())
+            exit_code = 1
+        return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
@@ -9,3 +9,11 @@ class SftpMountException(SftpException):
     def __init__(self, mount_cmd, mount_cmd_output):
         self.mount_cmd = mount_cmd
         self.mount_cmd_output = mount_cmd_output
+
+
+class SftpUnreachableException(SftpException):
+
+    def __init__(self, probe_result):
+        msg = 'Host %s:%d is unreachable: %s' % (probe_result.host, probe_result.port, probe_result.error)
+        super(SftpUnreachableException, self).__init__(msg)
+        self.probe_result = probe_result
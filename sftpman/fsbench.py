@@ -0,0 +1,175 @@
+import os
+import time
+import random
+import shutil
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+#: The outcome of a single test. `value` is the rate (in `unit`), out of `operations` done in `seconds`.
+#: For throughput tests (`MiB/s`), `operations` is the number of bytes.
+BenchmarkResult = collections.namedtuple('BenchmarkResult', 'name value unit operations seconds')
+
+TEST_SEQ_WRITE = 'seq-write'
+TEST_SEQ_READ = 'seq-read'
+TEST_RANDOM_READ = 'random-read'
+TEST_METADATA = 'metadata'
+TESTS = (TEST_SEQ_WRITE, TEST_SEQ_READ, TEST_RANDOM_READ, TEST_METADATA)
+
+MB = 1024 * 1024
+
+
+class FilesystemBenchmark(object):
+    """Measures how fast a (mounted) filesystem is, by working on files in a scratch directory.
+
+    Each of the `jobs` workers writes and reads its own file (of `file_size` bytes),
+    so the results show what running things in parallel gets us.
+    What's written is random, so that compression can't make it look faster than it is.
+    Before reading, we ask the kernel to forget what it has cached for the files,
+    so that reads go to the server.
+    """
+
+    #: Size of random reads
+    RANDOM_READ_SIZE = 4096
+
+    #: How many times to list the scratch directory (with `files` files in it)
+    READDIR_REPEATS = 20
+
+    def __init__(self, path, jobs=1, file_size=64 * MB, block_size=MB, files=200, duration=5):
+        #: Where to create the scratch directory (it gets removed afterwards)
+        self.path = path
+        self.jobs = jobs
+        self.file_size = file_size
+        self.block_size = block_size
+        #: How many files the metadata tests work with
+        self.files = files
+        #: How long (in seconds) to keep doing random reads
+        self.duration = duration
+        self.scratch_path = None
+
+    def run(self, tests=TESTS):
+        """Runs the given tests (in order).
+        The read tests need the files written by `seq-write`, which is done (without being reported) if needed.
+        :return: list of BenchmarkResult
+        """
+        self.scratch_path = os.path.join(self.path, '.sftpman-bench-%d-%d' % (os.getpid(), random.randint(0, 1 << 30)))
+        os.mkdir(self.scratch_path)
+        try:
+            results = []
+            if TEST_SEQ_WRITE in tests or TEST_SEQ_READ in tests or TEST_RANDOM_READ in tests:
+                result = self.test_seq_write()
+                if TEST_SEQ_WRITE in tests:
+                    results.append(result)
+            if TEST_SEQ_READ in tests:
+                results.append(self.test_seq_read())
+            if TEST_RANDOM_READ in tests:
+                results.append(self.test_random_read())
+            if TEST_METADATA in tests:
+                results += self.test_metadata()
+            return results
+        finally:
+            shutil.rmtree(self.scratch_path, ignore_errors=True)
+
+    def _get_data_path(self, job):
+        return os.path.join(self.scratch_path, 'data-%d' % job)
+
+    def _run_parallel(self, work, items):
+        """Calls `work(item)` for all items, using `jobs` threads.
+        :return: two-tuple (list of results, seconds it took)
+        """
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(items)))) as executor:
+            results = list(executor.map(work, items))
+        return results, time.monotonic() - started
+
+    def _drop_cache(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def _get_rate_result(self, name, operations, seconds, unit, divisor=1):
+        value = (operations / float(divisor)) / seconds if seconds > 0 else 0.0
+        return BenchmarkResult(name, value, unit, operations, seconds)
+
+    def test_seq_write(self):
+        block = os.urandom(self.block_size)
+
+        def work(job):
+            fd = os.open(self._get_data_path(job), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                written = 0
+                while written < self.file_size:
+                    written += os.write(fd, block[:self.file_size - written])
+                # Without this, we'd only be measuring how fast the kernel takes it.
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return written
+
+        written, seconds = self._run_parallel(work, range(self.jobs))
+        return self._get_rate_result(TEST_SEQ_WRITE, sum(written), seconds, 'MiB/s', MB)
+
+    def test_seq_read(self):
+        for job in range(self.jobs):
+            self._drop_cache(self._get_data_path(job))
+
+        def work(job):
+            fd = os.open(self._get_data_path(job), os.O_RDONLY)
+            try:
+                total = 0
+                while True:
+                    chunk = os.read(fd, self.block_size)
+                    if not chunk:
+                        return total
+                    total += len(chunk)
+            finally:
+                os.close(fd)
+
+        read, seconds = self._run_parallel(work, range(self.jobs))
+        return self._get_rate_result(TEST_SEQ_READ, sum(read), seconds, 'MiB/s', MB)
+
+    def test_random_read(self):
+        for job in range(self.jobs):
+            self._drop_cache(self._get_data_path(job))
+        blocks = max(1, self.file_size // self.RANDOM_READ_SIZE)
+        deadline = time.monotonic() + self.duration
+
+        def work(job):
+            rng = random.Random(job)
+            fd = os.open(self._get_data_path(job), os.O_RDONLY)
+            try:
+                count = 0
+                while time.monotonic() < deadline:
+                    os.pread(fd, self.RANDOM_READ_SIZE, rng.randrange(blocks) * self.RANDOM_READ_SIZE)
+                    count += 1
+                return count
+            finally:
+                os.close(fd)
+
+        counts, seconds = self._run_parallel(work, range(self.jobs))
+        return self._get_rate_result(TEST_RANDOM_READ, sum(counts), seconds, 'IOPS')
+
+    def test_metadata(self):
+        """Measures creating, stat-ing, listing and deleting (empty) files.
+        :return: list of BenchmarkResult (one per operation)
+        """
+        paths = [os.path.join(self.scratch_path, 'meta-%05d' % idx) for idx in range(self.files)]
+
+        def create(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+
+        def listdir(_):
+            return len(os.listdir(self.scratch_path))
+
+        results = []
+        for name, work, items in (
+            ('create', create, paths),
+            ('stat', os.stat, paths),
+            ('readdir', listdir, range(self.READDIR_REPEATS)),
+            ('unlink', os.unlink, paths),
+        ):
+            _, seconds = self._run_parallel(work, items)
+            results.append(self._get_rate_result('%s-%s' % (TEST_METADATA, name), len(items), seconds, 'ops/s'))
+        return results
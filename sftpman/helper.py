@@ -1,26 +1,63 @@
 import os, errno
-import subprocess
-
-# Try to load the best json implementation,
-# If json support is not available, we'll add
-# an object that raises a RuntimeError when used
-json = None
-try:
-    import simplejson as json
-except ImportError:
+import collections
+import select
+import threading
+import time
+import contextlib
+
+
+def _import_json():
+    """Returns the best json implementation available (or None)."""
+    try:
+        import simplejson as json
+        return json
+    except ImportError:
+        pass
     try:
         import json
+        return json
     except ImportError:
-        try:
-            # Google Appengine offers simplejson via django
-            from django.utils import simplejson as json
-        except ImportError:
-            pass
-if json is None:
-    class _JSON(object):
-        def __getattr__(self, name):
-            raise RuntimeError('You need a JSON library to use sftpman!')
-    json = _JSON()
+        pass
+    try:
+        # Google Appengine offers simplejson via django
+        from django.utils import simplejson as json
+        return json
+    except ImportError:
+        return None
+
+
+class _JSON(object):
+    """Stands in for the json module, which only gets imported when first used.
+    Commands which don't need it (`ls`, shell completion) start faster that way.
+    If json support is not available, using it raises a RuntimeError.
+    """
+
+    _module = None
+
+    def __getattr__(self, name):
+        if _JSON._module is None:
+            _JSON._module = _import_json()
+            if _JSON._module is None:
+                raise RuntimeError('You need a JSON library to use sftpman!')
+        return getattr(_JSON._module, name)
+
+
+json = _JSON()
+
+
+class LazyRegex(object):
+    """A regular expression which only gets compiled (importing `re`) when first used."""
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._compiled = None
+
+    def __getattr__(self, name):
+        if self._compiled is None:
+            import re
+            self._compiled = re.compile(self.pattern, self.flags)
+        return getattr(self._compiled, name)
 
 
 def mkdir_p(path):
@@ -32,23 +69,196 @@ def mkdir_p(path):
             raise
 
 
-def rmdir(path):
-    """Safe rmdir (non-recursive) which doesn't throw if the directory is not empty."""
+def atomic_write(path, content, fsync=True):
+    """Writes a file, so that readers see either the old or the new content (never a partial write)."""
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def rmdir(path, stderr=None):
+    """Safe rmdir (non-recursive) which doesn't throw if the directory is not empty.
+    Problems are reported to `stderr` (`sys.stderr` by default).
+    """
     try:
         os.rmdir(path)
     except OSError as exc:
-        print(str(exc))
+        import sys
+
+        (stderr or sys.stderr).write('%s\n' % str(exc))
 
 
 def shell_exec(command):
     """Executes the given shell command and returns its output."""
+    import subprocess
     out = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
     return out.decode('utf-8')
 
 
+#: The outcome of `run_command()`. `returncode` is None if the command could not be stopped.
+CommandResult = collections.namedtuple('CommandResult', 'returncode stdout stderr timed_out')
+
+
+def run_command(command, timeout=None, shell=False, capture=True):
+    """Runs a command and waits (up to `timeout` seconds) for it to finish.
+
+    `command` is an argv list. A shell is only involved if `shell` is enabled,
+    in which case `command` is a string.
+    Commands which take longer than `timeout` seconds get killed.
+    Commands which leave something running in the background (holding on to their output)
+    should disable `capture`, so we don't wait for the output to end.
+    :return: CommandResult
+    """
+    try:
+        proc = start_command(command, shell=shell, capture=capture)
+    except OSError as e:
+        # Most likely the executable doesn't exist. Make it look like the shell would.
+        return CommandResult(127, '', str(e), False)
+    return finish_command(proc, timeout)
+
+
+_command_tracking = threading.local()
+
+
+@contextlib.contextmanager
+def track_commands(callback):
+    """Calls `callback(command)` for each command the current thread starts within the block."""
+    previous = getattr(_command_tracking, 'callback', None)
+    _command_tracking.callback = callback
+    try:
+        yield
+    finally:
+        _command_tracking.callback = previous
+
+
+def start_command(command, shell=False, capture=True):
+    """Starts a command in the background, capturing its output (unless `capture` is disabled).
+    Use `finish_command()` to wait for it and collect the results.
+    :return: subprocess.Popen
+    """
+    import subprocess
+
+    callback = getattr(_command_tracking, 'callback', None)
+    if callback is not None:
+        callback(command)
+    output = subprocess.PIPE if capture else subprocess.DEVNULL
+    return subprocess.Popen(command, shell=shell, stdout=output, stderr=output)
+
+
+def finish_command(proc, timeout=None, kill=True):
+    """Waits (up to `timeout` seconds) for a command started by `start_command()` to finish.
+    Commands which take longer than that get killed (unless `kill` is disabled,
+    in which case they're left running and whatever output they produced is lost).
+    :return: CommandResult
+    """
+    import subprocess
+
+    timed_out = False
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        if not kill:
+            return CommandResult(None, '', '', timed_out)
+        proc.kill()
+        try:
+            stdout, stderr = proc.communicate(timeout=1)
+        except subprocess.TimeoutExpired:
+            # Stuck in uninterruptible sleep (a dead FUSE mount can do that).
+            # There's nothing more we can do, so we leave it behind.
+            stdout, stderr = b'', b''
+    stdout, stderr = stdout or b'', stderr or b''
+    return CommandResult(proc.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace'), timed_out)
+
+
+def format_command(argv):
+    """Turns an argv list into a string that can be pasted into a shell."""
+    import shlex
+
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
+def split_fuse_options(value):
+    """Splits the value of an `-o` argument into options, the way FUSE does:
+    on commas, unless they're escaped with a backslash.
+    """
+    options = []
+    current = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            current.append(next(chars, ''))
+        elif char == ',':
+            options.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    options.append(''.join(current))
+    return [option for option in options if option != '']
+
+
+def escape_fuse_option(option):
+    """Escapes an option, so that FUSE takes it as a single option (commas and all)."""
+    return option.replace('\\', '\\\\').replace(',', '\\,')
+
+
 def kill_pid(pid, signal):
-    """Sends a signal to the process with the given id."""
-    shell_exec("/bin/kill -%d %d" % (signal, pid))
+    """Sends a signal to the process with the given id.
+    Processes that have already exited are ignored.
+    """
+    try:
+        os.kill(pid, signal)
+    except ProcessLookupError:
+        pass
+
+
+def pid_exists(pid):
+    """Tells whether a process with the given id is (still) running."""
+    return os.path.exists('/proc/%d' % pid)
+
+
+def wait_for_pid_exit(pid, timeout):
+    """Waits (up to `timeout` seconds) for the process with the given id to exit.
+    Returns as soon as it does, which is what makes this better than sleeping.
+    :return: boolean - whether the process is gone
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # No pidfd support (Python < 3.9 or Linux < 5.3)
+        return _wait_for_pid_exit_polling(pid, timeout)
+
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        return len(poller.poll(timeout * 1000)) != 0
+    finally:
+        os.close(fd)
+
+
+def _wait_for_pid_exit_polling(pid, timeout):
+    deadline = time.monotonic() + timeout
+    interval = 0.01
+    while pid_exists(pid):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 0.2)
+    return True
 
 
 def which(program):
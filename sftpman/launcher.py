@@ -5,6 +5,14 @@ def main():
     import sys, os
     path = os.path.dirname(os.path.dirname(__file__))
     sys.path.insert(0, path)
+
+    # Let a running daemon (`sftpman daemon`) handle the command, if possible.
+    # That's much faster than importing and setting up everything ourselves.
+    from sftpman import client
+    exit_code = client.run(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
     from sftpman import cli
     cli.start()
 
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
-from .helper import json, shell_exec, mkdir_p, rmdir, kill_pid, which
-from .exception import SftpConfigException, SftpMountException
+import threading
+import contextlib
+import collections
+from .helper import json, atomic_write, CommandResult, run_command, start_command, finish_command, format_command, \
+    mkdir_p, rmdir, kill_pid, wait_for_pid_exit, which, track_commands, LazyRegex, \
+    split_fuse_options, escape_fuse_option
+from .exception import SftpException, SftpConfigException, SftpMountException
+from .proc import MountTable, MountWatcher, ProcessIndex, read_child_pids
+from .multiplex import ControlMasterManager
+from .store import ConfigIndex, list_config_ids
+from .state import MountStateStore, diff_argv
+from .profiles import PROFILES, SshfsCapabilities, merge_options
 
 
 class EnvironmentModel(object):
@@ -11,11 +20,85 @@ class EnvironmentModel(object):
     with which we're now working.
     """
 
+    #: The filesystem type sshfs mounts show up with in the mount table
+    MOUNT_FSTYPE = 'fuse.sshfs'
+
+    #: Loading fewer systems than this reads their files directly (cheaper than checking the whole index)
+    CONFIG_INDEX_MIN_SYSTEMS = 10
+
     def __init__(self):
         self.mount_path_base = '/mnt/sshfs/'
         cfg_home = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
         self.config_path_base = "%s/" % os.path.join(cfg_home, 'sftpman')
         self.config_path_mounts = '%smounts/' % self.config_path_base
+        cache_home = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        self.config_index = ConfigIndex(self.config_path_mounts, os.path.join(cache_home, 'sftpman', 'index.json'))
+        #: Whether to load many systems at once through the index (see `ConfigIndex`)
+        self.use_config_index = True
+        runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+        #: Where runtime data (sockets, state) goes. None if there's no per-user runtime directory.
+        self.runtime_path_base = None if not runtime_dir else "%s/" % os.path.join(runtime_dir, 'sftpman')
+        self.mountinfo_path = MountTable.MOUNTINFO_PATH
+        self._mount_table = None
+        self._mount_table_lock = threading.Lock()
+        self._process_index = None
+        self._process_index_lock = threading.Lock()
+        self.control_masters = ControlMasterManager(self)
+        #: Where what we know about the installed sshfs is cached (see `SshfsCapabilities.detect()`)
+        self.sshfs_capabilities_cache_path = os.path.join(cache_home, 'sftpman', 'sshfs.json')
+        self._sshfs_capabilities = None
+        self._sshfs_capabilities_lock = threading.Lock()
+        #: Where the ids shell completion suggests are cached (see `update_completion_cache()`), or None
+        self.completion_cache_path = None if self.runtime_path_base is None else '%scompletion' % self.runtime_path_base
+        #: What we know about the sshfs processes we've started (see `MountStateStore`), or None
+        self.mount_state = None if self.runtime_path_base is None else MountStateStore('%smounts' % self.runtime_path_base)
+        #: When before-mount commands last succeeded (see `sftpman.batch.CommandCache`), or None
+        self.before_mount_cache_path = None if self.runtime_path_base is None else '%sbefore-mount.json' % self.runtime_path_base
+
+    def get_sshfs_capabilities(self):
+        """Returns what the installed sshfs supports (detected once)."""
+        with self._sshfs_capabilities_lock:
+            if self._sshfs_capabilities is None:
+                self._sshfs_capabilities = SshfsCapabilities.detect(self.sshfs_capabilities_cache_path)
+            return self._sshfs_capabilities
+
+    def _get_config_dir_mtime(self):
+        try:
+            return os.stat(self.config_path_mounts).st_mtime_ns
+        except OSError:
+            return None
+
+    def update_completion_cache(self):
+        """Writes down the available, mounted and unmounted ids,
+        so that shell completion doesn't have to start sftpman (Python) on every TAB.
+
+        The cache is only good while it's newer than the configuration directory
+        and the sshfs filesystems mounted under `mount_path_base` are the ones it lists as mounted.
+        `bash_completion.d/sftpman` checks both (falling back to `sftpman ls` otherwise).
+        """
+        if self.completion_cache_path is None:
+            return
+        config_dir_mtime = self._get_config_dir_mtime()
+        self.invalidate_mount_table()
+        available = self.get_available_ids()
+        mounted = self.get_mounted_ids()
+        ids_mounted = set(mounted)
+        lines = [
+            'config_dir %s' % self.config_path_mounts,
+            'mount_path_base %s' % self.mount_path_base,
+            'available %s' % ' '.join(available),
+            'mounted %s' % ' '.join(mounted),
+            'unmounted %s' % ' '.join(id for id in available if id not in ids_mounted),
+        ]
+        try:
+            mkdir_p(self.runtime_path_base)
+            atomic_write(self.completion_cache_path, '\n'.join(lines) + '\n', fsync=False)
+            # A system added (or removed) while we were listing wouldn't make the cache look outdated.
+            if self._get_config_dir_mtime() != config_dir_mtime:
+                os.unlink(self.completion_cache_path)
+        except (IOError, OSError):
+            # It's only a cache.
+            pass
 
     def get_system_config_path(self, system_id):
         return '%s%s.json' % (self.config_path_mounts, system_id)
@@ -24,42 +107,135 @@ class EnvironmentModel(object):
         """The local path where the system will be mounted."""
         return '%s%s' % (self.mount_path_base, system_id)
 
+    def get_mount_table(self):
+        """Returns a snapshot of the mount table.
+        The same snapshot is reused (even across threads),
+        until `invalidate_mount_table()` is called.
+        """
+        with self._mount_table_lock:
+            if self._mount_table is None:
+                self._mount_table = self._read_mount_table()
+            return self._mount_table
+
+    def invalidate_mount_table(self):
+        """Makes sure the next `get_mount_table()` call sees the current mount table.
+        Call this after doing something that (possibly) mounts or unmounts.
+        """
+        with self._mount_table_lock:
+            self._mount_table = None
+
+    def _read_mount_table(self):
+        try:
+            return MountTable.read(self.mountinfo_path)
+        except IOError:
+            # No /proc (or not Linux). `mount -l` is slower, but available.
+            # "mount -l -t fuse.sshfs" cannot be used, as it requires root privileges
+            return MountTable.parse_mount_output(run_command(['mount', '-l']).stdout)
+
     def is_mounted(self, system_id):
-        return system_id in self.get_mounted_ids()
+        mount_dest = self.get_system_mount_dest(system_id)
+        return self.get_mount_table().is_mounted(mount_dest, self.MOUNT_FSTYPE)
+
+    def get_process_index(self):
+        """Returns a snapshot of the running sshfs/ssh processes.
+        The same snapshot is reused (even across threads),
+        until `invalidate_process_index()` is called.
+        """
+        with self._process_index_lock:
+            if self._process_index is None:
+                self._process_index = ProcessIndex.read()
+            return self._process_index
+
+    def invalidate_process_index(self):
+        """Makes sure the next `get_process_index()` call sees the current processes.
+        Call this after starting new sshfs processes.
+        """
+        with self._process_index_lock:
+            self._process_index = None
+
+    def get_mount_record(self, system_id):
+        """Returns what we recorded when mounting the system, if its sshfs process is still running.
+        :return: `sftpman.state.MountRecord` or None (not mounted, or not by us)
+        """
+        if self.mount_state is None:
+            return None
+        return self.mount_state.load(system_id)
 
     def get_pid_by_system_id(self, system_id):
-        # Matching in `{PID} blah blah {mount_dest}`
+        record = self.get_mount_record(system_id)
+        if record is not None:
+            return record.pid
         mount_dest = self.get_system_mount_dest(system_id)
-        regex = re.compile("^(\\d+)\\s+(?:.+?)\\s%s$" % re.escape(mount_dest))
-
-        processes = shell_exec("pgrep --list-full sshfs")
-        for line in processes.split("\n"):
-            match_object = regex.match(line)
-            if match_object is not None:
-                return int(match_object.group(1))
-        return None
+        return self.get_process_index().get_sshfs_pid(mount_dest)
+
+    def get_ssh_pids_by_system_id(self, system_id):
+        """Returns the ssh processes that the system's sshfs process uses."""
+        record = self.get_mount_record(system_id)
+        if record is not None:
+            pids = read_child_pids(record.pid)
+            if pids is not None:
+                return pids
+        pid = self.get_pid_by_system_id(system_id)
+        if pid is None:
+            return []
+        return self.get_process_index().get_ssh_pids(pid)
 
     def get_available_ids(self):
-        if not os.path.exists(self.config_path_mounts):
-            return []
-        cfg_files = shell_exec('ls %s' % self.config_path_mounts).strip().split('\n')
-        return [file_name[0:-5] for file_name in cfg_files if file_name.endswith('.json')]
+        return list_config_ids(self.config_path_mounts)
+
+    def load_systems(self, system_ids=None):
+        """Loads the given systems (or all available systems) at once.
+        :return: list of two-tuples (system_id, SystemModel or SftpConfigException)
+        """
+        if system_ids is None:
+            system_ids = self.get_available_ids()
+        configs = {}
+        if self.use_config_index and len(system_ids) >= self.CONFIG_INDEX_MIN_SYSTEMS:
+            configs = self.config_index.load()
+        out = []
+        for system_id in system_ids:
+            if system_id in configs:
+                out.append((system_id, SystemModel(**configs[system_id])))
+                continue
+            # Not indexed (possibly missing or broken). Loading it reports the problem.
+            try:
+                out.append((system_id, SystemModel.create_by_id(system_id, self)))
+            except SftpConfigException as e:
+                out.append((system_id, e))
+        return out
 
     def get_mounted_ids(self):
-        # Looking for /mnt/sshfs/{id} in output that looks like this:
-        # user@host:/remote/path on /mnt/sshfs/id type fuse.sshfs ...
-        # "mount -l -t fuse.sshfs" cannot be used, as it requires root privileges
-        mounted = shell_exec('mount -l')
-        regex = re.compile(' %s(.+?) type fuse\\.sshfs' % self.mount_path_base)
-        return regex.findall(mounted)
+        # Looking for sshfs filesystems mounted at /mnt/sshfs/{id}
+        entries = self.get_mount_table().find(self.mount_path_base, self.MOUNT_FSTYPE)
+        return [os.path.basename(entry.dest) for entry in entries]
 
     def get_unmounted_ids(self):
-        ids_mounted = self.get_mounted_ids()
+        ids_mounted = set(self.get_mounted_ids())
         return [id for id in self.get_available_ids() if id not in ids_mounted]
 
-    def perform_preflight_check(self):
+    def check_hosts(self, system_ids=None, timeout=None):
+        """Checks (concurrently) whether the SSH servers of the given systems
+        (or all available systems) can be reached.
+        :return: list of two-tuples (HostProbeResult, list system ids using that host)
+        """
+        if system_ids is None:
+            system_ids = self.get_available_ids()
+        endpoints = collections.OrderedDict()
+        for system_id, system in self.load_systems(system_ids):
+            if isinstance(system, SftpConfigException):
+                continue
+            endpoints.setdefault((system.host, system.port), []).append(system_id)
+
+        from . import reachability
+
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        results = reachability.probe_hosts(endpoints.keys(), **kwargs)
+        return [(result, endpoints[(result.host, result.port)]) for result in results]
+
+    def perform_preflight_check(self, host_results=None):
         """Performs checks to see if we have everything needed to mount
         sshfs filesystems.
+        :param host_results: the result of `check_hosts()`, if hosts should be checked too
         :return: two-tuple (boolean checks_pass, list failure messages)
         """
         failures = []
@@ -73,9 +249,43 @@ class EnvironmentModel(object):
             msg = ("SSHFS (http://fuse.sourceforge.net/sshfs.html)"
                    " does not seem to be installed.")
             failures.append(msg)
+        else:
+            capabilities = self.get_sshfs_capabilities()
+            for system_id, system in self.load_systems():
+                if isinstance(system, SftpConfigException):
+                    continue
+                for option in system.mount_opts:
+                    reason = capabilities.get_unsupported_reason(option)
+                    if reason is not None:
+                        msg = "Mount option `{option}` of `{id}` is not supported by the installed sshfs: {reason}"
+                        failures.append(msg.format(option = option, id = system_id, reason = reason))
+                failures += self._check_mount_options(system)
+        for result, system_ids in (host_results or []):
+            if not result.reachable:
+                msg = "Host `{host}:{port}` (used by: {ids}) is not reachable: {error}"
+                failures.append(msg.format(
+                    host = result.host,
+                    port = result.port,
+                    ids = ', '.join(system_ids),
+                    error = result.error,
+                ))
 
         return len(failures) == 0, failures
 
+    def _check_mount_options(self, system):
+        """Checks that sshfs (FUSE) would see each option of the system's mount command as it's meant.
+        :return: list of failure messages
+        """
+        builder = MountCommandBuilder(system, self)
+        argv = builder.get_mount_argv()
+        given = [argv[idx + 1] for idx in range(len(argv) - 1) if argv[idx] == '-o']
+        failures = []
+        for option, value in zip(builder.get_mount_options(), given):
+            if split_fuse_options(value) != [option]:
+                msg = "Mount option `{option}` of `{id}` would reach sshfs as: {parsed}"
+                failures.append(msg.format(option = option, id = system.id, parsed = ' | '.join(split_fuse_options(value))))
+        return failures
+
 
 class SystemModel(object):
     """Represents a system (mount point) that sftpman manages."""
@@ -105,6 +315,9 @@ class SystemModel(object):
         AUTH_METHOD_GSSAPI_WITH_MIC
     )
 
+    #: Auth methods which need someone to type something (at a terminal)
+    AUTH_METHODS_INTERACTIVE = (AUTH_METHOD_PASSWORD, AUTH_METHOD_INTERACTIVE)
+
     # libfuse (>=3.0.0) dropped support for big_writes
     UNSUPPORTED_MOUNT_OPTS = ['big_writes']
 
@@ -119,12 +332,27 @@ class SystemModel(object):
         self.auth_method = kwargs.get('authType', self.AUTH_METHOD_PUBLIC_KEY)
         self.ssh_key = kwargs.get('sshKey', None)
         self.cmd_before_mount = kwargs.get('beforeMount', '')
+        self.ssh_multiplexing = kwargs.get('sshMultiplexing', False)
+        #: The name of a performance profile (see `sftpman.profiles.PROFILES`), or None
+        self.performance_profile = kwargs.get('performanceProfile', None)
 
     def _set_port(self, value):
         self._port = int(value)
 
     port = property(lambda self: self._port, _set_port)
 
+    def _set_ssh_multiplexing(self, value):
+        if isinstance(value, str):
+            value = value.lower() in ('1', 'yes', 'true', 'on')
+        self._ssh_multiplexing = bool(value)
+
+    ssh_multiplexing = property(lambda self: self._ssh_multiplexing, _set_ssh_multiplexing)
+
+    def _set_performance_profile(self, value):
+        self._performance_profile = value or None
+
+    performance_profile = property(lambda self: self._performance_profile, _set_performance_profile)
+
     def _set_ssh_key(self, value):
         if value is not None:
             value = os.path.expanduser(value)
@@ -132,29 +360,34 @@ class SystemModel(object):
 
     ssh_key = property(lambda self: self._ssh_key, _set_ssh_key)
 
+    ID_REGEX = LazyRegex('^[a-zA-Z0-9\\.\\-_@]+$')
+    # Well, not really alphanumeric, but close enough to call it that
+    HOST_REGEX = LazyRegex('^[a-zA-Z0-9\\.\\-]+$')
+    USERNAME_REGEX = LazyRegex('^[a-zA-Z0-9\\.\\-_@]+$')
+    PATH_REGEX = LazyRegex('^/(([a-zA-Z0-9\\.\\-_]+)/?)*?$')
+
     def validate(self):
         def is_valid_id(value):
             if value is None:
                 return False
             if value in ('.', '..'):
                 return False
-            return re.compile('^[a-zA-Z0-9\\.\\-_@]+$').match(value) is not None
+            return self.ID_REGEX.match(value) is not None
 
         def is_alphanumeric(value):
             if value is None:
                 return False
-            # Well, not really alphanumeric, but close enough to call it that
-            return re.compile('^[a-zA-Z0-9\\.\\-]+$').match(value) is not None
+            return self.HOST_REGEX.match(value) is not None
 
         def is_valid_username(value):
             if value is None:
                 return False
-            return re.compile('^[a-zA-Z0-9\\.\\-_@]+$').match(value) is not None
+            return self.USERNAME_REGEX.match(value) is not None
 
         def is_valid_path(value):
             if value is None:
                 return False
-            return re.compile('^/(([a-zA-Z0-9\\.\\-_]+)/?)*?$').match(value) is not None
+            return self.PATH_REGEX.match(value) is not None
 
         errors = []
         if not is_valid_id(self.id):
@@ -181,11 +414,14 @@ class SystemModel(object):
             errors.append(('mount_opts', 'Bad options received.'))
         if not isinstance(self.cmd_before_mount, str):
             errors.append(('cmd_before_mount', 'Invalid before mount command.'))
+        if self.performance_profile is not None and self.performance_profile not in PROFILES:
+            msg = 'Unknown performance profile. Can be one of: %s.' % ', '.join(PROFILES)
+            errors.append(('performance_profile', msg))
 
         return (len(errors) == 0, errors)
 
-    def export(self):
-        """Serializes to JSON."""
+    def to_dict(self):
+        """Returns the configuration as stored (see `export()`)."""
         fields = ['id', 'host', 'port', 'user']
         out = {}
         for field in fields:
@@ -195,17 +431,26 @@ class SystemModel(object):
         out['beforeMount'] = self.cmd_before_mount
         out['authType'] = self.auth_method
         out['sshKey'] = self.ssh_key
-        return json.dumps(out, indent=4)
+        out['sshMultiplexing'] = self.ssh_multiplexing
+        out['performanceProfile'] = self.performance_profile
+        return out
+
+    def export(self):
+        """Serializes to JSON."""
+        return json.dumps(self.to_dict(), indent=4)
 
     def save(self, environment):
         path = environment.get_system_config_path(self.id)
         mkdir_p(os.path.dirname(path))
-        with open(path, 'w') as f:
-            f.write(self.export())
+        atomic_write(path, self.export())
+        if environment.use_config_index:
+            environment.config_index.load()
 
     def delete(self, environment):
         path = environment.get_system_config_path(self.id)
         os.unlink(path)
+        if environment.use_config_index:
+            environment.config_index.load()
 
     @staticmethod
     def create_by_id(id, environment):
@@ -223,6 +468,99 @@ class SystemModel(object):
             raise SftpConfigException(msg % path, e)
 
 
+class MountCommandBuilder(object):
+    """Builds the commands that mount a system.
+
+    Mounting it ourselves and generating units for the init system to do it
+    both go through here, so that they always run the same thing.
+    """
+
+    #: Time to wait for sshfs (ssh) to establish a connection
+    SSH_CONNECT_TIMEOUT = 8
+
+    def __init__(self, system, environment, multiplexed=False):
+        self.system = system
+        self.environment = environment
+        #: Whether to use (and possibly start) the connection shared with other systems on the same host
+        self.multiplexed = multiplexed
+        self._profile_options = None
+
+    @property
+    def source(self):
+        """What sshfs mounts (`user@host:/path`)."""
+        return '%s@%s:%s' % (self.system.user, self.system.host, self.system.mount_point)
+
+    @property
+    def dest(self):
+        return self.environment.get_system_mount_dest(self.system.id)
+
+    @property
+    def cmd_before_mount(self):
+        """The (shell) command to run before mounting, or None."""
+        return self.system.cmd_before_mount or None
+
+    def get_profile_options(self):
+        """Returns the options the system's performance profile contributes
+        (merged with the system's own options), or None if it doesn't use a profile.
+        :return: MergedOptions or None
+        """
+        profile = PROFILES.get(self.system.performance_profile)
+        if profile is None:
+            return None
+        if self._profile_options is None:
+            capabilities = self.environment.get_sshfs_capabilities()
+            self._profile_options = merge_options(profile, self.system.mount_opts, capabilities)
+        return self._profile_options
+
+    def get_ssh_argv(self, multiplexed=True):
+        """Returns the ssh command (as an argv list) that sshfs should use.
+        Unless disabled by `multiplexed`, this includes the options for sharing the connection.
+        """
+        argv = ['ssh', '-o', 'ConnectTimeout=%d' % self.SSH_CONNECT_TIMEOUT, '-p', str(self.system.port)]
+        if self.system.auth_method == self.system.AUTH_METHOD_PUBLIC_KEY:
+            argv += ['-o', 'PreferredAuthentications=publickey', '-i', self.system.ssh_key]
+        elif self.system.auth_method == self.system.AUTH_METHOD_AUTHENTICATION_AGENT:
+            # By not specifying a key and preferred authentication method,
+            # we're hoping to delegate all this to an already running SSH agent, if available.
+            pass
+        elif self.system.auth_method:
+            argv += ['-o', 'PreferredAuthentications=%s' % self.system.auth_method]
+        else:
+            argv += ['-o', 'PreferredAuthentications=password']
+        profile_options = self.get_profile_options()
+        if profile_options is not None:
+            for option in profile_options.ssh_options:
+                argv += ['-o', option]
+        if multiplexed and self.multiplexed:
+            argv += self.environment.control_masters.get_ssh_options(self.system)
+        return argv
+
+    def get_mount_options(self):
+        """Returns the options to pass to sshfs, one option per item (unescaped, see `escape_fuse_option()`)."""
+        # sshfs splits `ssh_command` on whitespace by itself.
+        options = ['ssh_command=%s' % ' '.join(self.get_ssh_argv())]
+        profile_options = self.get_profile_options()
+        if profile_options is not None:
+            options += profile_options.sshfs_options
+        for value in self.system.mount_opts:
+            # Someone may have put several options (`uid=1000,gid=1000`) into one.
+            options += split_fuse_options(value)
+        return options
+
+    def get_mount_argv(self, foreground=False):
+        """Returns the sshfs command (as an argv list) that mounts the system.
+        With `foreground`, sshfs stays in the foreground until the filesystem is unmounted.
+        """
+        argv = ['sshfs']
+        if foreground:
+            argv.append('-f')
+        for opt in self.get_mount_options():
+            # FUSE splits option values on commas (which ssh options like `Ciphers` have).
+            argv += ['-o', escape_fuse_option(opt)]
+        argv += [self.source, self.dest]
+        return argv
+
+
 class SystemControllerModel(object):
     """Controls a given system within the environment.
     The controller manages mounting, unmounting, cleaning up, etc.
@@ -231,15 +569,54 @@ class SystemControllerModel(object):
     SIGNAL_SIGTERM = 15
     SIGNAL_SIGKILL = 9
 
-    #: Time to wait when unmounting before forcefully killing the mount process
+    #: Max time to wait when unmounting before forcefully killing the mount process
     KILL_WAIT_TIME_SECONDS = 2
 
     #: Time to wait for sshfs (ssh) to establish a connection
-    SSH_CONNECT_TIMEOUT = 8
+    SSH_CONNECT_TIMEOUT = MountCommandBuilder.SSH_CONNECT_TIMEOUT
+
+    #: Time to wait for `fusermount` (which can hang on a dead FUSE mount)
+    FUSERMOUNT_TIMEOUT = 10
+
+    #: Time to wait for a mount to show up, unless the user has to type something (e.g. a password)
+    MOUNT_WAIT_TIME_SECONDS = 30
+
+    #: Unmounting a busy filesystem kills sshfs, then unmounts
+    UNMOUNT_STRATEGY_KILL = 'kill'
+    #: Unmounting a busy filesystem detaches it right away (`fusermount -uz`), then kills sshfs
+    UNMOUNT_STRATEGY_LAZY = 'lazy'
+
+    # Mounting and unmounting are generators of steps (see `_mount_steps()`), which say what to do
+    # and what to wait for. `_run_steps()` carries them out (and `sftpman.aio` does the same within an event loop).
+
+    #: Calling something which doesn't take long: (STEP_CALL, callable) -> what it returns
+    STEP_CALL = 'call'
+    #: Running a command: (STEP_RUN, command, boolean shell, timeout) -> CommandResult
+    STEP_RUN = 'run'
+    #: Starting sshfs and waiting for the mount: (STEP_MOUNT, command, boolean shell, timeout)
+    #: -> two-tuple (sshfs process, CommandResult of sshfs if it failed, None if mounted)
+    STEP_MOUNT = 'mount'
+    #: Letting the sshfs foreground process (from `STEP_MOUNT`) exit: (STEP_DETACH, process) -> None
+    STEP_DETACH = 'detach'
+    #: Waiting for a process to exit: (STEP_WAIT_FOR_EXIT, pid, timeout) -> boolean - whether it did
+    STEP_WAIT_FOR_EXIT = 'wait_for_exit'
 
     def __init__(self, system, environment):
         self.system = system
         self.environment = environment
+        self.kill_wait_time = self.KILL_WAIT_TIME_SECONDS
+        self.mount_wait_time = self.MOUNT_WAIT_TIME_SECONDS
+        self.unmount_strategy = self.UNMOUNT_STRATEGY_KILL
+        #: Records how long each phase of mounting takes (a `sftpman.timing.PhaseTimer`), if set
+        self.timer = None
+        #: Runs the before-mount command, sharing it with other systems (a `sftpman.batch.SharedCommandRunner`), if set
+        self.before_mount_runner = None
+        #: Called with (system id, event) as things progress, if set.
+        #: Events are the phases (see `timing.MOUNT_PHASES` and `timing.UNMOUNT_PHASES`) as they start,
+        #: followed by the outcome (e.g. `timing.OUTCOME_MOUNTED`, `timing.OUTCOME_UNMOUNTED`).
+        self.progress_callback = None
+        #: Where to report problems which don't stop the operation (`sys.stderr`, if not set)
+        self.stderr = None
 
     @property
     def mounted(self):
@@ -253,99 +630,331 @@ class SystemControllerModel(object):
     def mount_point_remote(self):
         return self.system.mount_point
 
-    def _mount_point_local_create(self):
-        """Ensures the mount location exists, so we can start using it."""
+    def _mount_point_local_delete(self):
+        rmdir(self.mount_point_local, self.stderr)
 
-        # Ensure nothing's mounted there right now..
-        shell_exec('fusermount -u %s' % self.mount_point_local)
+    def _fusermount(self, flags):
+        return run_command(['fusermount', flags, self.mount_point_local], timeout=self.FUSERMOUNT_TIMEOUT)
 
-        # Ensure the directory path exists
-        mkdir_p(self.mount_point_local)
+    @property
+    def multiplexed(self):
+        """Tells whether the system shares its SSH connection with others on the same host."""
+        return self.system.ssh_multiplexing and self.environment.control_masters.enabled
 
-    def _mount_point_local_delete(self):
-        rmdir(self.mount_point_local)
+    def get_command_builder(self):
+        return MountCommandBuilder(self.system, self.environment, self.multiplexed)
 
-    def mount(self):
-        """Mounts the sftp system if it's not already mounted."""
-        if self.mounted:
-            return
+    def get_ssh_argv(self, multiplexed=True):
+        """Returns the ssh command (as an argv list) that sshfs should use.
+        Unless disabled by `multiplexed`, this includes the options for sharing the connection
+        (if the system wants to).
+        """
+        return self.get_command_builder().get_ssh_argv(multiplexed)
 
-        self._mount_point_local_create()
+    def get_mount_argv(self):
+        """Returns the sshfs command (as an argv list) that mounts the system."""
+        return self.get_command_builder().get_mount_argv()
 
-        if len(self.system.mount_opts) == 0:
-            sshfs_opts = ""
-        else:
-            sshfs_opts = " -o %s" % " -o ".join(self.system.mount_opts)
+    def get_mount_record(self):
+        """Returns what we recorded when mounting the system (see `EnvironmentModel.get_mount_record()`)."""
+        return self.environment.get_mount_record(self.system.id)
 
-        if self.system.auth_method == self.system.AUTH_METHOD_PUBLIC_KEY:
-            ssh_opts = '-o PreferredAuthentications=publickey -i %s' % self.system.ssh_key
-        elif self.system.auth_method == self.system.AUTH_METHOD_AUTHENTICATION_AGENT:
-            # By not specifying a key and preferred authentication method,
-            # we're hoping to delegate all this to an already running SSH agent, if available.
-            ssh_opts = ""
-        elif self.system.auth_method:
-            ssh_opts = '-o PreferredAuthentications=%s' % self.system.auth_method
-        else:
-            ssh_opts = '-o PreferredAuthentications=password'
-
-        ssh_cmd = "ssh -o ConnectTimeout={timeout} -p {port} {ssh_opts}".format(
-            timeout = self.SSH_CONNECT_TIMEOUT,
-            port = self.system.port,
-            ssh_opts = ssh_opts,
-        )
-        ssh_cmd = ssh_cmd.rstrip()
-
-        cmd = (" sshfs -o ssh_command="
-               "'{ssh_cmd}'"
-               " {sshfs_opts} {user}@{host}:{remote_path} {local_path}")
-        cmd = cmd.format(
-            cmd_before_mount = self.system.cmd_before_mount,
-            ssh_cmd = ssh_cmd,
-            sshfs_opts = sshfs_opts,
-            host = self.system.host,
-            user = self.system.user,
-            remote_path = self.mount_point_remote,
-            local_path = self.mount_point_local,
-        )
-
-        if self.system.cmd_before_mount:
-            cmd = f"{self.system.cmd_before_mount} && {cmd}"
-
-        output = shell_exec(cmd).strip()
+    def get_config_drift(self):
+        """Tells how the system's current configuration differs from what it's mounted with.
+        Mounting again (after unmounting) is what applies a changed configuration.
+        :return: two-tuple (list of sshfs arguments only the mount has, list of those only the configuration has),
+            or None if we don't know (not mounted, or not by us)
+        """
+        record = self.get_mount_record()
+        if record is None:
+            return None
+        return diff_argv(record.argv, self.get_mount_argv())
+
+    def _notify(self, event):
+        if self.progress_callback is not None:
+            self.progress_callback(self.system.id, event)
+
+    def _phase(self, name):
+        """Times a phase of an operation (if there's a timer), after announcing it (see `progress_callback`)."""
+        self._notify(name)
+        if self.timer is None:
+            return contextlib.nullcontext()
+        return self.timer.phase(name)
+
+    def _finish(self, outcome, error=None):
+        """Records and announces how an operation ended."""
+        if self.timer is not None:
+            self.timer.finish(outcome, error)
+        self._notify(outcome)
+
+    def _run_steps(self, steps):
+        """Carries out an operation (see `_mount_steps()`), doing (and waiting for) each of its steps in turn.
+        :return: whatever the operation returns
+        """
+        result = None
+        try:
+            while True:
+                result = self._perform(steps.send(result))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+    def _perform(self, step):
+        """Does a step of an operation (see `STEP_RUN` and the others).
+        :return: the step's result
+        """
+        kind = step[0]
+        if kind == self.STEP_CALL:
+            return step[1]()
+        if kind == self.STEP_RUN:
+            _, command, shell, timeout = step
+            return run_command(command, timeout=timeout, shell=shell)
+        if kind == self.STEP_MOUNT:
+            _, command, shell, timeout = step
+            return self._mount_and_wait(command, shell, timeout)
+        if kind == self.STEP_DETACH:
+            finish_command(step[1], timeout=1, kill=False)
+            return None
+        if kind == self.STEP_WAIT_FOR_EXIT:
+            return wait_for_pid_exit(step[1], step[2])
+        raise ValueError('Unknown step: %s' % kind)
+
+    def _fusermount_step(self, flags):
+        return (self.STEP_RUN, ['fusermount', flags, self.mount_point_local], False, self.FUSERMOUNT_TIMEOUT)
 
-        if not self.mounted:
+    def mount(self):
+        """Mounts the sftp system if it's not already mounted.
+        :return: boolean - whether it got mounted (False if it already was)
+        """
+        from . import timing
+
+        tracking = contextlib.nullcontext() if self.timer is None else track_commands(self.timer.count_command)
+        with tracking:
+            try:
+                mounted = self._run_steps(self._mount_steps())
+            except SftpException as e:
+                self._finish(timing.OUTCOME_FAILED, e)
+                raise
+        self._finish(timing.OUTCOME_MOUNTED if mounted else timing.OUTCOME_ALREADY_MOUNTED)
+        return mounted
+
+    def _mount_steps(self):
+        """The steps of mounting (see `_run_steps()`), shared with `sftpman.aio.AsyncSystemController`.
+        :return: boolean - whether it got mounted (False if it already was)
+        """
+        with self._phase('check'):
+            if self.mounted:
+                return False
+
+        with self._phase('prepare'):
+            # Ensure nothing's mounted there right now..
+            yield self._fusermount_step('-u')
+            mkdir_p(self.mount_point_local)
+            if self.multiplexed:
+                # sshfs' ssh may become the master itself (see `ControlMaster=auto`).
+                self.environment.control_masters.ensure_control_dir(self.system)
+
+        # The first time around, this may have to ask sshfs what it supports.
+        argv = yield (self.STEP_CALL, self.get_mount_argv)
+        command, shell = self.get_sshfs_command(argv)
+
+        if self.system.cmd_before_mount and not shell:
+            with self._phase('before_mount'):
+                # Other systems may be waiting for the same command, so it isn't ours to kill (if mounting gets cancelled).
+                result = yield (self.STEP_CALL, self.run_before_mount)
+            self._check_before_mount_result(result)
+
+        if self.multiplexed and not shell:
+            # If this fails, ssh will start its own connection (and tell us what went wrong).
+            # When the before-mount command runs in sshfs' shell, it may be what makes the host reachable,
+            # so sshfs' ssh starts the shared connection itself (see `ControlMaster=auto`).
+            with self._phase('control_master'):
+                yield (self.STEP_CALL, lambda: self.environment.control_masters.ensure_master(self))
+
+        timeout = self.mount_wait_time
+        if self.system.auth_method in self.system.AUTH_METHODS_INTERACTIVE:
+            # Can't tell how long it would take someone to type their password.
+            timeout = None
+
+        try:
+            with self._phase('sshfs'):
+                proc, result = yield (self.STEP_MOUNT, command, shell, timeout)
+        finally:
+            self.environment.invalidate_mount_table()
+            self.environment.invalidate_process_index()
+
+        if result is not None:
             # Clean up the directory tree
             self._mount_point_local_delete()
+            output = (result.stdout + result.stderr).strip()
+            if result.timed_out:
+                output = ('%s\nGave up waiting for the mount after %s seconds.' % (output, timeout)).strip()
             if output == '':
                 output = 'Mounting failed for a reason unknown to sftpman.'
-            raise SftpMountException(cmd, output)
+            raise SftpMountException(command if shell else format_command(command), output)
+
+        # sshfs forks into the background once mounted.
+        # Give the foreground process a chance to exit, so we don't leave it hanging around.
+        with self._phase('sshfs_detach'):
+            yield (self.STEP_DETACH, proc)
+
+        if self.environment.mount_state is not None:
+            with self._phase('record'):
+                self._record_mount(argv)
+        return True
+
+    def _abandon_mount_steps(self):
+        """The steps of cleaning up after mounting got interrupted half-way (see `_run_steps()`)."""
+        # sshfs may have mounted (and forked into the background) already. It exits once unmounted.
+        yield self._fusermount_step('-uz')
+        self.environment.invalidate_mount_table()
+        self.environment.invalidate_process_index()
+        self._mount_point_local_delete()
+
+    def _record_mount(self, argv):
+        """Records the sshfs process serving the (just mounted) system (see `sftpman.state.MountStateStore`)."""
+        # The process we started has forked into the background (and exited), so we look for its child.
+        pid = self.environment.get_process_index().get_sshfs_pid(self.mount_point_local)
+        if pid is not None:
+            self.environment.mount_state.record(self.system.id, pid, argv)
+
+    def get_sshfs_command(self, argv):
+        """Returns the command which starts sshfs (`argv`, see `get_mount_argv()`).
+        Unless it's shared (see `before_mount_runner`), the before-mount command runs in the same shell,
+        right before sshfs, so whatever it sets up (environment variables, for example) applies to sshfs too.
+        :return: two-tuple (command, boolean shell), `command` being a string if `shell` is enabled
+        """
+        if self.system.cmd_before_mount and self.before_mount_runner is None:
+            return '%s && exec %s' % (self.system.cmd_before_mount, format_command(argv)), True
+        return argv, False
+
+    def run_before_mount(self):
+        """Runs the system's before-mount command (through `before_mount_runner`, if set).
+        :return: CommandResult
+        """
+        # This one's user-supplied and meant for a shell.
+        if self.before_mount_runner is not None:
+            return self.before_mount_runner.run(self.system.cmd_before_mount)
+        return run_command(self.system.cmd_before_mount, shell=True)
+
+    def _check_before_mount_result(self, result):
+        """Gives up on mounting (cleaning up) if the before-mount command failed."""
+        if result.returncode == 0:
+            return
+        self._mount_point_local_delete()
+        output = (result.stdout + result.stderr).strip()
+        if output == '':
+            output = 'The before-mount command failed (exit code: %s).' % result.returncode
+        raise SftpMountException(self.system.cmd_before_mount, output)
+
+    def _mount_and_wait(self, command, shell, timeout):
+        """Starts sshfs (see `get_sshfs_command()`) and waits (up to `timeout` seconds) for the kernel to register the mount.
+        We stop waiting as soon as the mount shows up, sshfs fails, or the deadline passes.
+        :return: two-tuple (sshfs process, CommandResult of sshfs if it failed, None if mounted)
+        """
+        with MountWatcher(self.environment.mountinfo_path) as watcher:
+            try:
+                proc = start_command(command, shell=shell)
+            except OSError as e:
+                return None, CommandResult(127, '', str(e), False)
+            table = watcher.wait_for(
+                self.mount_point_local,
+                self.environment.MOUNT_FSTYPE,
+                timeout = timeout,
+                abort = lambda: proc.poll() is not None,
+            )
+
+        if table is not None:
+            return proc, None
+        return proc, finish_command(proc, timeout=0 if proc.poll() is None else 1)
 
     def unmount(self):
-        """Unmounts the sftp system if it's currently mounted."""
+        """Unmounts the sftp system if it's currently mounted.
+        :return: boolean - whether it was mounted
+        """
+        from . import timing
+
+        unmounted = self._run_steps(self._unmount_steps())
+        self._finish(timing.OUTCOME_UNMOUNTED if unmounted else timing.OUTCOME_NOT_MOUNTED)
+        return unmounted
+
+    def _unmount_steps(self):
+        """The steps of unmounting (see `_run_steps()`), shared with `sftpman.aio.AsyncSystemController`.
+        :return: boolean - whether it was mounted
+        """
         if not self.mounted:
-            return
+            return False
 
-        # Try to unmount properly.
-        cmd = 'fusermount -u %s' % self.mount_point_local
-        shell_exec(cmd)
+        with self._phase('unmount'):
+            # Try to unmount properly.
+            yield self._fusermount_step('-u')
+            self.environment.invalidate_mount_table()
 
         # The filesystem is probably still in use.
-        # kill sshfs and re-run this same command (which will work then).
         if self.mounted:
-            self._kill()
-            shell_exec(cmd)
+            with self._phase('kill'):
+                if self.unmount_strategy == self.UNMOUNT_STRATEGY_LAZY:
+                    # Detach it now, so that nothing else starts using (and hanging on) it,
+                    # and let the kernel clean up once it's no longer busy.
+                    yield self._fusermount_step('-uz')
+                    yield from self._kill_steps()
+                else:
+                    # kill sshfs and re-run this same command (which will work then).
+                    yield from self._kill_steps()
+                    yield self._fusermount_step('-u')
+            self.environment.invalidate_mount_table()
+
+        with self._phase('cleanup'):
+            # Releasing the shared SSH connection talks to it (and waits).
+            yield (self.STEP_CALL, self._cleanup_after_unmount)
+        return True
+
+    def unmount_if_unused(self):
+        """Unmounts the sftp system, unless something is using it.
+        Unlike `unmount()`, this never kills sshfs.
+        :return: boolean - whether the system is no longer mounted
+        """
+        if not self.mounted:
+            return True
+        self._fusermount('-u')
+        self.environment.invalidate_mount_table()
+        if self.mounted:
+            return False
+        self._cleanup_after_unmount()
+        return True
 
+    def _cleanup_after_unmount(self):
         self._mount_point_local_delete()
-
-    def _kill(self):
+        if self.environment.mount_state is not None:
+            self.environment.mount_state.forget(self.system.id)
+
+        if self.multiplexed:
+            self.release_control_master()
+
+    def release_control_master(self):
+        """Closes the system's shared SSH connection, unless mounted systems are still using it."""
+        mounted_systems = [
+            system for _, system in self.environment.load_systems(self.environment.get_mounted_ids())
+            if not isinstance(system, SftpConfigException)
+        ]
+        self.environment.control_masters.release(self.system, mounted_systems)
+
+    def _kill_steps(self):
+        """The steps of killing sshfs (see `_run_steps()`)."""
         pid = self.environment.get_pid_by_system_id(self.system.id)
         if pid is None:
             return
+        ssh_pids = self.environment.get_ssh_pids_by_system_id(self.system.id)
         kill_pid(pid, SystemControllerModel.SIGNAL_SIGTERM)
 
-        from time import sleep
-        sleep(SystemControllerModel.KILL_WAIT_TIME_SECONDS)
+        if (yield (self.STEP_WAIT_FOR_EXIT, pid, self.kill_wait_time)):
+            return
 
-        pid = self.environment.get_pid_by_system_id(self.system.id)
-        if pid is not None:
-            kill_pid(pid, SystemControllerModel.SIGNAL_SIGKILL)
+        # Killing the ssh connection first lets a hung sshfs notice it's disconnected.
+        for ssh_pid in ssh_pids:
+            kill_pid(ssh_pid, SystemControllerModel.SIGNAL_SIGKILL)
+        kill_pid(pid, SystemControllerModel.SIGNAL_SIGKILL)
+        # SIGKILL can't be ignored, but it's still not instant.
+        # The filesystem can't be unmounted until sshfs is really gone.
+        yield (self.STEP_WAIT_FOR_EXIT, pid, self.kill_wait_time)
@@ -0,0 +1,135 @@
+import os
+import threading
+
+from .helper import mkdir_p, run_command, split_fuse_options
+
+
+class ControlMasterManager(object):
+    """Manages shared SSH connections (see `ControlMaster` in `ssh_config(5)`).
+
+    Systems connecting to the same host, as the same user, in the same way,
+    share a single connection, so mounting another one only needs to open a new channel
+    (no new handshake and authentication).
+    The master connection is closed when the last system using it is unmounted.
+    """
+
+    #: ssh options which are about sharing the connection (rather than how to connect)
+    CONTROL_OPTIONS = ('controlmaster', 'controlpath', 'controlpersist')
+
+    def __init__(self, environment):
+        self.environment = environment
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Multiplexing needs a private (per-user) runtime directory for the sockets."""
+        return self.environment.runtime_path_base is not None
+
+    def get_key(self, system):
+        """Systems with the same key can share a connection."""
+        return (
+            system.user, system.host, system.port, system.auth_method, system.ssh_key,
+            tuple(self.get_connection_options(system)),
+        )
+
+    def get_connection_options(self, system):
+        """Returns the ssh options (`-o`) the system connects with: those of its performance profile
+        and those in an `ssh_command` of its own (mount options), leaving out the ones about sharing the connection.
+        """
+        from .model import MountCommandBuilder
+
+        argvs = [MountCommandBuilder(system, self.environment).get_ssh_argv(multiplexed=False)]
+        for value in system.mount_opts:
+            for option in split_fuse_options(value):
+                if option.startswith('ssh_command='):
+                    argvs.append(option[len('ssh_command='):].split())
+
+        options = []
+        for argv in argvs:
+            for idx, arg in enumerate(argv):
+                if arg == '-o' and idx + 1 < len(argv):
+                    option = argv[idx + 1]
+                elif arg.startswith('-o') and len(arg) > 2:
+                    option = arg[2:]
+                else:
+                    continue
+                if option.split('=', 1)[0].strip().lower() not in self.CONTROL_OPTIONS:
+                    options.append(option)
+        return options
+
+    def get_control_path(self, system):
+        import hashlib
+
+        # Unix socket paths are limited to ~100 characters, so we can't just use the key as is.
+        digest = hashlib.sha1(repr(self.get_key(system)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.environment.runtime_path_base, 'ssh', digest)
+
+    def get_ssh_options(self, system):
+        """Returns the ssh options (an argv list) which make it use the shared connection.
+        If the master connection is not there, ssh will start it (in the background).
+        """
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % self.get_control_path(system),
+            '-o', 'ControlPersist=yes',
+        ]
+
+    def get_control_dir(self, system):
+        """Returns the directory the system's control socket lives in (private to the user)."""
+        return os.path.dirname(self.get_control_path(system))
+
+    def ensure_control_dir(self, system):
+        """Creates the directory for the system's control socket.
+        Without it, ssh can't become the master (it connects on its own, with just a warning).
+        """
+        control_dir = self.get_control_dir(system)
+        mkdir_p(control_dir)
+        os.chmod(control_dir, 0o700)
+
+    def _get_lock(self, system):
+        with self._locks_lock:
+            return self._locks.setdefault(self.get_key(system), threading.Lock())
+
+    def is_running(self, system):
+        result = run_command(self._get_control_argv(system, 'check'), timeout=5)
+        return result.returncode == 0
+
+    def ensure_master(self, controller):
+        """Starts the master connection for the controller's system, unless it's already running.
+
+        Systems on the same host may be mounted concurrently, and without this
+        they would all race to become the master.
+        :return: boolean - whether the master connection is running
+        """
+        system = controller.system
+        control_path = self.get_control_path(system)
+        with self._get_lock(system):
+            if os.path.exists(control_path) and self.is_running(system):
+                return True
+            self.ensure_control_dir(system)
+            argv = controller.get_ssh_argv(multiplexed=False)
+            argv += self.get_ssh_options(system)
+            # Put into the background (-f) once connected, without running a command (-N).
+            argv += ['-M', '-N', '-f', '%s@%s' % (system.user, system.host)]
+            timeout = None
+            if system.auth_method not in system.AUTH_METHODS_INTERACTIVE:
+                timeout = controller.SSH_CONNECT_TIMEOUT * 2
+            # The backgrounded master may hold on to its output, so we don't capture it.
+            run_command(argv, timeout=timeout, capture=False)
+            return self.is_running(system)
+
+    def release(self, system, mounted_systems):
+        """Closes the master connection of the given system,
+        unless other (mounted) systems are still using it.
+        """
+        key = self.get_key(system)
+        for other in mounted_systems:
+            if other.id != system.id and other.ssh_multiplexing and self.get_key(other) == key:
+                return
+        with self._get_lock(system):
+            if os.path.exists(self.get_control_path(system)):
+                run_command(self._get_control_argv(system, 'exit'), timeout=5)
+
+    def _get_control_argv(self, system, command):
+        return ['ssh', '-o', 'ControlPath=%s' % self.get_control_path(system), '-O', command, system.host]
@@ -0,0 +1,313 @@
+"""Readers for the kernel's view of mounts and processes (`/proc`)."""
+
+import collections
+import os
+import select
+import time
+
+
+#: Describes a single mounted filesystem, as seen in `/proc/self/mountinfo`
+MountEntry = collections.namedtuple('MountEntry', 'dest source fstype options super_options')
+
+
+def _unescape(value):
+    """Undoes the octal escaping (`\\040` for space, etc.) the kernel does in mount tables."""
+    if '\\' not in value:
+        return value
+    import re
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+
+
+class MountTable(object):
+    """A snapshot of the mount table, indexed by mount destination."""
+
+    MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        # If something is mounted over something else, the last one wins (it's what's visible).
+        self.by_dest = dict((entry.dest, entry) for entry in self.entries)
+
+    def get(self, dest):
+        return self.by_dest.get(dest.rstrip('/') or '/')
+
+    def is_mounted(self, dest, fstype=None):
+        entry = self.get(dest)
+        if entry is None:
+            return False
+        return fstype is None or entry.fstype == fstype
+
+    def find(self, dest_prefix, fstype=None):
+        """Returns the entries mounted directly under the given directory."""
+        dest_prefix = dest_prefix.rstrip('/') + '/'
+        out = []
+        for dest, entry in self.by_dest.items():
+            if not dest.startswith(dest_prefix) or '/' in dest[len(dest_prefix):]:
+                continue
+            if fstype is not None and entry.fstype != fstype:
+                continue
+            out.append(entry)
+        return out
+
+    @staticmethod
+    def parse_mountinfo(content):
+        # Format (see `proc(5)`):
+        # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        # (1)(2)(3)   (4)   (5)      (6)      (7)   (8) (9)   (10)         (11)
+        # There may be zero or more optional fields (7), terminated by a single hyphen.
+        entries = []
+        for line in content.split('\n'):
+            fields = line.split(' ')
+            try:
+                separator = fields.index('-', 6)
+                entries.append(MountEntry(
+                    dest = _unescape(fields[4]),
+                    source = _unescape(fields[separator + 2]),
+                    fstype = fields[separator + 1],
+                    options = fields[5].split(','),
+                    super_options = fields[separator + 3].split(','),
+                ))
+            except (ValueError, IndexError):
+                continue
+        return MountTable(entries)
+
+    @staticmethod
+    def parse_mount_output(content):
+        """Parses the output of `mount -l` (used when mountinfo is not available).
+
+        Lines look like this:
+        user@host:/remote/path on /mnt/sshfs/id type fuse.sshfs (rw,nosuid,nodev,user_id=1000)
+        """
+        import re
+        regex = re.compile(r'^(.+?) on (.+?) type (\S+) \((.*?)\)')
+        entries = []
+        for line in content.split('\n'):
+            match_object = regex.match(line)
+            if match_object is None:
+                continue
+            source, dest, fstype, options = match_object.groups()
+            options = options.split(',')
+            entries.append(MountEntry(dest, source, fstype, options, options))
+        return MountTable(entries)
+
+    @staticmethod
+    def read(path=None):
+        with open(path or MountTable.MOUNTINFO_PATH) as f:
+            return MountTable.parse_mountinfo(f.read())
+
+
+class MountWatcher(object):
+    """Waits for changes to the mount table, without busy-polling.
+
+    The kernel signals POLLPRI on `/proc/self/mountinfo` whenever something gets mounted or unmounted.
+    Other files (not backed by the kernel) are re-read periodically instead.
+    """
+
+    #: How often to re-check things (abort conditions, files that don't support polling)
+    CHECK_INTERVAL_SECONDS = 0.1
+
+    def __init__(self, path=None):
+        self.path = path or MountTable.MOUNTINFO_PATH
+        self._file = open(self.path)
+        self._poller = None
+        if self.path.startswith('/proc/'):
+            self._poller = select.poll()
+            self._poller.register(self._file.fileno(), select.POLLPRI | select.POLLERR)
+
+    def close(self):
+        self._file.close()
+
+    def fileno(self):
+        """Returns the file descriptor the kernel signals changes on (with POLLPRI),
+        or None for files which don't support polling.
+        """
+        return None if self._poller is None else self._file.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self):
+        """Reads the current mount table (this also resets the change notification)."""
+        self._file.seek(0)
+        return MountTable.parse_mountinfo(self._file.read())
+
+    def wait(self, timeout=None):
+        """Blocks until the mount table (possibly) changes or `timeout` seconds pass.
+        :return: boolean - whether a change was signaled
+        """
+        if self._poller is None:
+            time.sleep(self.CHECK_INTERVAL_SECONDS if timeout is None else min(timeout, self.CHECK_INTERVAL_SECONDS))
+            return True
+        return len(self._poller.poll(None if timeout is None else timeout * 1000)) != 0
+
+    def wait_for(self, dest, fstype=None, timeout=None, abort=None):
+        """Waits until something (of the given type) gets mounted at `dest`.
+
+        Waiting stops early if the `abort` callable returns True
+        (e.g. the process that was supposed to mount exited).
+        :return: MountTable snapshot with the mount in it, or None if it didn't show up
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            aborted = abort is not None and abort()
+            table = self.read()
+            if table.is_mounted(dest, fstype):
+                return table
+            if aborted:
+                return None
+            wait_time = None if abort is None else self.CHECK_INTERVAL_SECONDS
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+            self.wait(wait_time)
+
+
+class ProcessIndex(object):
+    """A snapshot of the running sshfs processes (and their ssh children),
+    built by a single pass over `/proc`.
+    """
+
+    PROC_PATH = '/proc'
+
+    def __init__(self, processes, parents):
+        #: pid -> argv, for all sshfs and ssh processes
+        self.processes = processes
+        #: pid -> parent pid, for all ssh processes
+        self.parents = parents
+
+        self.sshfs_by_dest = {}
+        for pid, argv in processes.items():
+            if os.path.basename(argv[0]) != 'sshfs' or len(argv) < 2:
+                continue
+            # The mount destination is the last argument (`sshfs [options] source dest`)
+            self.sshfs_by_dest[argv[-1].rstrip('/') or '/'] = pid
+
+        self.children = {}
+        for pid, ppid in parents.items():
+            self.children.setdefault(ppid, []).append(pid)
+
+    def get_sshfs_pid(self, dest):
+        return self.sshfs_by_dest.get(dest.rstrip('/') or '/')
+
+    def get_ssh_pids(self, sshfs_pid):
+        """Returns the ssh processes the given sshfs process uses for its connection."""
+        return sorted(self.children.get(sshfs_pid, []))
+
+    @staticmethod
+    def _read_argv(pid_path):
+        with open(os.path.join(pid_path, 'cmdline'), 'rb') as f:
+            return f.read().decode('utf-8', 'replace').rstrip('\0').split('\0')
+
+    @staticmethod
+    def _read_ppid(pid_path):
+        with open(os.path.join(pid_path, 'stat')) as f:
+            # The process name (2nd field) is in parentheses and may contain spaces,
+            # so we look for the fields after the closing parenthesis.
+            # Format: `pid (comm) state ppid ...`
+            return int(f.read().rsplit(')', 1)[1].split()[1])
+
+    @staticmethod
+    def read(proc_path=None):
+        proc_path = proc_path or ProcessIndex.PROC_PATH
+        processes = {}
+        parents = {}
+        with os.scandir(proc_path) as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                pid = int(entry.name)
+                try:
+                    argv = ProcessIndex._read_argv(entry.path)
+                    name = os.path.basename(argv[0])
+                    if name not in ('sshfs', 'ssh'):
+                        continue
+                    processes[pid] = argv
+                    # Parents are only interesting for ssh processes (to find their sshfs)
+                    if name == 'ssh':
+                        parents[pid] = ProcessIndex._read_ppid(entry.path)
+                except (IOError, OSError, IndexError, ValueError):
+                    # The process went away while we were looking at it, or it's a kernel thread.
+                    continue
+        return ProcessIndex(processes, parents)
+
+
+def find_busy_paths(paths, proc_path=None):
+    """Tells which of the given directories are in use (by a single pass over `/proc`).
+    A directory is in use if a process has a file open in it, works in it (cwd) or runs a program from it.
+    Only processes we're allowed to look at (usually our own) are considered.
+    :return: set of paths (from `paths`) in use
+    """
+    paths = [path.rstrip('/') or '/' for path in paths]
+    prefixes = [(path, path.rstrip('/') + '/') for path in paths]
+    busy = set()
+    with os.scandir(proc_path or ProcessIndex.PROC_PATH) as it:
+        for entry in it:
+            if not entry.name.isdigit():
+                continue
+            links = []
+            for name in ('cwd', 'root', 'exe'):
+                try:
+                    links.append(os.readlink(os.path.join(entry.path, name)))
+                except OSError:
+                    pass
+            try:
+                with os.scandir(os.path.join(entry.path, 'fd')) as fds:
+                    for fd in fds:
+                        try:
+                            links.append(os.readlink(fd.path))
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+            for link in links:
+                for path, prefix in prefixes:
+                    if link == path or link.startswith(prefix):
+                        busy.add(path)
+            if len(busy) == len(paths):
+                break
+    return busy
+
+
+def read_process_start_time(pid, proc_path=None):
+    """Tells when the given process started (in clock ticks since boot, see `proc(5)`).
+    A pid can be reused once its process is gone, but not with the same start time,
+    so the two of them identify a process.
+    :return: int, or None if there's no such process
+    """
+    try:
+        with open(os.path.join(proc_path or ProcessIndex.PROC_PATH, str(pid), 'stat')) as f:
+            # `starttime` is the 22nd field. Like in `ProcessIndex._read_ppid()`,
+            # we count the fields after the process name (the 3rd one there).
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def read_process_argv(pid, proc_path=None):
+    """:return: list (the given process's argv), or None if there's no such process"""
+    try:
+        return ProcessIndex._read_argv(os.path.join(proc_path or ProcessIndex.PROC_PATH, str(pid)))
+    except (IOError, OSError):
+        return None
+
+
+def read_child_pids(pid, proc_path=None):
+    """Finds the children of the given process, without going over all of `/proc`.
+    :return: list of pids, or None if the kernel can't tell (no `/proc/{pid}/task/{tid}/children`)
+    """
+    task_path = os.path.join(proc_path or ProcessIndex.PROC_PATH, str(pid), 'task')
+    children = []
+    try:
+        # Each thread's children are listed separately.
+        with os.scandir(task_path) as it:
+            for entry in it:
+                with open(os.path.join(entry.path, 'children')) as f:
+                    children += [int(child) for child in f.read().split()]
+    except (IOError, OSError, ValueError):
+        return None
+    return sorted(children)
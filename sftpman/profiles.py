@@ -0,0 +1,159 @@
+import os
+import collections
+
+from .helper import json, atomic_write, mkdir_p, run_command, which, LazyRegex
+
+
+#: A named set of options tuned for a kind of workload.
+#: `sshfs_options` are passed to sshfs (`-o`), `ssh_options` to ssh (`-o`).
+PerformanceProfile = collections.namedtuple('PerformanceProfile', 'name description sshfs_options ssh_options')
+
+PROFILES = collections.OrderedDict((profile.name, profile) for profile in (
+    PerformanceProfile(
+        'bulk-read',
+        'Large sequential transfers (media, backups, archives).',
+        # Bigger reads, the kernel's page cache, and several connections to spread the load over.
+        ['max_read=65536', 'kernel_cache', 'max_conns=4'],
+        # A fast (hardware-accelerated) cipher and no compression (the data is usually compressed already).
+        ['Ciphers=aes128-gcm@openssh.com,aes128-ctr', 'Compression=no'],
+    ),
+    PerformanceProfile(
+        'many-small-files',
+        'Source trees and other directories with lots of small files.',
+        # Most of the time goes to looking up files, so cache what we learn about them for longer.
+        ['cache_timeout=120', 'cache_stat_timeout=120', 'cache_dir_timeout=120', 'kernel_cache'],
+        [],
+    ),
+    PerformanceProfile(
+        'low-latency-wan',
+        'Interactive use over slow or unreliable (WAN) links.',
+        # Avoid round-trips where we can, and survive connection drops.
+        ['cache_timeout=60', 'kernel_cache', 'reconnect'],
+        ['Compression=yes', 'ServerAliveInterval=15', 'ServerAliveCountMax=3'],
+    ),
+))
+
+
+def get_option_key(option):
+    """Returns what an option sets (`cache_timeout` for `cache_timeout=60`).
+    ssh options are case-insensitive, so keys are lowercased.
+    """
+    return option.split('=', 1)[0].strip().lower()
+
+
+#: The outcome of merging a profile with a system's own options.
+#: `conflicts` is a list of two-tuples (profile option, explicit option overriding it).
+#: `unsupported` is a list of two-tuples (profile option, reason it was left out).
+MergedOptions = collections.namedtuple('MergedOptions', 'sshfs_options ssh_options conflicts unsupported')
+
+
+def merge_options(profile, explicit_options, capabilities=None):
+    """Merges a profile's options with a system's own (explicit) mount options.
+
+    The system's own options win: profile options setting the same thing
+    (with a different value) are left out and reported as conflicts.
+    Profile options the installed sshfs doesn't support (according to `capabilities`) are left out too.
+    :return: MergedOptions (`sshfs_options` doesn't include the explicit options)
+    """
+    explicit = dict((get_option_key(option), option) for option in explicit_options)
+    conflicts = []
+    unsupported = []
+
+    def pick(options, check_support):
+        picked = []
+        for option in options:
+            overriding = explicit.get(get_option_key(option))
+            if overriding is not None:
+                if overriding != option:
+                    conflicts.append((option, overriding))
+                continue
+            if check_support and capabilities is not None:
+                reason = capabilities.get_unsupported_reason(option)
+                if reason is not None:
+                    unsupported.append((option, reason))
+                    continue
+            picked.append(option)
+        return picked
+
+    sshfs_options = pick(profile.sshfs_options, True)
+    ssh_options = pick(profile.ssh_options, False)
+    return MergedOptions(sshfs_options, ssh_options, conflicts, unsupported)
+
+
+class SshfsCapabilities(object):
+    """Knows which options the installed sshfs supports, based on its version."""
+
+    #: Options which need at least this sshfs version
+    OPTIONS_ADDED = {
+        'max_conns': (3, 7, 0),
+    }
+
+    #: Options which stopped working with this sshfs version (sshfs 3 uses libfuse 3)
+    OPTIONS_REMOVED = {
+        'big_writes': (3, 0, 0),
+        'nonempty': (3, 0, 0),
+        'large_read': (3, 0, 0),
+        'atomic_o_trunc': (3, 0, 0),
+    }
+
+    VERSION_REGEX = LazyRegex(r'SSHFS version (\d+)\.(\d+)(?:\.(\d+))?')
+
+    def __init__(self, version):
+        #: three-tuple of ints, or None if unknown (in which case everything is considered supported)
+        self.version = version
+
+    def get_unsupported_reason(self, option):
+        """Returns why the option can't be used, or None if it can."""
+        if self.version is None:
+            return None
+        key = get_option_key(option)
+        if key in self.OPTIONS_ADDED and self.version < self.OPTIONS_ADDED[key]:
+            return 'Needs sshfs %s or newer' % '.'.join(str(part) for part in self.OPTIONS_ADDED[key])
+        if key in self.OPTIONS_REMOVED and self.version >= self.OPTIONS_REMOVED[key]:
+            return 'Not supported since sshfs %s' % '.'.join(str(part) for part in self.OPTIONS_REMOVED[key])
+        return None
+
+    @staticmethod
+    def parse_version(output):
+        match = SshfsCapabilities.VERSION_REGEX.search(output)
+        if match is None:
+            return None
+        return tuple(int(part or 0) for part in match.groups())
+
+    @staticmethod
+    def detect(cache_path=None):
+        """Finds out the version of the installed sshfs.
+
+        Running `sshfs --version` for each mount would be wasteful,
+        so the result is cached (in `cache_path`) until the sshfs executable changes.
+        :return: SshfsCapabilities
+        """
+        path = which('sshfs')
+        if path is None:
+            return SshfsCapabilities(None)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return SshfsCapabilities(None)
+        key = [path, stat.st_mtime_ns, stat.st_size]
+
+        if cache_path is not None:
+            try:
+                with open(cache_path) as f:
+                    cached = json.loads(f.read())
+                if cached['key'] == key:
+                    return SshfsCapabilities(None if cached['version'] is None else tuple(cached['version']))
+            except (ValueError, IOError, KeyError, TypeError):
+                pass
+
+        result = run_command([path, '--version'], timeout=5)
+        version = SshfsCapabilities.parse_version(result.stdout + result.stderr)
+
+        if cache_path is not None:
+            try:
+                mkdir_p(os.path.dirname(cache_path))
+                atomic_write(cache_path, json.dumps({'key': key, 'version': version}), fsync=False)
+            except (IOError, OSError):
+                # It's only a cache.
+                pass
+        return SshfsCapabilities(version)
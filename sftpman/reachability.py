@@ -0,0 +1,57 @@
+import time
+import socket
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+#: Max time to spend on a single host (connecting and waiting for the SSH banner)
+PROBE_TIMEOUT_SECONDS = 2
+
+#: How many hosts to probe at the same time
+PROBE_JOBS = 32
+
+#: The outcome of probing a host. `latency` is the time it took to connect (None if we couldn't).
+HostProbeResult = collections.namedtuple('HostProbeResult', 'host port reachable latency banner error')
+
+
+def probe_host(host, port, timeout=PROBE_TIMEOUT_SECONDS):
+    """Checks whether an SSH server is listening at the given host and port,
+    by connecting and waiting for it to identify itself (`SSH-2.0-...`).
+    :return: HostProbeResult
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        return HostProbeResult(host, port, False, None, None, str(e) or e.__class__.__name__)
+    latency = time.monotonic() - started
+
+    try:
+        banner = b''
+        while b'\n' not in banner and len(banner) < 255:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            chunk = sock.recv(255)
+            if not chunk:
+                break
+            banner += chunk
+    except OSError as e:
+        return HostProbeResult(host, port, False, latency, None, 'No SSH banner received (%s)' % (str(e) or 'timed out'))
+    finally:
+        sock.close()
+
+    banner = banner.split(b'\n')[0].decode('utf-8', 'replace').strip()
+    if not banner.startswith('SSH-'):
+        return HostProbeResult(host, port, False, latency, banner, 'Not an SSH server')
+    return HostProbeResult(host, port, True, latency, banner, None)
+
+
+def probe_hosts(endpoints, timeout=PROBE_TIMEOUT_SECONDS, jobs=PROBE_JOBS):
+    """Probes many (host, port) endpoints concurrently.
+    :return: list of HostProbeResult, in the order of `endpoints` (duplicates are probed once)
+    """
+    endpoints = list(collections.OrderedDict.fromkeys(endpoints))
+    if len(endpoints) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(jobs, len(endpoints))) as executor:
+        return list(executor.map(lambda endpoint: probe_host(endpoint[0], endpoint[1], timeout), endpoints))
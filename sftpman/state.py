@@ -0,0 +1,145 @@
+import os
+import time
+
+from .helper import json, atomic_write, mkdir_p
+from .proc import read_process_start_time, read_process_argv
+
+
+class MountRecord(object):
+    """What sftpman started for a mounted system: the sshfs process (which serves the filesystem)
+    and exactly how it was started.
+    """
+
+    def __init__(self, system_id, pid, start_time, argv, mounted_at=None):
+        self.system_id = system_id
+        self.pid = pid
+        #: When the sshfs process started (see `read_process_start_time()`)
+        self.start_time = start_time
+        #: The sshfs command (argv list) the system got mounted with
+        self.argv = argv
+        #: When the system got mounted (seconds since the epoch)
+        self.mounted_at = time.time() if mounted_at is None else mounted_at
+
+    @property
+    def options(self):
+        """The options (`-o`) sshfs was started with."""
+        return get_argv_options(self.argv)
+
+    def to_dict(self):
+        return {
+            'systemId': self.system_id,
+            'pid': self.pid,
+            'startTime': self.start_time,
+            'argv': self.argv,
+            'options': self.options,
+            'mountedAt': self.mounted_at,
+        }
+
+    @staticmethod
+    def from_dict(data):
+        return MountRecord(data['systemId'], data['pid'], data['startTime'], data['argv'], data['mountedAt'])
+
+
+def get_argv_options(argv):
+    """Returns the options (`-o`) in an sshfs command (argv list)."""
+    return [argv[idx + 1] for idx in range(len(argv) - 1) if argv[idx] == '-o']
+
+
+def diff_argv(old, new):
+    """Compares two sshfs commands (argv lists), option by option.
+    Options are compared as a whole (`cache_timeout=20` and `cache_timeout=60` are different),
+    and so is the rest of the command (the source, flags like `-f`).
+    :return: two-tuple (list of what only `old` has, list of what only `new` has)
+    """
+    def get_parts(argv):
+        parts = []
+        skip = False
+        for idx, arg in enumerate(argv[1:], 1):
+            if skip:
+                skip = False
+            elif arg == '-o' and idx + 1 < len(argv):
+                parts.append(argv[idx + 1])
+                skip = True
+            else:
+                parts.append(arg)
+        return parts
+
+    old_parts, new_parts = get_parts(old), get_parts(new)
+    return [part for part in old_parts if part not in new_parts], [part for part in new_parts if part not in old_parts]
+
+
+class MountStateStore(object):
+    """Remembers the sshfs processes sftpman started (one file per mounted system, see `MountRecord`).
+
+    It lives in the (per-user, in-memory) runtime directory, so it never outlives a reboot.
+    What it says is checked against `/proc` when reading, so a record whose process is gone
+    (crashed, killed by someone else, or its pid reused by another process) is never trusted.
+    """
+
+    def __init__(self, state_dir, proc_path=None):
+        self.state_dir = state_dir
+        self.proc_path = proc_path
+
+    def get_record_path(self, system_id):
+        return os.path.join(self.state_dir, '%s.json' % system_id)
+
+    def record(self, system_id, pid, argv):
+        """Records the sshfs process serving a system (which has just been mounted).
+        :return: MountRecord, or None if there's no such process (anymore)
+        """
+        start_time = read_process_start_time(pid, self.proc_path)
+        if start_time is None:
+            return None
+        record = MountRecord(system_id, pid, start_time, argv)
+        try:
+            mkdir_p(self.state_dir)
+            atomic_write(self.get_record_path(system_id), json.dumps(record.to_dict()), fsync=False)
+        except (IOError, OSError):
+            # We'll do without (and look at `/proc` instead).
+            return None
+        return record
+
+    def load(self, system_id):
+        """Returns the record for the given system, if its sshfs process is still running.
+        Records which are no longer valid get removed.
+        :return: MountRecord or None
+        """
+        try:
+            with open(self.get_record_path(system_id)) as f:
+                record = MountRecord.from_dict(json.loads(f.read()))
+        except (IOError, OSError):
+            return None
+        except (ValueError, KeyError, TypeError):
+            self.forget(system_id)
+            return None
+        if not self._is_running(record):
+            self.forget(system_id)
+            return None
+        return record
+
+    def _is_running(self, record):
+        if read_process_start_time(record.pid, self.proc_path) != record.start_time:
+            return False
+        return read_process_argv(record.pid, self.proc_path) == record.argv
+
+    def load_all(self):
+        """Returns the records of all systems whose sshfs process is still running.
+        :return: dict system id -> MountRecord
+        """
+        try:
+            with os.scandir(self.state_dir) as it:
+                system_ids = [entry.name[:-len('.json')] for entry in it if entry.name.endswith('.json')]
+        except OSError:
+            return {}
+        records = {}
+        for system_id in sorted(system_ids):
+            record = self.load(system_id)
+            if record is not None:
+                records[system_id] = record
+        return records
+
+    def forget(self, system_id):
+        try:
+            os.unlink(self.get_record_path(system_id))
+        except OSError:
+            pass
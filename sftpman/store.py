@@ -0,0 +1,103 @@
+import os
+import threading
+
+from .helper import json, atomic_write, mkdir_p
+
+
+#: The extension of system configuration files
+CONFIG_FILE_EXTENSION = '.json'
+
+
+def list_config_ids(config_dir):
+    """Returns the ids of all systems configured in the given directory (sorted)."""
+    try:
+        with os.scandir(config_dir) as it:
+            names = [entry.name for entry in it if entry.name.endswith(CONFIG_FILE_EXTENSION)]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return sorted(name[:-len(CONFIG_FILE_EXTENSION)] for name in names)
+
+
+class ConfigIndex(object):
+    """A cache of all system configurations, kept in a single file.
+
+    Loading thousands of configurations means opening and parsing thousands of files.
+    The index keeps the parsed configurations, along with the modification time and size
+    of the file each one came from, so only files which changed get parsed again.
+    """
+
+    VERSION = 1
+
+    #: What each (per-file) entry of the index has
+    ENTRY_KEYS = frozenset(('mtime_ns', 'size', 'config'))
+
+    def __init__(self, config_dir, index_path):
+        self.config_dir = config_dir
+        self.index_path = index_path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns all (valid JSON) system configurations, refreshing the index if needed.
+        :return: dict system id -> config dict
+        """
+        with self._lock:
+            entries = self._read_index()
+            fresh = {}
+            changed = False
+            try:
+                with os.scandir(self.config_dir) as it:
+                    files = [entry for entry in it if entry.name.endswith(CONFIG_FILE_EXTENSION)]
+            except (FileNotFoundError, NotADirectoryError):
+                files = []
+
+            for entry in files:
+                system_id = entry.name[:-len(CONFIG_FILE_EXTENSION)]
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                cached = entries.get(system_id)
+                if cached is not None and cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+                    fresh[system_id] = cached
+                    continue
+                changed = True
+                try:
+                    with open(entry.path) as f:
+                        config = json.loads(f.read())
+                except (ValueError, IOError):
+                    # Remembered as broken (until it changes), so that we don't parse it each time.
+                    # Broken files are left out of the results, so that loading them reports the problem.
+                    config = None
+                fresh[system_id] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'config': config}
+
+            if changed or set(fresh) != set(entries):
+                self._write_index(fresh)
+
+        return dict((system_id, entry['config']) for system_id, entry in fresh.items() if entry['config'] is not None)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.loads(f.read())
+            if data.get('version') != self.VERSION or data.get('configDir') != self.config_dir:
+                return {}
+            files = data['files']
+        except (ValueError, IOError, KeyError, AttributeError):
+            return {}
+        if not isinstance(files, dict):
+            return {}
+        # Whatever doesn't look like what we write (truncated, or another version's) gets parsed again.
+        return dict(
+            (system_id, entry) for system_id, entry in files.items()
+            if isinstance(entry, dict) and self.ENTRY_KEYS.issubset(entry)
+            and (entry['config'] is None or isinstance(entry['config'], dict))
+        )
+
+    def _write_index(self, entries):
+        data = {'version': self.VERSION, 'configDir': self.config_dir, 'files': entries}
+        try:
+            mkdir_p(os.path.dirname(self.index_path))
+            atomic_write(self.index_path, json.dumps(data), fsync=False)
+        except (IOError, OSError):
+            # It's only a cache. We'll do without it.
+            pass
@@ -0,0 +1,172 @@
+import os
+import pwd
+import time
+import collections
+
+from .helper import json, atomic_write, mkdir_p, start_command, finish_command, format_command, \
+    kill_pid, pid_exists, wait_for_pid_exit
+from .model import SystemControllerModel
+from .proc import MountTable, ProcessIndex
+
+
+#: An sshfs filesystem mounted (by any user) under the mount base
+SuspendedMount = collections.namedtuple('SuspendedMount', 'system_id dest uid')
+
+OUTCOME_UNMOUNTED = 'unmounted'
+#: Detaching the filesystem failed (and there was no sshfs process to kill)
+OUTCOME_FAILED = 'failed'
+#: sshfs had to be killed (after detaching the filesystem, or failing to)
+OUTCOME_KILLED = 'killed'
+#: We ran out of time, with sshfs still running
+OUTCOME_TIMED_OUT = 'timed_out'
+
+
+class SuspendHook(object):
+    """Unmounts every user's sshfs filesystems before the machine goes to sleep,
+    and (if they were recorded) remounts them afterwards.
+
+    Meant to run as root (from a sleep hook), so it sees (and can unmount) everybody's filesystems.
+    Sleeping with sshfs filesystems mounted leaves them hung after resuming (the connections are gone),
+    and so is anything that touches them.
+
+    Unmounting is bounded by a deadline: a hung filesystem must not keep the machine awake.
+    All filesystems are detached at once (`fusermount -uz`, which doesn't wait for them to stop being used),
+    then whichever sshfs processes are still around get killed.
+    """
+
+    #: Unmounting everything never takes longer than this
+    DEADLINE_SECONDS = 10
+
+    #: After detaching, how long sshfs gets to exit by itself (if the deadline allows)
+    KILL_WAIT_SECONDS = 2
+
+    #: Where the filesystems unmounted on suspend are recorded, so that they can be remounted on resume
+    STATE_PATH = '/run/sftpman/suspended.json'
+
+    #: How many systems each user's `sftpman mount` (on resume) mounts concurrently
+    RESUME_JOBS = 8
+
+    def __init__(self, environment, deadline=DEADLINE_SECONDS, state_path=STATE_PATH, record=False):
+        self.environment = environment
+        self.deadline = deadline
+        self.state_path = state_path
+        #: Whether `suspend()` records what it unmounts (only what's recorded gets remounted on resume)
+        self.record = record
+        self.kill_wait_time = self.KILL_WAIT_SECONDS
+
+    def find_mounts(self):
+        """Finds all sshfs filesystems under the mount base (with a single read of the mount table).
+        :return: list of SuspendedMount
+        """
+        table = MountTable.read(self.environment.mountinfo_path)
+        mounts = []
+        for entry in table.find(self.environment.mount_path_base, self.environment.MOUNT_FSTYPE):
+            # FUSE records who mounted it (`user_id=1000`) among the superblock options.
+            uid = None
+            for option in entry.super_options:
+                if option.startswith('user_id='):
+                    uid = int(option[len('user_id='):])
+            mounts.append(SuspendedMount(os.path.basename(entry.dest), entry.dest, uid))
+        return mounts
+
+    def suspend(self):
+        """Unmounts all sshfs filesystems under the mount base (recording them first, if enabled).
+        :return: list of two-tuples (SuspendedMount, outcome)
+        """
+        deadline = time.monotonic() + self.deadline
+        mounts = self.find_mounts()
+        if len(mounts) == 0:
+            return []
+        if self.record:
+            self._record(mounts)
+
+        processes = ProcessIndex.read()
+
+        # Detach everything at once. Lazy unmounting doesn't wait for anything (not even a hung filesystem).
+        unmounting = [(mount, start_command(['fusermount', '-uz', mount.dest])) for mount in mounts]
+        outcomes = {}
+        for mount, proc in unmounting:
+            result = finish_command(proc, timeout=max(0, deadline - time.monotonic()))
+            outcomes[mount] = OUTCOME_UNMOUNTED if result.returncode == 0 else OUTCOME_FAILED
+
+        # sshfs exits once its filesystem is gone. Whatever doesn't gets terminated, then killed.
+        pids = dict((mount, processes.get_sshfs_pid(mount.dest)) for mount in mounts)
+        running = [mount for mount in mounts if pids[mount] is not None and pid_exists(pids[mount])]
+        running = self._wait_for_exit(running, pids, min(deadline, time.monotonic() + self.kill_wait_time))
+        for mount in running:
+            kill_pid(pids[mount], SystemControllerModel.SIGNAL_SIGTERM)
+            outcomes[mount] = OUTCOME_KILLED
+        running = self._wait_for_exit(running, pids, deadline - 0.5)
+        for mount in running:
+            kill_pid(pids[mount], SystemControllerModel.SIGNAL_SIGKILL)
+            for pid in processes.get_ssh_pids(pids[mount]):
+                kill_pid(pid, SystemControllerModel.SIGNAL_SIGKILL)
+        for mount in self._wait_for_exit(running, pids, deadline):
+            outcomes[mount] = OUTCOME_TIMED_OUT
+        return [(mount, outcomes[mount]) for mount in mounts]
+
+    def _wait_for_exit(self, mounts, pids, until):
+        """Waits (until the given monotonic time) for the sshfs processes of the given mounts to exit.
+        :return: list of the mounts whose sshfs process is still running
+        """
+        running = []
+        for mount in mounts:
+            if not wait_for_pid_exit(pids[mount], max(0, until - time.monotonic())):
+                running.append(mount)
+        return running
+
+    def _record(self, mounts):
+        try:
+            mkdir_p(os.path.dirname(self.state_path))
+            os.chmod(os.path.dirname(self.state_path), 0o700)
+            atomic_write(self.state_path, json.dumps([mount._asdict() for mount in mounts]))
+        except (IOError, OSError):
+            # Not being able to remount later shouldn't stop us from unmounting.
+            pass
+
+    def load_recorded(self):
+        """:return: list of SuspendedMount recorded by `suspend()` (empty if none)"""
+        try:
+            with open(self.state_path) as f:
+                return [SuspendedMount(**mount) for mount in json.loads(f.read())]
+        except (IOError, ValueError, TypeError):
+            return []
+
+    def resume(self):
+        """Remounts what `suspend()` recorded, in the background: a `sftpman mount` for each user (as that user),
+        all of them at once. Waking up shouldn't wait for the network.
+        :return: list of two-tuples (username, list of system ids)
+        """
+        import subprocess
+
+        mounts = self.load_recorded()
+        try:
+            os.unlink(self.state_path)
+        except OSError:
+            pass
+
+        by_uid = collections.OrderedDict()
+        for mount in mounts:
+            if mount.uid is not None:
+                by_uid.setdefault(mount.uid, []).append(mount.system_id)
+
+        started = []
+        for uid, system_ids in by_uid.items():
+            try:
+                username = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                continue
+            command = format_command(['sftpman', 'mount', '--jobs=%d' % self.RESUME_JOBS] + system_ids)
+            runtime_dir = '/run/user/%d' % uid
+            if os.path.isdir(runtime_dir):
+                # Where the user's ssh multiplexing sockets (and our runtime data) are.
+                command = 'XDG_RUNTIME_DIR=%s %s' % (runtime_dir, command)
+            subprocess.Popen(
+                ['su', '-l', username, '-c', command],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            started.append((username, system_ids))
+        return started
@@ -0,0 +1,181 @@
+import os
+import re
+import time
+import contextlib
+
+from .helper import json, atomic_write, mkdir_p
+
+
+OUTCOME_MOUNTED = 'mounted'
+OUTCOME_ALREADY_MOUNTED = 'already_mounted'
+OUTCOME_FAILED = 'failed'
+OUTCOME_UNREACHABLE = 'unreachable'
+OUTCOME_CONFIG_ERROR = 'config_error'
+OUTCOME_UNMOUNTED = 'unmounted'
+OUTCOME_NOT_MOUNTED = 'not_mounted'
+
+#: Outcomes which leave the system mounted
+OUTCOMES_SUCCESSFUL = (OUTCOME_MOUNTED, OUTCOME_ALREADY_MOUNTED)
+
+#: The phases of mounting, in order (see `SystemControllerModel.mount()`)
+MOUNT_PHASES = (
+    # Checking the mount table (is it mounted already?)
+    'check',
+    # Getting the mount point ready (unmounting leftovers, creating the directory)
+    'prepare',
+    # Running the system's `cmd_before_mount`, when it's shared (otherwise it runs as part of `sshfs`)
+    'before_mount',
+    # Starting the shared SSH connection (connecting and authenticating), for multiplexed systems
+    'control_master',
+    # From starting sshfs until the kernel has the mount (connecting, authenticating and starting SFTP)
+    'sshfs',
+    # Waiting for the sshfs foreground process to go away
+    'sshfs_detach',
+    # Recording the sshfs process (see `sftpman.state.MountStateStore`)
+    'record',
+)
+
+#: The phases of unmounting, in order (see `SystemControllerModel.unmount()`)
+UNMOUNT_PHASES = (
+    # Asking nicely (`fusermount -u`)
+    'unmount',
+    # The filesystem was busy: detaching it and/or killing sshfs
+    'kill',
+    # Removing the mount point, releasing the shared SSH connection
+    'cleanup',
+)
+
+
+class PhaseTimer(object):
+    """Records how long each phase of an operation on a system takes,
+    how many processes it runs and how it ends.
+    """
+
+    def __init__(self, system_id, operation='mount'):
+        self.system_id = system_id
+        self.operation = operation
+        #: Wall-clock time (seconds since the epoch) the operation started
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        #: list of two-tuples (phase name, seconds)
+        self.phases = []
+        self.subprocesses = 0
+        #: Total seconds, once finished
+        self.duration = None
+        self.outcome = None
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - started))
+
+    def count_command(self, command):
+        self.subprocesses += 1
+
+    def finish(self, outcome, error=None):
+        self.duration = time.monotonic() - self._started
+        self.outcome = outcome
+        self.error = None if error is None else str(error)
+
+    def get_phase_names(self):
+        """Returns the names of the phases which happened, in order (each one once)."""
+        names = []
+        for name, _ in self.phases:
+            if name not in names:
+                names.append(name)
+        return names
+
+    def get_phase_duration(self, name):
+        """Returns the total time spent in the given phase (None if it didn't happen)."""
+        durations = [duration for phase, duration in self.phases if phase == name]
+        return sum(durations) if len(durations) != 0 else None
+
+    def to_dict(self):
+        phases = dict((name, round(self.get_phase_duration(name), 6)) for name in self.get_phase_names())
+        return {
+            'system': self.system_id,
+            'operation': self.operation,
+            'startedAt': round(self.started_at, 3),
+            'duration': None if self.duration is None else round(self.duration, 6),
+            'phases': phases,
+            'subprocesses': self.subprocesses,
+            'outcome': self.outcome,
+            'error': self.error,
+        }
+
+
+def append_jsonl(timers, path):
+    """Appends a line per timer to the given (JSON lines) log file."""
+    mkdir_p(os.path.dirname(os.path.abspath(path)))
+    content = ''.join('%s\n' % json.dumps(timer.to_dict()) for timer in timers)
+    with open(path, 'a') as f:
+        f.write(content)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_SYSTEM_LABEL_REGEX = re.compile(r'system="((?:[^"\\]|\\.)*)"')
+
+#: name -> help, for the metrics we write
+PROMETHEUS_METRICS = (
+    ('sftpman_mount_phase_duration_seconds', 'Time the last mount spent in each phase.'),
+    ('sftpman_mount_duration_seconds', 'Time the last mount took.'),
+    ('sftpman_mount_subprocesses', 'Processes started by the last mount.'),
+    ('sftpman_mount_success', 'Whether the last mount left the system mounted.'),
+    ('sftpman_mount_last_run_timestamp_seconds', 'When the last mount started.'),
+)
+
+
+def write_prometheus(timers, path):
+    """Writes the timers to a file for the Prometheus node exporter's textfile collector.
+
+    Systems which aren't among `timers`, but are already in the file (from previous runs), are kept.
+    The file is replaced atomically, so the collector never sees a partial file.
+    """
+    samples = dict((name, []) for name, _ in PROMETHEUS_METRICS)
+    labels = set(_escape_label(timer.system_id) for timer in timers)
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line == '' or line.startswith('#'):
+                    continue
+                name = re.split('[{ ]', line, 1)[0]
+                match = _SYSTEM_LABEL_REGEX.search(line)
+                if name not in samples or match is None:
+                    continue
+                if match.group(1) in labels:
+                    # This run has newer data for the system.
+                    continue
+                samples[name].append(line)
+    except IOError:
+        pass
+
+    for timer in timers:
+        system = 'system="%s"' % _escape_label(timer.system_id)
+        for name in timer.get_phase_names():
+            samples['sftpman_mount_phase_duration_seconds'].append(
+                'sftpman_mount_phase_duration_seconds{%s,phase="%s"} %f' % (system, name, timer.get_phase_duration(name))
+            )
+        if timer.duration is not None:
+            samples['sftpman_mount_duration_seconds'].append('sftpman_mount_duration_seconds{%s} %f' % (system, timer.duration))
+        samples['sftpman_mount_subprocesses'].append('sftpman_mount_subprocesses{%s} %d' % (system, timer.subprocesses))
+        samples['sftpman_mount_success'].append(
+            'sftpman_mount_success{%s} %d' % (system, 1 if timer.outcome in OUTCOMES_SUCCESSFUL else 0)
+        )
+        samples['sftpman_mount_last_run_timestamp_seconds'].append(
+            'sftpman_mount_last_run_timestamp_seconds{%s} %.3f' % (system, timer.started_at)
+        )
+
+    lines = []
+    for name, help_text in PROMETHEUS_METRICS:
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name]
+        lines += sorted(samples[name])
+    mkdir_p(os.path.dirname(os.path.abspath(path)))
+    atomic_write(path, '\n'.join(lines) + '\n')
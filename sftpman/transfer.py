@@ -0,0 +1,459 @@
+import os
+import stat
+import time
+import shlex
+import tarfile
+import threading
+import posixpath
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .exception import SftpException
+
+
+#: A file or directory to copy. `path` is relative to the root being copied ('' for the root itself).
+#: `mtime` is in whole seconds.
+FileEntry = collections.namedtuple('FileEntry', 'path is_dir size mtime')
+
+
+class CopyStats(object):
+    """What a copy has done so far."""
+
+    def __init__(self):
+        self.files = 0
+        #: Files which were already there (same size and modification time)
+        self.files_skipped = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        #: list of two-tuples (path, error message)
+        self.errors = []
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'files': self.files,
+            'filesSkipped': self.files_skipped,
+            'filesCopied': self.files_copied,
+            'bytesCopied': self.bytes_copied,
+            'errors': len(self.errors),
+            'seconds': round(self.seconds, 6),
+        }
+
+
+class RemoteShell(object):
+    """Runs commands on a system's host, through ssh."""
+
+    def __init__(self, ssh_argv, destination):
+        #: The ssh command (an argv list), without the destination
+        self.ssh_argv = list(ssh_argv)
+        #: `user@host`
+        self.destination = destination
+
+    def get_argv(self, command):
+        # ssh hands the command to the remote user's shell.
+        return self.ssh_argv + [self.destination, command]
+
+    def start(self, command, stdin=subprocess.DEVNULL):
+        return subprocess.Popen(self.get_argv(command), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @staticmethod
+    def wait(proc):
+        """Waits for a command (fed through its stdin, with no output to speak of) to finish.
+        :return: two-tuple (exit code, stderr)
+        """
+        if proc.stdin is not None and not proc.stdin.closed:
+            proc.stdin.close()
+        proc.stdout.read()
+        stderr = proc.stderr.read().decode('utf-8', 'replace').strip()
+        proc.stdout.close()
+        proc.stderr.close()
+        return proc.wait(), stderr
+
+    def run(self, command, input=b''):
+        """Runs the command, raising SftpException if it fails.
+        :return: bytes - what it wrote to stdout
+        """
+        proc = self.start(command, stdin=subprocess.PIPE)
+        stdout, stderr = proc.communicate(input)
+        if proc.returncode != 0:
+            raise SftpException('`%s` failed (%d): %s' % (command, proc.returncode, stderr.decode('utf-8', 'replace').strip()))
+        return stdout
+
+
+def _quote(path):
+    # Paths starting with a dash would be taken for options.
+    return shlex.quote(path if not path.startswith('-') else './' + path)
+
+
+class TreeCopier(object):
+    """Copies files between the local machine and a system's host, without going through sshfs (FUSE).
+
+    Transfers run over `jobs` concurrent ssh sessions:
+
+    - small files are batched, each batch being streamed as a tar archive
+      (one round-trip for many files, instead of several per file)
+    - large files are split into chunks, which are transferred in parallel (`dd` at an offset)
+
+    Files which are already at the destination (same size and modification time) are skipped,
+    so an interrupted copy can be resumed by running it again.
+    Large files are assembled in a `.sftpman-part` file next to their destination, and only renamed once complete.
+
+    The host needs a POSIX shell with `find` (GNU, for `-printf`), `tar` and `dd` (see `DOWNLOAD_TOOLS`),
+    and for uploading also `xargs` (with `-0`), `mkdir`, `truncate`, `touch` (GNU, for `-d @SECONDS`),
+    `mv` and `rm` (see `UPLOAD_TOOLS`), so this doesn't work with SFTP-only accounts
+    (e.g. `ForceCommand internal-sftp`). They're checked for before copying anything.
+    Symlinks and special files are skipped.
+    """
+
+    #: Files up to this size are batched together
+    SMALL_FILE_SIZE = 1024 * 1024
+    #: Max files per batch
+    BATCH_FILES = 256
+    #: Max bytes per batch
+    BATCH_SIZE = 16 * 1024 * 1024
+    #: Large files are transferred in chunks of this size, by default
+    CHUNK_SIZE = 64 * 1024 * 1024
+    #: What `dd` reads and writes at a time
+    BLOCK_SIZE = 1024 * 1024
+
+    PART_SUFFIX = '.sftpman-part'
+
+    #: What downloading runs on the host
+    DOWNLOAD_TOOLS = ('find', 'tar', 'dd')
+    #: What uploading runs on the host
+    UPLOAD_TOOLS = ('find', 'xargs', 'mkdir', 'tar', 'dd', 'truncate', 'touch', 'mv', 'rm')
+
+    #: Checks for the non-POSIX options we use (each prints what's missing, if it is)
+    TOOL_OPTION_CHECKS = {
+        'find': ("find / -maxdepth 0 -printf ''", 'find -printf (GNU find)'),
+        'xargs': ('xargs -0 sh -c : </dev/null', 'xargs -0'),
+        # `-c` doesn't create anything (the file doesn't exist anyway).
+        'touch': ('touch -c -d @0 /nonexistent/sftpman-check', 'touch -d @SECONDS (GNU touch)'),
+    }
+
+    def __init__(self, shell, jobs=4, chunk_size=CHUNK_SIZE, progress_callback=None):
+        #: RemoteShell
+        self.shell = shell
+        self.jobs = jobs
+        #: Large files are transferred in chunks of this size (a multiple of `BLOCK_SIZE`)
+        self.chunk_size = chunk_size
+        #: Called with CopyStats whenever a file's been copied (from several threads, so it should be quick)
+        self.progress_callback = progress_callback
+        self.stats = CopyStats()
+        self._lock = threading.Lock()
+
+    def _add_error(self, path, e):
+        with self._lock:
+            self.stats.errors.append((path, str(e)))
+
+    def _add_copied(self, files, size):
+        with self._lock:
+            self.stats.files_copied += files
+            self.stats.bytes_copied += size
+        if self.progress_callback is not None:
+            self.progress_callback(self.stats)
+
+    def check_remote_tools(self, tools):
+        """Makes sure the host has the given commands (and the options we use), with a single command.
+        Finding out half-way would leave a partial copy (and `.sftpman-part` files) behind.
+        """
+        checks = []
+        for tool in tools:
+            checks.append('command -v %s >/dev/null 2>&1 || echo %s' % (tool, tool))
+            if tool in self.TOOL_OPTION_CHECKS:
+                command, description = self.TOOL_OPTION_CHECKS[tool]
+                checks.append('{ %s; } >/dev/null 2>&1 || echo %s' % (command, shlex.quote(description)))
+        missing = self.shell.run('; '.join(checks)).decode('utf-8', 'replace').split('\n')
+        missing = [line for line in missing if line != '']
+        if len(missing) != 0:
+            raise SftpException('The host lacks what copying needs: %s' % ', '.join(missing))
+
+    def list_remote(self, root):
+        """Lists a remote tree (which may be a single file).
+        :return: list of FileEntry (empty if `root` doesn't exist)
+        """
+        command = "if [ -e %s ]; then find %s \\( -type f -o -type d \\) -printf '%%y\\t%%s\\t%%T@\\t%%P\\0'; fi" % (
+            _quote(root), _quote(root),
+        )
+        entries = []
+        for line in self.shell.run(command).split(b'\0'):
+            if line == b'':
+                continue
+            kind, size, mtime, path = line.split(b'\t', 3)
+            entries.append(FileEntry(os.fsdecode(path), kind == b'd', int(size), int(float(mtime))))
+        return entries
+
+    @staticmethod
+    def list_local(root):
+        """Lists a local tree (which may be a single file).
+        :return: list of FileEntry (empty if `root` doesn't exist)
+        """
+        def get_entry(path, relative_path):
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                return FileEntry(relative_path, True, 0, int(st.st_mtime))
+            if stat.S_ISREG(st.st_mode):
+                return FileEntry(relative_path, False, st.st_size, int(st.st_mtime))
+            return None
+
+        try:
+            root_entry = get_entry(root, '')
+        except FileNotFoundError:
+            return []
+        entries = [root_entry] if root_entry is not None else []
+        if root_entry is None or not root_entry.is_dir:
+            return entries
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    entry = get_entry(path, os.path.relpath(path, root))
+                except OSError:
+                    continue
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    def _plan(self, source_entries, dest_entries):
+        """Works out what needs copying.
+        :return: three-tuple (directories, list of small file batches, list of large files) - all FileEntry
+        """
+        existing = dict((entry.path, entry) for entry in dest_entries)
+        directories = []
+        batches = []
+        batch, batch_size = [], 0
+        large = []
+        for entry in source_entries:
+            if entry.is_dir:
+                directories.append(entry)
+                continue
+            self.stats.files += 1
+            dest_entry = existing.get(entry.path)
+            if dest_entry is not None and not dest_entry.is_dir and (dest_entry.size, dest_entry.mtime) == (entry.size, entry.mtime):
+                self.stats.files_skipped += 1
+                continue
+            # A lone file is always copied in chunks (tar can't rename it on the way).
+            if entry.size > self.SMALL_FILE_SIZE or entry.path == '':
+                large.append(entry)
+                continue
+            if len(batch) == self.BATCH_FILES or batch_size + entry.size > self.BATCH_SIZE:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(entry)
+            batch_size += entry.size
+        if len(batch) != 0:
+            batches.append(batch)
+        return directories, batches, large
+
+    def _get_chunks(self, entry):
+        """:return: list of two-tuples (offset, size)"""
+        return [(offset, min(self.chunk_size, entry.size - offset)) for offset in range(0, entry.size, self.chunk_size)] or [(0, 0)]
+
+    def _run_tasks(self, tasks):
+        """Runs the tasks (two-tuples of (function, args)) using `jobs` threads. Larger ones should come first."""
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            for future in [executor.submit(function, *args) for function, args in tasks]:
+                future.result()
+
+    def _copy_large_files(self, large, copy_chunk, finish):
+        """Copies the large files, chunk by chunk, calling `finish(entry)` once all chunks of a file are there."""
+        remaining = {}
+        failed = set()
+
+        def run_chunk(entry, offset, size):
+            try:
+                copy_chunk(entry, offset, size)
+            except (SftpException, IOError, OSError) as e:
+                with self._lock:
+                    is_first_error = entry.path not in failed
+                    failed.add(entry.path)
+                if is_first_error:
+                    self._add_error(entry.path, e)
+            with self._lock:
+                remaining[entry.path] -= 1
+                is_last = remaining[entry.path] == 0 and entry.path not in failed
+            if is_last:
+                try:
+                    finish(entry)
+                except (SftpException, IOError, OSError) as e:
+                    self._add_error(entry.path, e)
+                    return
+                self._add_copied(1, entry.size)
+
+        tasks = []
+        for entry in sorted(large, key=lambda entry: -entry.size):
+            chunks = self._get_chunks(entry)
+            remaining[entry.path] = len(chunks)
+            tasks += [(run_chunk, (entry, offset, size)) for offset, size in chunks]
+        return tasks
+
+    def download(self, remote_root, local_root):
+        """Makes `local_root` a copy of `remote_root`.
+        :return: CopyStats
+        """
+        started = time.monotonic()
+        self.check_remote_tools(self.DOWNLOAD_TOOLS)
+        source_entries = self.list_remote(remote_root)
+        if len(source_entries) == 0:
+            raise SftpException('%s does not exist' % remote_root)
+        directories, batches, large = self._plan(source_entries, self.list_local(local_root))
+
+        def get_local_path(entry):
+            return os.path.join(local_root, entry.path) if entry.path != '' else local_root
+
+        for entry in directories:
+            os.makedirs(get_local_path(entry), exist_ok=True)
+        if not source_entries[0].is_dir:
+            os.makedirs(os.path.dirname(os.path.abspath(local_root)), exist_ok=True)
+
+        def copy_batch(batch):
+            wanted = dict((entry.path, entry) for entry in batch)
+            proc = self.shell.start('cd %s && tar cf - --null -T -' % _quote(remote_root), stdin=subprocess.PIPE)
+            error = None
+            try:
+                # Names starting with a dash would be taken for options (older tars do that even with `--null`).
+                proc.stdin.write(b''.join(b'./' + os.fsencode(entry.path) + b'\0' for entry in batch))
+                proc.stdin.close()
+                with tarfile.open(fileobj=proc.stdout, mode='r|') as archive:
+                    for member in archive:
+                        # Only take what we asked for (the archive could name anything, e.g. `../..`).
+                        entry = wanted.pop(posixpath.normpath(member.name), None)
+                        if entry is None or not member.isfile():
+                            continue
+                        path = get_local_path(entry)
+                        with open(path + self.PART_SUFFIX, 'wb') as f:
+                            f.write(archive.extractfile(member).read())
+                        os.utime(path + self.PART_SUFFIX, (entry.mtime, entry.mtime))
+                        os.replace(path + self.PART_SUFFIX, path)
+                        self._add_copied(1, entry.size)
+            except (tarfile.TarError, IOError, OSError) as e:
+                proc.kill()
+                error = e
+            finally:
+                proc.stdout.close()
+                stderr = proc.stderr.read().decode('utf-8', 'replace').strip()
+                proc.stderr.close()
+                proc.wait()
+            if error is not None:
+                self._add_error(remote_root, 'Copying a batch of %d files failed: %s' % (len(batch), str(error)))
+                return
+            for path in wanted:
+                self._add_error(path, stderr or 'Not received')
+
+        def prepare(entry):
+            with open(get_local_path(entry) + self.PART_SUFFIX, 'wb') as f:
+                f.truncate(entry.size)
+
+        def copy_chunk(entry, offset, size):
+            if size == 0:
+                return
+            remote_path = posixpath.join(remote_root, entry.path) if entry.path != '' else remote_root
+            proc = self.shell.start('dd if=%s bs=%d skip=%d count=%d 2>/dev/null' % (
+                _quote(remote_path), self.BLOCK_SIZE, offset // self.BLOCK_SIZE, (size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE,
+            ))
+            received = 0
+            try:
+                with open(get_local_path(entry) + self.PART_SUFFIX, 'r+b') as f:
+                    f.seek(offset)
+                    while received < size:
+                        data = proc.stdout.read(min(self.BLOCK_SIZE, size - received))
+                        if not data:
+                            break
+                        f.write(data)
+                        received += len(data)
+            finally:
+                proc.kill()
+                proc.communicate()
+            if received != size:
+                raise SftpException('Received %d bytes (at offset %d) instead of %d' % (received, offset, size))
+
+        def finish(entry):
+            path = get_local_path(entry)
+            os.utime(path + self.PART_SUFFIX, (entry.mtime, entry.mtime))
+            os.replace(path + self.PART_SUFFIX, path)
+
+        for entry in large:
+            prepare(entry)
+        tasks = self._copy_large_files(large, copy_chunk, finish)
+        tasks += [(copy_batch, (batch,)) for batch in batches]
+        self._run_tasks(tasks)
+        self.stats.seconds = time.monotonic() - started
+        return self.stats
+
+    def upload(self, local_root, remote_root):
+        """Makes `remote_root` a copy of `local_root`.
+        :return: CopyStats
+        """
+        started = time.monotonic()
+        self.check_remote_tools(self.UPLOAD_TOOLS)
+        source_entries = self.list_local(local_root)
+        if len(source_entries) == 0:
+            raise SftpException('%s does not exist' % local_root)
+        directories, batches, large = self._plan(source_entries, self.list_remote(remote_root))
+
+        def get_remote_path(entry):
+            return posixpath.join(remote_root, entry.path) if entry.path != '' else remote_root
+
+        paths = [get_remote_path(entry) for entry in directories]
+        if not source_entries[0].is_dir:
+            paths.append(posixpath.dirname(remote_root) or '/')
+        if len(paths) != 0:
+            self.shell.run('xargs -0 mkdir -p --', b''.join(os.fsencode(path) + b'\0' for path in paths))
+
+        def copy_batch(batch):
+            proc = self.shell.start('cd %s && tar xf -' % _quote(remote_root), stdin=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|') as archive:
+                    for entry in batch:
+                        archive.add(os.path.join(local_root, entry.path), arcname=entry.path, recursive=False)
+            except (tarfile.TarError, IOError, OSError) as e:
+                proc.kill()
+                self.shell.wait(proc)
+                self._add_error(local_root, 'Copying a batch of %d files failed: %s' % (len(batch), str(e)))
+                return
+            returncode, stderr = self.shell.wait(proc)
+            if returncode != 0:
+                self._add_error(local_root, 'Copying a batch of %d files failed: %s' % (len(batch), stderr))
+                return
+            self._add_copied(len(batch), sum(entry.size for entry in batch))
+
+        def copy_chunk(entry, offset, size):
+            part_path = get_remote_path(entry) + self.PART_SUFFIX
+            # `dd` writes whatever it gets (even short reads from the pipe) right after the previous write.
+            proc = self.shell.start('dd of=%s bs=%d seek=%d conv=notrunc 2>/dev/null' % (
+                _quote(part_path), self.BLOCK_SIZE, offset // self.BLOCK_SIZE,
+            ), stdin=subprocess.PIPE)
+            try:
+                with open(os.path.join(local_root, entry.path) if entry.path != '' else local_root, 'rb') as f:
+                    f.seek(offset)
+                    sent = 0
+                    while sent < size:
+                        data = f.read(min(self.BLOCK_SIZE, size - sent))
+                        if not data:
+                            raise SftpException('%s got shorter while copying it' % entry.path)
+                        proc.stdin.write(data)
+                        sent += len(data)
+            except BaseException:
+                proc.kill()
+                self.shell.wait(proc)
+                raise
+            returncode, stderr = self.shell.wait(proc)
+            if returncode != 0:
+                raise SftpException('Writing %d bytes at offset %d failed: %s' % (size, offset, stderr))
+
+        def finish(entry):
+            path = get_remote_path(entry)
+            self.shell.run('truncate -s %d %s && touch -m -d @%d %s && mv -f %s %s' % (
+                entry.size, _quote(path + self.PART_SUFFIX), entry.mtime, _quote(path + self.PART_SUFFIX),
+                _quote(path + self.PART_SUFFIX), _quote(path),
+            ))
+
+        if len(large) != 0:
+            # Leftovers of an interrupted copy could be longer than the file is now.
+            self.shell.run('xargs -0 rm -f --', b''.join(os.fsencode(get_remote_path(entry) + self.PART_SUFFIX) + b'\0' for entry in large))
+        tasks = self._copy_large_files(large, copy_chunk, finish)
+        tasks += [(copy_batch, (batch,)) for batch in batches]
+        self._run_tasks(tasks)
+        self.stats.seconds = time.monotonic() - started
+        return self.stats
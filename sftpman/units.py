@@ -0,0 +1,200 @@
+import os
+import string
+
+from .helper import atomic_write, mkdir_p, which, escape_fuse_option
+from .model import MountCommandBuilder, SystemControllerModel
+
+
+UNIT_TYPE_SERVICE = 'service'
+UNIT_TYPE_MOUNT = 'mount'
+UNIT_TYPES = (UNIT_TYPE_SERVICE, UNIT_TYPE_MOUNT)
+
+#: Where `--type=service` units go by default (they're started by the user's service manager)
+USER_UNIT_PATH = os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'systemd', 'user')
+
+#: Where `--type=mount` units go by default (mounting is done by the system's service manager)
+SYSTEM_UNIT_PATH = '/etc/systemd/system'
+
+_UNIT_NAME_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + ':_.')
+
+
+def escape_unit_name(value):
+    """Escapes a string for use in a unit name (like `systemd-escape`)."""
+    out = []
+    for idx, char in enumerate(value):
+        if char == '/':
+            out.append('-')
+        elif char in _UNIT_NAME_SAFE_CHARS and not (idx == 0 and char == '.'):
+            out.append(char)
+        else:
+            out.extend('\\x%02x' % byte for byte in char.encode('utf-8'))
+    return ''.join(out)
+
+
+def escape_unit_path(path):
+    """Escapes a path for use in a unit name (like `systemd-escape --path`).
+    `.mount` and `.automount` units must be named after the path they're for.
+    """
+    path = os.path.normpath(path).strip('/')
+    return '-' if path == '' else escape_unit_name(path)
+
+
+def escape_specifiers(value):
+    """Escapes `%` (which starts a specifier, like `%h`) in a unit setting."""
+    return value.replace('%', '%%')
+
+
+def quote_exec_arg(arg):
+    """Quotes a single argument for an `Exec*=` line (see "COMMAND LINES" in `systemd.service(5)`)."""
+    # Specifiers (%) and environment variables ($) get expanded, unless doubled.
+    arg = escape_specifiers(arg).replace('$', '$$')
+    if arg != '' and not any(char in arg for char in ' \t\n"\'\\;'):
+        return arg
+    arg = arg.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t')
+    return '"%s"' % arg
+
+
+def format_exec(argv):
+    """Formats a command for an `Exec*=` line.
+    Older versions of systemd require the executable to be an absolute path, so we look it up.
+    """
+    executable = which(argv[0]) or argv[0]
+    return ' '.join(quote_exec_arg(arg) for arg in [executable] + list(argv[1:]))
+
+
+class UnitGenerator(object):
+    """Generates systemd units that mount systems, so that the init system
+    can mount them (in parallel) on boot or on login, and supervise them.
+
+    `service` units run sshfs in the foreground, as the user (in the user's service manager).
+    `mount` units (optionally with an `automount` unit, for mounting on first access)
+    are for the system's service manager, so sshfs runs as root.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+
+    def get_service_name(self, system):
+        return 'sftpman-%s.service' % escape_unit_name(system.id)
+
+    def get_mount_name(self, system):
+        return '%s.mount' % escape_unit_path(self.environment.get_system_mount_dest(system.id))
+
+    def get_before_mount_name(self, system):
+        return 'sftpman-%s-before-mount.service' % escape_unit_name(system.id)
+
+    def generate(self, system, unit_type=UNIT_TYPE_SERVICE, automount=False, idle_timeout=None):
+        """Generates the units for the given system.
+        With `automount` (for `mount` units only), `idle_timeout` is the number of seconds
+        after which an unused system gets unmounted (None to keep it mounted).
+        :return: list of two-tuples (unit file name, contents)
+        """
+        if unit_type == UNIT_TYPE_SERVICE:
+            return [(self.get_service_name(system), self._generate_service(system))]
+        return self._generate_mount(system, automount, idle_timeout)
+
+    def write(self, units, output_dir):
+        """Writes units (as returned by `generate()`) to the given directory.
+        :return: list of paths written
+        """
+        mkdir_p(output_dir)
+        paths = []
+        for name, content in units:
+            path = os.path.join(output_dir, name)
+            atomic_write(path, content)
+            paths.append(path)
+        return paths
+
+    def _get_description(self, system, builder):
+        return 'sftpman: %s (%s)' % (system.id, builder.source)
+
+    def _generate_service(self, system):
+        multiplexed = system.ssh_multiplexing and self.environment.control_masters.enabled
+        builder = MountCommandBuilder(system, self.environment, multiplexed)
+        fusermount = ['fusermount', '-u', builder.dest]
+        lines = [
+            '[Unit]',
+            'Description=%s' % escape_specifiers(self._get_description(system, builder)),
+            '',
+            '[Service]',
+            'Type=simple',
+            # Whatever was left mounted (or dead) there gets out of the way first, like in `sftpman mount`.
+            'ExecStartPre=-%s' % format_exec(fusermount),
+            'ExecStartPre=%s' % format_exec(['mkdir', '-p', builder.dest]),
+        ]
+        if multiplexed:
+            # sshfs' ssh becomes the master (or uses it), and it needs somewhere to put the socket.
+            control_dir = self.environment.control_masters.get_control_dir(system)
+            lines.append('ExecStartPre=%s' % format_exec(['mkdir', '-p', '-m', '0700', control_dir]))
+        if builder.cmd_before_mount is not None:
+            lines.append('ExecStartPre=%s' % format_exec(['sh', '-c', builder.cmd_before_mount]))
+        lines += [
+            'ExecStart=%s' % format_exec(builder.get_mount_argv(foreground=True)),
+            'ExecStop=-%s' % format_exec(fusermount),
+            'Restart=on-failure',
+            'RestartSec=5',
+            '',
+            '[Install]',
+            'WantedBy=default.target',
+            '',
+        ]
+        return '\n'.join(lines)
+
+    def _generate_mount(self, system, automount, idle_timeout):
+        # Root has no access to the user's shared connections.
+        builder = MountCommandBuilder(system, self.environment, False)
+        mount_name = self.get_mount_name(system)
+        units = []
+
+        unit_lines = [
+            '[Unit]',
+            'Description=%s' % escape_specifiers(self._get_description(system, builder)),
+            'Wants=network-online.target',
+            'After=network-online.target',
+        ]
+        if builder.cmd_before_mount is not None:
+            # Mount units can't run commands, so this one is a separate unit, pulled in by the mount.
+            before_name = self.get_before_mount_name(system)
+            unit_lines += ['Requires=%s' % before_name, 'After=%s' % before_name]
+            units.append((before_name, '\n'.join([
+                '[Unit]',
+                'Description=sftpman: before mounting %s' % system.id,
+                'Wants=network-online.target',
+                'After=network-online.target',
+                '',
+                '[Service]',
+                'Type=oneshot',
+                'ExecStart=%s' % format_exec(['sh', '-c', builder.cmd_before_mount]),
+                '',
+            ])))
+
+        options = ['_netdev'] + builder.get_mount_options()
+        mount_lines = unit_lines + [
+            '',
+            '[Mount]',
+            'What=%s' % escape_specifiers(builder.source),
+            'Where=%s' % escape_specifiers(builder.dest),
+            'Type=%s' % self.environment.MOUNT_FSTYPE,
+            # Like sshfs (see `MountCommandBuilder.get_mount_argv()`), mount.fuse splits options on commas.
+            'Options=%s' % escape_specifiers(','.join(escape_fuse_option(option) for option in options)),
+            'TimeoutSec=%d' % SystemControllerModel.MOUNT_WAIT_TIME_SECONDS,
+            '',
+        ]
+        if not automount:
+            mount_lines += ['[Install]', 'WantedBy=remote-fs.target', '']
+        units.append((mount_name, '\n'.join(mount_lines)))
+
+        if automount:
+            automount_lines = [
+                '[Unit]',
+                'Description=%s' % escape_specifiers(self._get_description(system, builder)),
+                '',
+                '[Automount]',
+                'Where=%s' % escape_specifiers(builder.dest),
+            ]
+            if idle_timeout:
+                automount_lines.append('TimeoutIdleSec=%d' % idle_timeout)
+            automount_lines += ['', '[Install]', 'WantedBy=remote-fs.target', '']
+            units.append(('%s.automount' % mount_name[:-len('.mount')], '\n'.join(automount_lines)))
+        return units
+
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class WarmStats(object):
+    """What a crawl has done so far."""
+
+    def __init__(self):
+        self.directories = 0
+        self.files = 0
+        #: Files read (whole) into the page cache
+        self.files_read = 0
+        self.bytes_read = 0
+        #: list of two-tuples (path, error message)
+        self.errors = []
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'directories': self.directories,
+            'files': self.files,
+            'filesRead': self.files_read,
+            'bytesRead': self.bytes_read,
+            'errors': len(self.errors),
+            'seconds': round(self.seconds, 6),
+        }
+
+
+class DirectoryWarmer(object):
+    """Crawls a directory tree (on a mounted system), so that whatever uses it next finds warm caches.
+
+    Listing directories and stat-ing their entries fills sshfs's attribute and directory caches
+    (and the kernel's dentry/inode caches). Files no bigger than `read_max_size` are also read
+    (and thrown away), which fills the kernel's page cache (it only survives for `kernel_cache` mounts).
+
+    Each of these is a round-trip to the server, so `jobs` threads do them in parallel.
+    Symlinks aren't followed, so the crawl can't loop or leave the tree.
+    """
+
+    #: How much to read at a time
+    READ_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, path, depth=None, jobs=8, read_max_size=None, progress_callback=None, progress_interval=1.0):
+        self.path = path
+        #: How many levels of subdirectories to descend into (0 only lists `path`, None has no limit)
+        self.depth = depth
+        self.jobs = jobs
+        #: Read files up to this size (in bytes). None doesn't read files.
+        self.read_max_size = read_max_size
+        #: Called with WarmStats (at most every `progress_interval` seconds) while crawling
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.stats = WarmStats()
+        self._lock = threading.Lock()
+
+    def _add_error(self, path, e):
+        with self._lock:
+            self.stats.errors.append((path, str(e)))
+
+    def _scan_directory(self, path, level):
+        """Lists a directory and stats its entries.
+        :return: list of two-tuples (function, args) of further work
+        """
+        work = []
+        files = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        self._add_error(entry.path, e)
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.depth is None or level < self.depth:
+                            work.append((self._scan_directory, (entry.path, level + 1)))
+                        continue
+                    files += 1
+                    if (self.read_max_size is not None and entry.is_file(follow_symlinks=False)
+                            and stat.st_size <= self.read_max_size):
+                        work.append((self._read_file, (entry.path,)))
+        except OSError as e:
+            self._add_error(path, e)
+            return work
+        with self._lock:
+            self.stats.directories += 1
+            self.stats.files += files
+        return work
+
+    def _read_file(self, path):
+        total = 0
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    chunk = f.read(self.READ_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+        except (IOError, OSError) as e:
+            self._add_error(path, e)
+            return []
+        with self._lock:
+            self.stats.files_read += 1
+            self.stats.bytes_read += total
+        return []
+
+    def run(self):
+        """Crawls the tree, returning once everything's been done.
+        :return: WarmStats
+        """
+        started = time.monotonic()
+        last_progress = started
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            pending = set([executor.submit(self._scan_directory, self.path, 0)])
+            while len(pending) != 0:
+                done, pending = wait(pending, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for function, args in future.result():
+                        pending.add(executor.submit(function, *args))
+                now = time.monotonic()
+                if self.progress_callback is not None and now - last_progress >= self.progress_interval:
+                    self.stats.seconds = now - started
+                    self.progress_callback(self.stats)
+                    last_progress = now
+        self.stats.seconds = time.monotonic() - started
+        return self.stats
@@ -0,0 +1,174 @@
+import os
+import time
+import random
+import threading
+import collections
+
+from .exception import SftpException
+from .model import SystemModel, SystemControllerModel
+
+
+HEALTH_HEALTHY = 'healthy'
+HEALTH_SLOW = 'slow'
+HEALTH_STALE = 'stale'
+
+#: The outcome of probing a mount. `latency` is how long the probe took (or has been running, if stale).
+ProbeResult = collections.namedtuple('ProbeResult', 'system_id health latency')
+
+
+class MountProber(object):
+    """Checks whether mounted filesystems respond, without letting a dead one hang us.
+
+    Each probe runs in its own (daemon) thread, which we stop waiting for after a timeout.
+    A thread stuck on a dead mount can't be interrupted, so while it's stuck
+    the mount is reported as stale without being probed again.
+    """
+
+    def __init__(self, timeout, slow_threshold):
+        self.timeout = timeout
+        self.slow_threshold = slow_threshold
+        self._outstanding = {}
+        self._lock = threading.Lock()
+
+    def start(self, path):
+        """Starts probing the given path (unless a previous probe is still stuck on it).
+        :return: the probe, to be passed to `collect()`
+        """
+        with self._lock:
+            if path in self._outstanding:
+                return self._outstanding[path]
+            probe = {'started': time.monotonic(), 'done': threading.Event()}
+            self._outstanding[path] = probe
+
+        def work():
+            try:
+                # `statvfs` goes all the way to the server (sshfs doesn't cache it),
+                # unlike `stat`, which sshfs may answer from its attribute cache.
+                os.statvfs(path)
+            except OSError:
+                # It answered, but with an error ("Transport endpoint is not connected" and friends),
+                # which is just as bad.
+                probe['failed'] = True
+            probe['latency'] = time.monotonic() - probe['started']
+            probe['done'].set()
+            with self._lock:
+                del self._outstanding[path]
+
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        return probe
+
+    def collect(self, probe, deadline):
+        """Waits (until the `deadline`, in monotonic time) for the probe to finish.
+        :return: two-tuple (health, latency)
+        """
+        started = probe['started']
+        if not probe['done'].wait(max(0, min(deadline, started + self.timeout) - time.monotonic())):
+            return HEALTH_STALE, time.monotonic() - started
+        if probe.get('failed'):
+            return HEALTH_STALE, probe['latency']
+        if probe['latency'] >= self.slow_threshold:
+            return HEALTH_SLOW, probe['latency']
+        return HEALTH_HEALTHY, probe['latency']
+
+
+class Watchdog(object):
+    """Keeps an eye on mounted systems and remounts the ones that go stale
+    (e.g. after the remote host reboots).
+
+    Remounting failures are retried with an exponential backoff (with jitter,
+    so that many systems on the same host don't retry in lockstep).
+    """
+
+    #: Probes taking longer than this consider the mount stale
+    PROBE_TIMEOUT_SECONDS = 5
+
+    #: Probes taking longer than this consider the mount slow
+    SLOW_THRESHOLD_SECONDS = 1
+
+    #: Delay before retrying a failed remount (doubles with each failure)
+    BACKOFF_BASE_SECONDS = 5
+
+    #: Max delay before retrying a failed remount
+    BACKOFF_MAX_SECONDS = 300
+
+    def __init__(self, environment, system_ids=None, remount=True):
+        self.environment = environment
+        #: Systems to watch. If None, all mounted systems are watched.
+        self.system_ids = system_ids
+        self.remount = remount
+        self.prober = MountProber(self.PROBE_TIMEOUT_SECONDS, self.SLOW_THRESHOLD_SECONDS)
+        #: system id -> ProbeResult, from the last check
+        self.results = {}
+        #: system id -> two-tuple (failure count, monotonic time of the next attempt)
+        self.remount_pending = {}
+
+    def get_report(self):
+        """Returns the latest probe results (health and latency of each system)."""
+        return [self.results[system_id] for system_id in sorted(self.results)]
+
+    def check(self):
+        """Probes all watched systems (concurrently) and remounts the stale ones.
+        :return: list of ProbeResult
+        """
+        self.environment.invalidate_mount_table()
+        system_ids = self.environment.get_mounted_ids()
+        if self.system_ids is not None:
+            system_ids = [system_id for system_id in system_ids if system_id in self.system_ids]
+
+        probes = [self.prober.start(self.environment.get_system_mount_dest(system_id)) for system_id in system_ids]
+
+        deadline = time.monotonic() + self.PROBE_TIMEOUT_SECONDS
+        results = []
+        for system_id, probe in zip(system_ids, probes):
+            health, latency = self.prober.collect(probe, deadline)
+            results.append(ProbeResult(system_id, health, latency))
+
+        self.results = dict((result.system_id, result) for result in results)
+
+        if self.remount:
+            for result in results:
+                if result.health == HEALTH_STALE and result.system_id not in self.remount_pending:
+                    self.remount_pending[result.system_id] = (0, time.monotonic())
+            self._remount_due()
+
+        return results
+
+    def run_forever(self, interval, callback=None):
+        """Checks every `interval` seconds, passing the results to `callback`."""
+        while True:
+            results = self.check()
+            if callback is not None:
+                callback(results)
+            time.sleep(interval)
+
+    def get_backoff_delay(self, failures):
+        delay = min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * (2 ** failures))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _remount_due(self):
+        now = time.monotonic()
+        for system_id, (failures, next_attempt) in list(self.remount_pending.items()):
+            if next_attempt > now:
+                continue
+            if self._remount(system_id):
+                del self.remount_pending[system_id]
+            else:
+                failures += 1
+                self.remount_pending[system_id] = (failures, now + self.get_backoff_delay(failures))
+
+    def _remount(self, system_id):
+        try:
+            system = SystemModel.create_by_id(system_id, self.environment)
+            if system.auth_method in SystemModel.AUTH_METHODS_INTERACTIVE:
+                # Nobody's there to type the password.
+                return False
+            controller = SystemControllerModel(system, self.environment)
+            # Detach the dead mount right away, so nothing else gets stuck on it.
+            controller.unmount_strategy = SystemControllerModel.UNMOUNT_STRATEGY_LAZY
+            controller.unmount()
+            controller.mount()
+        except SftpException:
+            return False
+        return True
@@ -3,12 +3,20 @@
 # Sleep hook for systemd.
 # Takes care of unmounting everything for all users on system suspend/hibernate.
 # To be placed in /usr/lib/systemd/system-sleep/
+#
+# Unmounting never takes longer than the deadline (even if a filesystem hangs).
+# See `sftpman help` (suspend_hook) for the options.
+#
+# To also mount everything again on resume (in the background, as the users who had it mounted),
+# set REMOUNT=yes. Remounting may well start before the network is back.
+REMOUNT=no
 
-if [ -n "$1" ]; then
-	if ([ "$1" = "pre" ]); then
-		for username in $(ps aux | grep '/mnt/sshfs/' | grep -v 'grep' | grep -o -E '^(\w+)\s' | uniq); do
-			su -l $username -c 'sftpman umount_all'
-		done;
+if [ "$1" = "pre" ]; then
+	if [ "$REMOUNT" = "yes" ]; then
+		sftpman suspend-hook --deadline=10 --record pre
+	else
+		sftpman suspend-hook --deadline=10 pre
 	fi
+elif [ "$1" = "post" ] && [ "$REMOUNT" = "yes" ]; then
+	sftpman suspend-hook post
 fi
-